@@ -0,0 +1,420 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+A non-blocking VNX block device API which runs ``naviseccli`` through the
+reactor.
+
+Scanning for and waiting on devices is done exactly as by the synchronous
+API, in the reactor's thread pool.
+"""
+
+import os
+
+from eliot import Message
+from twisted.internet.defer import (
+    DeferredSemaphore, gatherResults, inlineCallbacks, returnValue, succeed,
+)
+from twisted.internet.task import deferLater
+from twisted.internet.threads import deferToThreadPool
+from twisted.internet.utils import getProcessOutputAndValue
+from zope.interface import implementer
+
+from flocker.node.agents.blockdevice import (
+    AlreadyAttachedVolume, UnknownVolume, UnattachedVolume,
+    IBlockDeviceAsyncAPI,
+)
+from flocker.node.agents.loopback import (
+    _blockdevicevolume_from_dataset_id,
+    _blockdevicevolume_from_blockdevice_id,
+)
+
+from ._devices import hlu_bus_paths
+from ._driver import _EMCVnxBlockDeviceAPIBase
+from ._emc_vnx_client import CLI_PATH, EMCVNXClient
+from ._records import LUN
+
+
+class AsyncEMCVNXClient(object):
+    """
+    Run ``naviseccli`` commands as reactor child processes.
+
+    Commands are built and their output parsed by an ``EMCVNXClient``, so
+    both clients speak to the array in exactly the same way.
+
+    :param workers: The most ``naviseccli`` processes to run at once, or
+        ``None`` for no limit.
+    """
+    def __init__(self, reactor, ip, key_path, output_format='text',
+                 workers=None, naviseccli_path=CLI_PATH, debug=False):
+        self._reactor = reactor
+        self._commands = EMCVNXClient(
+            ip, key_path, output_format=output_format,
+            naviseccli_path=naviseccli_path, debug=debug,
+        )
+        self._semaphore = None
+        if workers is not None:
+            self._semaphore = DeferredSemaphore(workers)
+
+    def _execute(self, cmd):
+        if self._semaphore is None:
+            return self._spawn(cmd)
+        return self._semaphore.run(self._spawn, cmd)
+
+    def _spawn(self, cmd):
+        d = getProcessOutputAndValue(
+            cmd[0], cmd[1:], env=os.environ, reactor=self._reactor
+        )
+        d.addCallback(lambda (out, err, rc): (rc, out, err))
+        return d
+
+    def _execute_cli(self, cmd):
+        d = self._execute(self._commands.cli + cmd)
+        d.addCallback(lambda (rc, out, err): (rc, out))
+        return d
+
+    def get_lun_by_name(self, name, properties=None):
+        if properties is None:
+            properties = EMCVNXClient.LUN_ALL
+        d = self._execute(
+            self._commands._list_command('lun', ('-name', name), properties)
+        )
+
+        def parse((rc, out, err)):
+            if rc != 0:
+                return None
+            return self._commands.output.parse_one(
+                properties, EMCVNXClient.LUN_ID, out.splitlines(True), LUN
+            )
+        return d.addCallback(parse)
+
+    def get_inventory(self, properties=None):
+        """
+        See ``EMCVNXClient.get_inventory``.  Both queries always run
+        concurrently.
+        """
+        if properties is None:
+            properties = EMCVNXClient.LUN_ALL
+        luns = self._execute(
+            self._commands._list_command('lun', (), properties)
+        )
+
+        def parse_luns((rc, out, err)):
+            if rc != 0:
+                return []
+            return list(
+                self._commands.output.records(
+                    properties, EMCVNXClient.LUN_ID, out.splitlines(True),
+                    LUN
+                )
+            )
+        luns.addCallback(parse_luns)
+        return gatherResults([luns, self.storage_groups()], consumeErrors=True)
+
+    def storage_groups(self):
+        d = self._execute(self._commands._storage_groups_command())
+        return d.addCallback(self._commands._parse_storage_groups)
+
+    def get_storage_group(self, name):
+        return self._execute_cli(
+            ('storagegroup', '-list', '-gname', name,
+             '-host', '-iscsiAttributes')
+        )
+
+    def parse_sg_content(self, content):
+        return self._commands.parse_sg_content(content)
+
+    def create_volume(self, name, size, pool):
+        return self._execute_cli(
+            ('lun', '-create', '-capacity', size, '-sq', 'gb',
+             '-poolName', pool, '-name', name)
+        )
+
+    def destroy_volume(self, name):
+        return self._execute_cli(
+            ('lun', '-destroy', '-name', name, '-forceDetach', '-o')
+        )
+
+    def add_volume_to_sg(self, hlu, alu, sg_name):
+        return self._execute_cli(
+            ('storagegroup', '-addhlu', '-hlu', hlu,
+             '-alu', alu, '-gname', sg_name, '-o')
+        )
+
+    def remove_volume_from_sg(self, hlu, sg_name):
+        return self._execute_cli(
+            ('storagegroup', '-removehlu', '-hlu', hlu,
+             '-gname', sg_name, '-o')
+        )
+
+
+@implementer(IBlockDeviceAsyncAPI)
+class AsyncEMCVnxBlockDeviceAPI(_EMCVnxBlockDeviceAPIBase):
+    """
+    An ``IBlockDeviceAsyncAPI`` for VNX which never blocks the reactor, so
+    that many volumes can be created, attached and destroyed concurrently.
+
+    The options are those of ``EMCVnxBlockDeviceAPI`` which don't need its
+    background threads, except that ``naviseccli_workers`` defaults to no
+    limit.
+    """
+    def __init__(self, reactor, cluster_id, spa_ip, storage_pool, hostname,
+                 storage_group, naviseccli_keys, naviseccli_workers=None,
+                 naviseccli_output_format='text', multipath=False,
+                 naviseccli_path=CLI_PATH, naviseccli_debug=False,
+                 hlu_reservation_directory=None):
+        _EMCVnxBlockDeviceAPIBase.__init__(
+            self, cluster_id, storage_pool, hostname, storage_group,
+            hlu_reservation_directory,
+        )
+        self._reactor = reactor
+        self._clock = reactor.seconds
+        self._multipath = multipath
+        self._client = AsyncEMCVNXClient(
+            reactor, spa_ip, naviseccli_keys,
+            output_format=naviseccli_output_format,
+            workers=naviseccli_workers, naviseccli_path=naviseccli_path,
+            debug=naviseccli_debug,
+        )
+
+    def _in_thread(self, f, *args, **kwargs):
+        return deferToThreadPool(
+            self._reactor, self._reactor.getThreadPool(), f, *args, **kwargs
+        )
+
+    def _find_local_device(self, lun, hlu):
+        """
+        Find the bus paths of ``hlu`` and the device ``lun`` appears as on
+        this node.  This reads sysfs and ``/dev``, so it runs in the thread
+        pool.
+
+        :returns: A tuple of the bus paths and the device ``FilePath``, or
+            ``None``.
+        """
+        bus_paths = hlu_bus_paths(hlu, self._sysfs)
+        return bus_paths, self._local_device(lun, bus_paths)
+
+    def allocation_unit(self):
+        return succeed(
+            _EMCVnxBlockDeviceAPIBase.allocation_unit(self)
+        )
+
+    def compute_instance_id(self):
+        return succeed(
+            _EMCVnxBlockDeviceAPIBase.compute_instance_id(self)
+        )
+
+    @inlineCallbacks
+    def create_volume(self, dataset_id, size):
+        Message.new(operation=u'create_volume',
+                    dataset_id=str(dataset_id),
+                    size=size).write()
+        volume = _blockdevicevolume_from_dataset_id(
+            size=size, dataset_id=dataset_id
+        )
+        lun_name = self._get_lun_name_from_blockdevice_id(
+            volume.blockdevice_id
+        )
+        rc, out = yield self._client.create_volume(
+            lun_name,
+            str(self._convert_volume_size(size)),
+            self._pool
+        )
+        Message.new(operation=u'create_volume_output',
+                    dataset_id=str(dataset_id),
+                    size=size,
+                    lun_name=lun_name,
+                    rc=rc,
+                    out=out).write()
+        if rc != 0:
+            raise Exception(rc, out)
+        returnValue(volume)
+
+    @inlineCallbacks
+    def destroy_volume(self, blockdevice_id):
+        Message.new(operation=u'destroy_volume',
+                    blockdevice_id=blockdevice_id).write()
+        lun_name = self._get_lun_name_from_blockdevice_id(blockdevice_id)
+        self._forget_device(blockdevice_id)
+        max_retries = 3
+        retry_attempt = 0
+        while True:
+            rc, out = yield self._client.destroy_volume(lun_name)
+            Message.new(operation=u'destroy_volume_output',
+                        retry_attempt=retry_attempt,
+                        blockdevice_id=blockdevice_id,
+                        lun_name=lun_name,
+                        rc=rc,
+                        out=out).write()
+            if rc == 0:
+                return
+            if rc == 9:
+                raise UnknownVolume(blockdevice_id)
+            if rc != 8 or retry_attempt == max_retries:
+                raise Exception(rc, out)
+            # The LUN is busy.  Try again shortly without blocking anything
+            # else.
+            retry_attempt += 1
+            yield deferLater(self._reactor, 1, lambda: None)
+
+    @inlineCallbacks
+    def _lookup_hlu(self, blockdevice_id):
+        """
+        :returns: A ``Deferred`` firing with the LUN record and the
+            ``lunmap`` of this node's storage group.
+        """
+        lun_name = self._get_lun_name_from_blockdevice_id(blockdevice_id)
+        lun = yield self._client.get_lun_by_name(
+            lun_name, EMCVNXClient.LUN_ATTACHMENT
+        )
+        if lun is None:
+            raise UnknownVolume(blockdevice_id)
+        rc, out = yield self._client.get_storage_group(self._group)
+        if rc != 0:
+            raise Exception(rc, out)
+        returnValue((lun, self._client.parse_sg_content(out).lunmap))
+
+    @inlineCallbacks
+    def _add_to_storage_group(self, blockdevice_id, alu, lunmap):
+        """
+        As ``EMCVnxBlockDeviceAPI._add_to_storage_group``.
+        """
+        for attempt in range(self._hlu_attempts):
+            hlu = self._hlus.reserve(lunmap)
+            rc, out = yield self._client.add_volume_to_sg(
+                str(hlu), str(alu), self._group
+            )
+            if rc == 0:
+                returnValue(hlu)
+            self._hlus.release(hlu)
+            if rc != 66:
+                raise Exception(rc, out)
+            rc, out = yield self._client.get_storage_group(self._group)
+            if rc != 0:
+                raise Exception(rc, out)
+            lunmap = self._client.parse_sg_content(out).lunmap
+            if alu in lunmap:
+                raise AlreadyAttachedVolume(blockdevice_id)
+            Message.new(operation=u'hlu_conflict',
+                        blockdevice_id=blockdevice_id,
+                        alu=alu,
+                        hlu=hlu,
+                        attempt=attempt).write()
+        storage_groups = yield self._client.storage_groups()
+        raise self._conflict_error(blockdevice_id, alu, hlu, storage_groups)
+
+    @inlineCallbacks
+    def attach_volume(self, blockdevice_id, attach_to):
+        Message.new(operation=u'attach_volume',
+                    blockdevice_id=blockdevice_id,
+                    attach_to=attach_to).write()
+        lun, lunmap = yield self._lookup_hlu(blockdevice_id)
+        alu = lun.lun_id
+        try:
+            hlu = lunmap[alu]
+        except KeyError:
+            hlu = yield self._add_to_storage_group(
+                blockdevice_id, alu, lunmap
+            )
+
+        volume = _blockdevicevolume_from_blockdevice_id(
+            blockdevice_id=blockdevice_id,
+            size=int(lun.total_capacity_gb*1024*1024*1024),
+            attached_to=unicode(attach_to)
+        )
+
+        bus_paths, device = yield self._in_thread(
+            self._find_local_device, lun, hlu
+        )
+        if device is not None:
+            self._remember_device(
+                blockdevice_id, lun, hlu, bus_paths[0], device
+            )
+            raise AlreadyAttachedVolume(blockdevice_id)
+
+        # Scanning and waiting block, so they run in the thread pool.
+        failures = {}
+        devices = yield self._in_thread(
+            self._wait_for_devices, {blockdevice_id: (lun, hlu, bus_paths)},
+            failures, self._metrics.timings('flocker_vnx_attach_phase_seconds')
+        )
+        if blockdevice_id in failures:
+            raise failures[blockdevice_id]
+        new_device = devices[blockdevice_id]
+        self._remember_device(
+            blockdevice_id, lun, hlu, bus_paths[0], new_device
+        )
+        Message.new(
+            operation=u'attach_volume_output',
+            blockdevice_id=blockdevice_id,
+            attach_to=attach_to,
+            alu=alu,
+            hlu=hlu,
+            device_path=repr(new_device)
+        ).write()
+        returnValue(volume)
+
+    @inlineCallbacks
+    def detach_volume(self, blockdevice_id):
+        Message.new(operation=u'detach_volume',
+                    blockdevice_id=blockdevice_id).write()
+        self._forget_device(blockdevice_id)
+        lun, lunmap = yield self._lookup_hlu(blockdevice_id)
+        alu = lun.lun_id
+        try:
+            hlu = lunmap[alu]
+        except KeyError:
+            raise UnattachedVolume(blockdevice_id)
+
+        # Each delete blocks until the kernel has removed the device.
+        yield self._in_thread(self._delete_local_devices, hlu)
+
+        rc, out = yield self._client.remove_volume_from_sg(
+            str(hlu), self._group
+        )
+        if rc != 0:
+            raise Exception(rc, out)
+        Message.new(
+            operation=u'detach_volume_output',
+            blockdevice_id=blockdevice_id,
+            alu=alu,
+            hlu=hlu,
+            rc=rc,
+            out=out,
+        ).write()
+
+    def list_volumes(self):
+        d = self._client.get_inventory(EMCVNXClient.LUN_INVENTORY)
+        d.addCallback(
+            lambda (luns, storage_groups): self._volumes_from_inventory(
+                luns, storage_groups
+            )
+        )
+        return d
+
+    @inlineCallbacks
+    def get_device_path(self, blockdevice_id):
+        Message.new(operation=u'get_device_path',
+                    blockdevice_id=blockdevice_id).write()
+        device_path = yield self._in_thread(
+            self._known_device_path, blockdevice_id
+        )
+        cached = device_path is not None
+        if not cached:
+            lun, lunmap = yield self._lookup_hlu(blockdevice_id)
+            try:
+                hlu = lunmap[lun.lun_id]
+            except KeyError:
+                raise UnattachedVolume(blockdevice_id)
+            bus_paths, device_path = yield self._in_thread(
+                self._find_local_device, lun, hlu
+            )
+            if device_path is None:
+                raise UnattachedVolume(blockdevice_id)
+            self._remember_device(
+                blockdevice_id, lun, hlu, bus_paths[0], device_path
+            )
+        Message.new(operation=u'get_device_path_output',
+                    blockdevice_id=blockdevice_id,
+                    device_path=device_path.path,
+                    cached=cached).write()
+        returnValue(device_path)
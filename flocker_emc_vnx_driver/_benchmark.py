@@ -0,0 +1,369 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Benchmarks of output parsing, inventory assembly and whole driver calls
+against synthetic arrays of up to fleet scale, with machine-readable results
+which can be compared across commits.
+
+Each array is held by a ``VNXEmulator`` and the driver calls run it as
+``naviseccli``, so the timings include a process per command as they would
+in production.
+"""
+
+import gc
+import json
+import platform
+import resource
+import subprocess
+import sys
+from argparse import ArgumentParser
+from tempfile import mkdtemp
+from timeit import default_timer
+from uuid import uuid4
+
+from twisted.python.filepath import FilePath
+
+from ._devices import SysfsPollingSource
+from ._driver import EMCVnxBlockDeviceAPI
+from ._emc_vnx_client import EMCVNXClient
+from ._emulator import VNXEmulator, make_host_tree
+from ._hlu import LAST_HLU
+from ._parsing import TextOutput
+from ._records import LUN
+
+# ``(LUNs, storage groups)`` of the arrays to benchmark.
+SCALES = {
+    'small': [(100, 1), (1000, 10)],
+    'fleet': [(100, 1), (1000, 10), (10000, 100), (50000, 1000)],
+}
+
+# The storage group of the node being benchmarked.
+NODE = u'node1'
+
+# Leave room in each storage group for the attach benchmark.
+_MAX_MAPPED = LAST_HLU - 55
+
+
+class Fleet(object):
+    """
+    A synthetic array, with ``luns`` LUNs of which a tenth belong to some
+    other cluster, and ``storage_groups`` storage groups among which half of
+    the LUNs are mapped.
+
+    :ivar api: An ``EMCVnxBlockDeviceAPI`` for ``NODE``, running the
+        emulator as ``naviseccli`` and finding devices in a fake host tree.
+    """
+    def __init__(self, root, luns, storage_groups):
+        self.luns = luns
+        self.storage_groups = storage_groups
+        root.makedirs()
+        self.emulator = VNXEmulator(root.child('array.json'))
+        groups = [u'node{}'.format(i) for i in range(1, storage_groups + 1)]
+        self.emulator.create(storage_groups=groups)
+        naviseccli = root.child('naviseccli')
+        self.emulator.write_script(naviseccli)
+        self.api = EMCVnxBlockDeviceAPI(
+            unicode(uuid4()).split('-')[0], '192.0.2.1', 'pool', NODE, NODE,
+            '/keys', naviseccli_path=naviseccli.path,
+            hlu_reservation_directory=root.child('run').path,
+        )
+        names = []
+        for i in range(luns):
+            if i % 10 == 9:
+                names.append('flocker--00000000--block-{}'.format(uuid4()))
+            else:
+                names.append(self.api._get_lun_name_from_blockdevice_id(
+                    u'block-{}'.format(uuid4())
+                ))
+        alus = iter(self.emulator.add_luns(names))
+        per_group = min(luns // (2 * storage_groups), _MAX_MAPPED)
+        self.emulator.add_hlus({
+            group: [(hlu, next(alus)) for hlu in range(1, per_group + 1)]
+            for group in groups
+        })
+        sysfs, dev = make_host_tree(root)
+        self.bridge = self.emulator.bind_host(NODE, sysfs, dev)
+        self.api._sysfs, self.api._dev = sysfs, dev
+        self.api._open_device_events = lambda: SysfsPollingSource(
+            interval=0.01
+        )
+
+    def output(self, *args):
+        rc, out = self.emulator.execute(list(args))
+        return out
+
+
+def _lines(out):
+    return out.splitlines(True)
+
+
+def parse_luns(fleet):
+    lines = _lines(fleet.output('lun', '-list', '-userCap'))
+    output = TextOutput()
+    return lambda: list(output.records(
+        EMCVNXClient.LUN_INVENTORY, EMCVNXClient.LUN_ID, lines, LUN
+    ))
+
+
+def parse_storage_groups(fleet):
+    out = fleet.output('storagegroup', '-list', '-host', '-iscsiAttributes')
+    return lambda: TextOutput().storage_groups(out)
+
+
+def parse_sg_content(fleet):
+    out = fleet.output('storagegroup', '-list', '-gname', NODE)
+    content = out.split('\n', 1)[1]
+    return lambda: fleet.api._client.parse_sg_content(content)
+
+
+def _listing(fleet):
+    output = TextOutput()
+    luns = list(output.records(
+        EMCVNXClient.LUN_INVENTORY, EMCVNXClient.LUN_ID,
+        _lines(fleet.output('lun', '-list', '-userCap')), LUN
+    ))
+    groups = output.storage_groups(fleet.output('storagegroup', '-list'))
+    return luns, groups
+
+
+def volumes_from_inventory(fleet):
+    luns, groups = _listing(fleet)
+
+    def volumes_from_inventory():
+        fleet.api._inventory._reset()
+        fleet.api._volumes_from_inventory(luns, groups)
+    return volumes_from_inventory
+
+
+def volumes_from_unchanged_inventory(fleet):
+    # Alternate between two equal listings, as successive uncached listings
+    # of an idle array would be.
+    listings = [_listing(fleet), _listing(fleet)]
+    fleet.api._volumes_from_inventory(*listings[0])
+
+    def volumes_from_unchanged_inventory():
+        listings.reverse()
+        fleet.api._volumes_from_inventory(*listings[0])
+    return volumes_from_unchanged_inventory
+
+
+def get_all_luns(fleet):
+    return lambda: fleet.api._client.get_all_luns(EMCVNXClient.LUN_INVENTORY)
+
+
+def list_volumes(fleet):
+    return fleet.api.list_volumes
+
+
+def attach_detach(fleet):
+    api = fleet.api
+    volume = api.create_volume(uuid4(), 8 * 1024 ** 3)
+
+    def attach_detach():
+        api.attach_volume(volume.blockdevice_id, NODE)
+        api.detach_volume(volume.blockdevice_id)
+    return attach_detach
+
+
+# name -> a callable which sets up the benchmark on a ``Fleet`` and returns
+# the callable to time.
+CASES = [
+    ('parse_luns', parse_luns),
+    ('parse_storage_groups', parse_storage_groups),
+    ('parse_sg_content', parse_sg_content),
+    ('volumes_from_inventory', volumes_from_inventory),
+    ('volumes_from_unchanged_inventory', volumes_from_unchanged_inventory),
+    ('get_all_luns', get_all_luns),
+    ('list_volumes', list_volumes),
+    ('attach_detach', attach_detach),
+]
+
+
+def _status_kb(field):
+    """
+    :returns: A field of ``/proc/self/status``, in kB, or ``None``.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    """
+    Reset the high-water mark of this process's resident set, if the kernel
+    allows it.
+
+    :returns: Whether it was reset.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        return False
+    return True
+
+
+def measure(function, repeats):
+    """
+    Time ``repeats`` calls of ``function`` and track the memory they use.
+
+    :returns: A ``dict`` of the ``seconds`` taken by each call, the peak
+        resident set of the process in kB and, where the high-water mark can
+        be reset, how far the calls raised it above the resident set before
+        they started.
+    """
+    gc.collect()
+    reset = _reset_peak_rss()
+    before = _status_kb('VmRSS')
+    seconds = []
+    for _ in range(repeats):
+        start = default_timer()
+        function()
+        seconds.append(default_timer() - start)
+    peak = _status_kb('VmHWM') if reset else None
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    growth = None
+    if reset and before is not None:
+        growth = max(0, peak - before)
+    seconds.sort()
+    return {
+        'seconds': seconds,
+        'min': seconds[0],
+        'median': seconds[len(seconds) // 2],
+        'peak_rss_kb': peak,
+        'rss_growth_kb': growth,
+    }
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+            cwd=FilePath(__file__).parent().path,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(root, scales, cases, repeats):
+    """
+    Run each of ``cases`` on an array of each of ``scales``.
+
+    :param FilePath root: A directory for the arrays and host trees.
+    :returns: A ``list`` of result ``dict`` instances.
+    """
+    results = []
+    for luns, storage_groups in scales:
+        fleet = Fleet(
+            root.child('{}-{}'.format(luns, storage_groups)), luns,
+            storage_groups,
+        )
+        fleet.bridge.start()
+        try:
+            for name, setup in cases:
+                result = measure(setup(fleet), repeats)
+                result.update({
+                    'case': name, 'luns': luns,
+                    'storage_groups': storage_groups,
+                })
+                results.append(result)
+        finally:
+            fleet.bridge.stop()
+    return results
+
+
+def _key(result):
+    return (result['case'], result['luns'], result['storage_groups'])
+
+
+def render(results, baseline=None):
+    """
+    :param baseline: Earlier results to compare with, or ``None``.
+    :returns: A table of ``results``, as text.
+    """
+    previous = {_key(result): result for result in baseline or ()}
+    lines = [u'{:<32} {:>7} {:>6} {:>10} {:>10} {:>10} {:>8}'.format(
+        u'case', u'luns', u'groups', u'min', u'median', u'rss kB', u'ratio'
+    )]
+    for result in results:
+        ratio = u''
+        old = previous.get(_key(result))
+        if old is not None and old['min'] > 0:
+            ratio = u'{:.2f}'.format(result['min'] / old['min'])
+        lines.append(
+            u'{:<32} {:>7} {:>6} {:>10.4f} {:>10.4f} {:>10} {:>8}'.format(
+                result['case'], result['luns'], result['storage_groups'],
+                result['min'], result['median'],
+                result['rss_growth_kb'] if result['rss_growth_kb']
+                is not None else result['peak_rss_kb'],
+                ratio,
+            )
+        )
+    return u''.join(line + u'\n' for line in lines)
+
+
+def main(argv=None, stdout=sys.stdout):
+    parser = ArgumentParser(
+        description=u'Benchmark the VNX driver against emulated arrays of '
+                    u'up to 50,000 LUNs and 1,000 storage groups.'
+    )
+    parser.add_argument(
+        u'--scale', choices=sorted(SCALES), default=u'small',
+        help=u'The sizes of array to benchmark.'
+    )
+    parser.add_argument(
+        u'--case', action=u'append', choices=[name for name, _ in CASES],
+        help=u'A benchmark to run.  May be repeated.  All run by default.'
+    )
+    parser.add_argument(u'--repeats', type=int, default=3)
+    parser.add_argument(
+        u'--output',
+        help=u'Write the results as JSON to this file and print a table.  '
+             u'The JSON is printed if this isn\'t given.'
+    )
+    parser.add_argument(
+        u'--compare',
+        help=u'A file of earlier results to compare the table with.'
+    )
+    parser.add_argument(
+        u'--directory', default=None,
+        help=u'Where to keep the emulated arrays.  A temporary directory is '
+             u'used by default.'
+    )
+    options = parser.parse_args(argv)
+    cases = [
+        (name, setup) for name, setup in CASES
+        if options.case is None or name in options.case
+    ]
+    if options.directory is None:
+        root = FilePath(mkdtemp())
+    else:
+        root = FilePath(options.directory)
+    try:
+        results = run(root, SCALES[options.scale], cases, options.repeats)
+    finally:
+        if options.directory is None and root.exists():
+            root.remove()
+    document = {
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'repeats': options.repeats,
+        'results': results,
+    }
+    if options.output is None:
+        json.dump(document, stdout, indent=2, sort_keys=True)
+        stdout.write('\n')
+        return
+    with open(options.output, 'w') as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+    baseline = None
+    if options.compare is not None:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+    stdout.write(render(results, baseline).encode('utf-8'))
@@ -0,0 +1,93 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+A small in-memory cache for array inventory queries.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache(object):
+    """
+    A thread-safe mapping whose entries expire ``ttl`` seconds after they
+    were stored and which evicts the least recently used entry once it holds
+    ``max_entries`` entries.
+
+    A ``ttl`` of zero disables the cache: every lookup misses.
+
+    Every invalidation bumps a generation counter.  Callers that read the
+    generation before querying the array and pass it back to ``set`` will
+    not store a result which an invalidation made stale in the meantime.
+    """
+    def __init__(self, ttl=0, max_entries=1024, clock=time.time):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def generation(self):
+        """
+        :returns: An opaque token to be passed to ``set``.
+        """
+        with self._lock:
+            return self._generation
+
+    def get(self, key, default=None):
+        """
+        :returns: The unexpired value stored for ``key`` or ``default``.
+        """
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires <= self._clock():
+                self.misses += 1
+                return default
+            # Re-insert to mark as most recently used.
+            self._entries[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation=None):
+        """
+        Store ``value`` for ``key``.
+
+        :param generation: The result of ``generation()`` taken before
+            ``value`` was fetched, or ``None`` to store unconditionally.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (self._clock() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, predicate):
+        """
+        Discard every entry whose key satisfies ``predicate``.
+        """
+        with self._lock:
+            self._generation += 1
+            for key in [k for k in self._entries if predicate(k)]:
+                del self._entries[key]
+
+    def clear(self):
+        """
+        Discard every entry.
+        """
+        self.invalidate(lambda key: True)
@@ -0,0 +1,432 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Discovery of the local block devices which VNX LUNs appear as.
+"""
+
+import errno
+import os
+import select
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from twisted.python.constants import Names, NamedConstant
+from twisted.python.filepath import FilePath, UnlistableError
+from zope.interface import Interface, implementer
+
+SYSFS = FilePath('/sys')
+DEV = FilePath('/dev')
+
+# From linux/netlink.h
+NETLINK_KOBJECT_UEVENT = 15
+
+# The uevent subsystems which announce new SCSI disks and changes in their
+# capacity.
+_DEVICE_SUBSYSTEMS = frozenset([
+    'block', 'scsi', 'scsi_device', 'scsi_disk',
+])
+
+
+class Timeout(Exception):
+    """
+    """
+
+
+def fc_hosts(sysfs=SYSFS):
+    return sorted(
+        int(f.basename()[len('host'):])
+        for f
+        in sysfs.descendant(['class', 'fc_host']).children()
+    )
+
+
+def hlu_bus_paths(hlu, sysfs=SYSFS):
+    return sorted(
+        sysfs.descendant(
+            ['class', 'scsi_disk', '{}:0:0:{}'.format(fc_host, hlu)]
+        )
+        for fc_host in fc_hosts(sysfs)
+    )
+
+
+def device_paths_for_hlu_bus_path(hlu_bus_path, dev=DEV):
+    return sorted(
+        dev.child(
+            device_name_pointer.basename()
+        )
+        for device_name_pointer
+        in hlu_bus_path.descendant(
+            ['device', 'block']
+        ).children()
+    )
+
+
+def scan_hlus(hlus, sysfs=SYSFS, channel=0, target=0, clock=time.time):
+    """
+    Ask every FC host to probe for each LUN in ``hlus`` in turn, by writing a
+    ``channel target lun`` triplet to its ``scan`` attribute.
+
+    Each write returns when the kernel has finished that host's scan, so the
+    hosts are scanned concurrently.
+
+    :returns: A ``dict`` mapping each FC host number to the number of
+        seconds all of its scans took.
+    """
+    latencies = {}
+    failures = []
+
+    def scan(host):
+        start = clock()
+        try:
+            scan_file = sysfs.descendant(
+                ['class', 'scsi_host', 'host{}'.format(host), 'scan']
+            )
+            for hlu in hlus:
+                with scan_file.open('w') as f:
+                    f.write('{} {} {}\n'.format(channel, target, hlu))
+        except:
+            failures.append(sys.exc_info())
+        latencies[host] = clock() - start
+
+    hosts = fc_hosts(sysfs)
+    threads = [
+        threading.Thread(target=scan, args=(host,)) for host in hosts[1:]
+    ]
+    for thread in threads:
+        thread.start()
+    # Scan the first host in this thread, to save starting a thread in the
+    # common single HBA case.
+    for host in hosts[:1]:
+        scan(host)
+    for thread in threads:
+        thread.join()
+    if failures:
+        raise failures[0][0], failures[0][1], failures[0][2]
+    return latencies
+
+
+def scsi_devices_for_hlu(hlu, sysfs=SYSFS):
+    """
+    :returns: The ``/sys/bus/scsi/drivers/sd`` entries of every SCSI device
+        with LUN number ``hlu``.
+    """
+    alu_suffix = ':{}'.format(hlu)
+    drivers = sysfs.descendant(['bus', 'scsi', 'drivers', 'sd'])
+    return [
+        child
+        for child in drivers.children()
+        if child.basename().endswith(alu_suffix)
+    ]
+
+
+def directory_listable(directory):
+    try:
+        directory.children()
+    except UnlistableError:
+        return False
+    return True
+
+
+class IDeviceEventSource(Interface):
+    """
+    A source of notifications that block devices may have changed.
+    """
+    def wait(timeout):
+        """
+        Block until there may have been a change, or ``timeout`` seconds have
+        passed.
+
+        :returns: ``True`` if there may have been a change, else ``False``.
+        """
+
+    def close():
+        """
+        Release any resources held by the source.
+        """
+
+
+@implementer(IDeviceEventSource)
+class UeventSource(object):
+    """
+    Listen for kernel uevents on a netlink socket and wake up for those from
+    the block and SCSI subsystems.
+
+    Events are queued by the kernel from the moment the source is created,
+    so one created before a LUN is mapped cannot miss its arrival.
+    """
+    def __init__(self):
+        self._socket = socket.socket(
+            socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT
+        )
+        try:
+            # Let the kernel choose the port id and join the kernel event
+            # multicast group.
+            self._socket.bind((0, 1))
+        except:
+            self._socket.close()
+            raise
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self._socket], [], [], timeout)
+        if not readable:
+            return False
+        relevant = False
+        while True:
+            try:
+                message = self._socket.recv(65536, socket.MSG_DONTWAIT)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return relevant
+                raise
+            relevant = relevant or _is_device_event(message)
+
+    def close(self):
+        self._socket.close()
+
+
+def _is_device_event(message):
+    """
+    :param bytes message: A kernel uevent; a summary line followed by
+        ``KEY=value`` fields, all NUL separated.
+    """
+    for field in message.split('\0'):
+        if field.startswith('SUBSYSTEM='):
+            return field[len('SUBSYSTEM='):] in _DEVICE_SUBSYSTEMS
+    return False
+
+
+@implementer(IDeviceEventSource)
+class SysfsPollingSource(object):
+    """
+    Report a possible change every ``interval`` seconds, for systems where
+    uevents are unavailable.
+    """
+    def __init__(self, interval=0.1, sleep=time.sleep):
+        self.interval = interval
+        self._sleep = sleep
+
+    def wait(self, timeout):
+        self._sleep(min(self.interval, timeout))
+        return True
+
+    def close(self):
+        pass
+
+
+def open_device_event_source():
+    """
+    :returns: A ``UeventSource`` if this process may listen for uevents,
+        otherwise a ``SysfsPollingSource``.
+    """
+    try:
+        return UeventSource()
+    except (socket.error, AttributeError):
+        # AttributeError: no AF_NETLINK on this platform.
+        return SysfsPollingSource()
+
+
+class DeviceState(Names):
+    """
+    How ready a block device is for use.
+    """
+    ABSENT = NamedConstant()
+    ZERO_CAPACITY = NamedConstant()
+    READY = NamedConstant()
+
+
+def _device_size(device_path, sysfs):
+    """
+    :returns: The size of the block device at ``device_path``, in sysfs
+        sectors or bytes, or ``None`` if it can't be determined.
+    """
+    size_path = sysfs.descendant(['block', device_path.basename(), 'size'])
+    try:
+        return int(size_path.getContent().strip())
+    except (IOError, OSError, ValueError):
+        pass
+    # No sysfs entry; ask the device node itself.
+    try:
+        fd = os.open(device_path.path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+
+def probe_block_device(device_path, sysfs=SYSFS):
+    """
+    Decide whether the block device at ``device_path`` is ready, without
+    running any other process.
+
+    :returns: A ``DeviceState``.
+    """
+    if not device_path.exists():
+        return DeviceState.ABSENT
+    size = _device_size(device_path, sysfs)
+    if size is None:
+        return DeviceState.ABSENT
+    if size == 0:
+        return DeviceState.ZERO_CAPACITY
+    return DeviceState.READY
+
+
+def wait_for_devices(events, finders, timeout, clock=time.time):
+    """
+    Wait for several devices at once, checking again for those not yet
+    found whenever ``events`` reports a possible change.
+
+    :param IDeviceEventSource events: Opened before the devices could have
+        appeared.
+    :param dict finders: Maps a key for each device to a callable which
+        returns the ``FilePath`` of the device if it is ready, else
+        ``None``.
+    :returns: A ``dict`` mapping the key of each device which was found to
+        its ``FilePath``.  This includes every key unless ``timeout``
+        seconds passed first.
+    """
+    deadline = clock() + timeout
+    found = {}
+    while True:
+        for key, find in finders.items():
+            if key in found:
+                continue
+            device = find()
+            if device is not None:
+                found[key] = device
+        if len(found) == len(finders):
+            return found
+        remaining = deadline - clock()
+        if remaining <= 0:
+            return found
+        events.wait(remaining)
+
+
+def _device_wwid(device_name, sysfs):
+    """
+    :returns: The World Wide Identifier the kernel reports for
+        ``device_name``, lower case and without its ``naa.`` style prefix, or
+        ``None`` if it doesn't report one.
+    """
+    wwid_path = sysfs.descendant(['block', device_name, 'device', 'wwid'])
+    try:
+        wwid = wwid_path.getContent().strip().lower()
+    except (IOError, OSError):
+        return None
+    return wwid.split('.', 1)[-1]
+
+
+def device_still_attached(device_path, hlu_bus_path, lun_uid, sysfs=SYSFS):
+    """
+    Check, using only sysfs, that ``device_path`` is still a ready device
+    for the LUN which was found at ``hlu_bus_path``.
+
+    A multipath device is checked through the SCSI disks it is made of,
+    rather than through ``hlu_bus_path``.
+
+    :param lun_uid: The UID of the LUN, as parsed by
+        ``EMCVNXClient.LUN_UID``, or ``None`` to skip the identity check.
+    :returns: ``True`` if the device can be used without asking the array.
+    """
+    name = device_path.basename()
+    slaves = sysfs.descendant(['block', name, 'slaves'])
+    if slaves.isdir():
+        names = [slave.basename() for slave in slaves.children()]
+        if not names:
+            return False
+    else:
+        if not hlu_bus_path.descendant(['device', 'block', name]).exists():
+            return False
+        names = [name]
+    if probe_block_device(device_path, sysfs) is not DeviceState.READY:
+        return False
+    if lun_uid is not None:
+        for name in names:
+            wwid = _device_wwid(name, sysfs)
+            # Older kernels have no wwid attribute; the bus path check above
+            # will have to do.
+            if wwid is not None and wwid != lun_uid:
+                return False
+    return True
+
+
+def path_devices(hlu_bus_paths, lun_uid, sysfs=SYSFS, dev=DEV):
+    """
+    Find the ready SCSI disks for one LUN across several FC paths.
+
+    :param list hlu_bus_paths: One ``/sys/class/scsi_disk`` entry per path.
+    :param lun_uid: Devices whose wwid is something other than this are
+        ignored.
+    :returns: A ``list`` of device ``FilePath`` objects, at most one per
+        path.
+    """
+    devices = []
+    for hlu_bus_path in hlu_bus_paths:
+        try:
+            candidates = device_paths_for_hlu_bus_path(hlu_bus_path, dev)
+        except UnlistableError:
+            continue
+        for device in candidates:
+            if probe_block_device(device, sysfs) is not DeviceState.READY:
+                continue
+            wwid = _device_wwid(device.basename(), sysfs)
+            if wwid is not None and wwid != lun_uid:
+                continue
+            devices.append(device)
+            break
+    return devices
+
+
+def multipath_device(devices, sysfs=SYSFS, dev=DEV):
+    """
+    :param list devices: Paths to the same LUN, as found by
+        ``path_devices``.
+    :returns: The ``FilePath`` of the device-mapper device which holds every
+        one of ``devices``, or ``None`` if there isn't one yet.
+    """
+    common = None
+    for device in devices:
+        holders = sysfs.descendant(['block', device.basename(), 'holders'])
+        try:
+            names = set(
+                holder.basename() for holder in holders.children()
+                if holder.basename().startswith('dm-')
+            )
+        except UnlistableError:
+            return None
+        common = names if common is None else common & names
+    if not common:
+        return None
+    return dev.child(sorted(common)[0])
+
+
+def flush_multipath_device(dm_device, sysfs=SYSFS):
+    """
+    Ask ``multipath`` to remove the map behind ``dm_device``.
+    """
+    name = sysfs.descendant(
+        ['block', dm_device.basename(), 'dm', 'name']
+    ).getContent().strip()
+    subprocess.check_call(['multipath', '-f', name])
+
+
+def ready_multipath_device(hlu_bus_paths, lun_uid, sysfs=SYSFS, dev=DEV):
+    """
+    :returns: The ``FilePath`` of the ready multipath device combining the
+        LUN's disk on every one of ``hlu_bus_paths``, or ``None`` if the LUN
+        is missing from any path or ``multipathd`` hasn't yet assembled it.
+    """
+    devices = path_devices(hlu_bus_paths, lun_uid, sysfs, dev)
+    if not devices or len(devices) != len(hlu_bus_paths):
+        return None
+    device = multipath_device(devices, sysfs, dev)
+    if (device is None or
+            probe_block_device(device, sysfs) is not DeviceState.READY):
+        return None
+    return device
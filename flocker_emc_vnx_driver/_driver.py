@@ -1,13 +1,13 @@
 # Copyright ClusterHQ Inc.  See LICENSE file for details.
 
-import os
 import re
-from subprocess import check_output, CalledProcessError
 import time
-import random
+from collections import OrderedDict
+from functools import partial
+from itertools import chain
 
-from eliot import Message
-from pyrsistent import pmap
+from eliot import Message, start_action
+from pyrsistent import PClass, field, pmap
 from twisted.python.filepath import FilePath, UnlistableError
 from zope.interface import implementer
 
@@ -21,90 +21,347 @@ from flocker.node.agents.loopback import (
     _blockdevicevolume_from_blockdevice_id,
 )
 
-from ._emc_vnx_client import EMCVNXClient
+from ._cache import TTLCache
+from ._devices import (
+    DEV, SYSFS, DeviceState, Timeout, device_paths_for_hlu_bus_path,
+    device_still_attached, directory_listable, flush_multipath_device,
+    hlu_bus_paths, multipath_device, open_device_event_source, path_devices,
+    probe_block_device, ready_multipath_device, scan_hlus,
+    scsi_devices_for_hlu, wait_for_devices,
+)
+from ._emc_vnx_client import CLI_PATH, EMCVNXClient
+from ._hlu import (
+    RESERVATION_DIRECTORY, HLUAllocator, HLUConflict, HLUsExhausted,
+)
+from ._inventory import Inventory
+from ._executor import PooledExecutor, SerialExecutor
+from ._metrics import COUNTER, GAUGE, Metrics, MetricsExporter
+from ._reaper import Reaper
+from ._scheduler import ScheduledExecutor, TokenBucket, token_bucket_path
+from ._snapshot import SnapshotReader, SnapshotWriter, snapshot_path
+from ._warm_pool import WarmPool
 
 LUN_NAME_PREFIX = 'flocker'
 UNKNOWN_COMPUTE_ID = u'unknown-compute-id'
 
 
-class Timeout(Exception):
+class BulkOperationFailed(Exception):
     """
+    Some of the volumes in a bulk attach or detach failed.
+
+    :ivar dict failures: Maps the blockdevice_id of each volume which failed
+        to the exception which the single volume operation would have
+        raised.
+    :ivar results: What the bulk operation would have returned, for the
+        volumes which succeeded.
     """
+    def __init__(self, failures, results):
+        Exception.__init__(self, failures, results)
+        self.failures = failures
+        self.results = results
 
 
-def wait_for(predicate, timeout):
-    start_time = time.time()
-    while True:
-        result = predicate()
-        if result:
-            return result
-        elapsed_time = time.time() - start_time
-        if elapsed_time > timeout:
-            raise Timeout(predicate)
-        else:
-            time.sleep(1)
+def _only(bulk_operation, blockdevice_id, *args):
+    """
+    Run ``bulk_operation`` for one volume, raising its failure directly.
+    """
+    try:
+        results = bulk_operation([blockdevice_id], *args)
+    except BulkOperationFailed as e:
+        raise e.failures[blockdevice_id]
+    if isinstance(results, dict):
+        return results[blockdevice_id]
 
 
-def _fc_hosts():
-    return sorted(
-        int(f.basename()[len('host'):])
-        for f
-        in FilePath('/sys/class/fc_host').children()
-    )
+class _AttachedDevice(PClass):
+    """
+    Where a LUN attached to this node was last found.
 
+    :ivar int alu: The array's number for the LUN.
+    :ivar int hlu: The number of the LUN in this node's storage group.
+    :ivar FilePath hlu_bus_path: The ``/sys/class/scsi_disk`` entry which
+        the device appeared under.
+    :ivar FilePath device_path: The block device, which is a device-mapper
+        device in multipath mode.
+    :ivar lun_uid: The UID of the LUN, or ``None`` if it isn't known.
+    """
+    alu = field(type=int, mandatory=True)
+    hlu = field(type=int, mandatory=True)
+    hlu_bus_path = field(type=FilePath, mandatory=True)
+    device_path = field(type=FilePath, mandatory=True)
+    lun_uid = field(mandatory=True)
 
-def _hlu_bus_paths(hlu):
-    return sorted(
-        FilePath(
-            '/sys/class/scsi_disk/{}:0:0:{}'.format(fc_host, hlu)
-        )
-        for fc_host in _fc_hosts()
-    )
 
+class _EMCVnxBlockDeviceAPIBase(object):
+    """
+    The parts of the VNX block device API which don't talk to the array or
+    the operating system, shared by the synchronous and asynchronous APIs.
+    """
+    VERSION = '0.1'
+    driver_name = 'VNX'
 
-def _device_paths_for_hlu_bus_path(hlu_bus_path):
-    return sorted(
-        FilePath('/dev').child(
-            device_name_pointer.basename()
+    def __init__(self, cluster_id, storage_pool, hostname, storage_group,
+                 hlu_reservation_directory=None):
+        self._cluster_id = cluster_id
+        self._pool = storage_pool
+        self._hostname = unicode(hostname)
+        self._group = unicode(storage_group)
+        self._sysfs = SYSFS
+        self._dev = DEV
+        # blockdevice_id -> _AttachedDevice
+        self._device_path_map = pmap()
+        self._multipath = False
+        self._open_device_events = open_device_event_source
+        self._clock = time.time
+        if hlu_reservation_directory is None:
+            hlu_reservation_directory = RESERVATION_DIRECTORY
+        else:
+            hlu_reservation_directory = FilePath(hlu_reservation_directory)
+        self._hlus = HLUAllocator(
+            self._group, directory=hlu_reservation_directory
+        )
+        self._metrics = Metrics()
+        self._inventory = Inventory(
+            self._get_blockdevice_id_from_lun_name, self._group,
+            self._hostname, UNKNOWN_COMPUTE_ID,
         )
-        for device_name_pointer
-        in hlu_bus_path.descendant(
-            ['device', 'block']
-        ).children()
-    )
 
+    def _remember_device(self, blockdevice_id, lun, hlu, hlu_bus_path,
+                         device_path):
+        self._device_path_map = self._device_path_map.set(
+            blockdevice_id,
+            _AttachedDevice(
+                alu=lun.lun_id, hlu=hlu, hlu_bus_path=hlu_bus_path,
+                device_path=device_path, lun_uid=lun.lun_uid,
+            )
+        )
 
-def _device_path_is_usable(device_path):
-    try:
-        check_output(['lsblk', device_path.path])
-    except CalledProcessError:
-        return False
-    else:
-        return True
+    def _forget_device(self, blockdevice_id):
+        self._device_path_map = self._device_path_map.discard(blockdevice_id)
 
+    def _known_device_path(self, blockdevice_id):
+        """
+        Look up where ``blockdevice_id`` was last found, checking against
+        sysfs that the device is still there and still the same LUN.
 
-def _directory_listable(directory):
-    try:
-        directory.children()
-    except UnlistableError:
-        return False
-    return True
+        :returns: The device ``FilePath``, or ``None`` if the array must be
+            asked.
+        """
+        attached = self._device_path_map.get(blockdevice_id)
+        if attached is None:
+            return None
+        if device_still_attached(attached.device_path, attached.hlu_bus_path,
+                                 attached.lun_uid, self._sysfs):
+            return attached.device_path
+        self._forget_device(blockdevice_id)
+        return None
 
+    def _local_device(self, lun, bus_paths, all_paths=False):
+        """
+        Find the usable device which ``lun`` appears as on this node, without
+        waiting or scanning.
 
-@implementer(IBlockDeviceAPI)
-class EMCVnxBlockDeviceAPI(object):
+        :param list bus_paths: The ``/sys/class/scsi_disk`` entries for the
+            LUN's HLU, one per FC host.
+        :param bool all_paths: In multipath mode, require the LUN to be
+            present on every FC host.
+        :returns: The device ``FilePath``, or ``None``.
+        """
+        if self._multipath and all_paths:
+            return ready_multipath_device(
+                bus_paths, lun.lun_uid, self._sysfs, self._dev
+            )
+        if self._multipath:
+            devices = path_devices(
+                bus_paths, lun.lun_uid, self._sysfs, self._dev
+            )
+            if not devices:
+                return None
+            device = multipath_device(devices, self._sysfs, self._dev)
+        else:
+            # XXX This will only operate on the first available HLU bus and
+            # on one of the resulting device paths.
+            # /sys/class/scsi_disk/x:x:x:HLU/device/block/sdvb for example.
+            try:
+                device = device_paths_for_hlu_bus_path(
+                    bus_paths[0], self._dev
+                )[0]
+            except (IndexError, UnlistableError):
+                return None
+        if device is None or not self._device_path_is_usable(device):
+            return None
+        return device
 
-    VERSION = '0.1'
-    driver_name = 'VNX'
+    def _probe(self, device_path):
+        with self._metrics.timer('flocker_vnx_device_probe_seconds'):
+            return probe_block_device(device_path, self._sysfs)
 
-    def __init__(self, cluster_id, spa_ip, storage_pool, hostname,
-                 storage_group, naviseccli_keys):
-        self._client = EMCVNXClient(spa_ip, naviseccli_keys)
-        self._cluster_id = cluster_id
-        self._pool = storage_pool
-        self._hostname = unicode(hostname)
-        self._group = unicode(storage_group)
-        self._device_path_map = pmap()
+    def _device_path_is_usable(self, device_path):
+        return self._probe(device_path) is DeviceState.READY
+
+    def _zero_capacity(self, hlu_bus_path):
+        """
+        :returns: ``True`` if a device has appeared under ``hlu_bus_path``
+            but the kernel doesn't yet know its capacity.
+        """
+        return any(
+            self._probe(device) is DeviceState.ZERO_CAPACITY
+            for device in device_paths_for_hlu_bus_path(
+                hlu_bus_path, self._dev
+            )
+        )
+
+    def _wanted_bus_paths(self, bus_paths):
+        if self._multipath:
+            # Every FC host is a separate path to the LUN.
+            return bus_paths
+        # XXX This will only operate on the first available HLU bus
+        return bus_paths[:1]
+
+    def _wait_for_devices(self, pending, failures, timings):
+        """
+        Scan for and wait successively longer for the devices of several
+        LUNs to appear, waking as soon as the kernel reports a change rather
+        than polling.  Sometimes the bus doesn't appear until you rescan
+        repeatedly.
+
+        :param dict pending: Maps blockdevice_id to the LUN record, HLU and
+            bus paths of each LUN.
+        :param dict failures: ``Timeout`` is added to this for each device
+            which doesn't appear.
+        :param Timings timings: Records the time spent scanning, rescanning
+            and waiting.
+        :returns: A ``dict`` mapping blockdevice_id to device ``FilePath``.
+        """
+        start_time = self._clock()
+        devices = {}
+        waiting = dict(pending)
+        if not waiting:
+            return devices
+        # The events are subscribed to before the first scan so that the
+        # arrival of a device cannot be missed.
+        events = self._open_device_events()
+        passes = 0
+        try:
+            counter = 1
+            while waiting:
+                wanted = {
+                    blockdevice_id: self._wanted_bus_paths(bus_paths)
+                    for blockdevice_id, (lun, hlu, bus_paths)
+                    in waiting.items()
+                }
+                unscanned = sorted(set(
+                    hlu
+                    for blockdevice_id, (lun, hlu, bus_paths)
+                    in waiting.items()
+                    if not all(
+                        directory_listable(
+                            bus_path.descendant(['device', 'block'])
+                        )
+                        for bus_path in wanted[blockdevice_id]
+                    )
+                ))
+                if unscanned:
+                    with timings.phase('scan'):
+                        scan_latencies = scan_hlus(unscanned, self._sysfs)
+                    Message.new(
+                        operation=u'scan_hlu',
+                        blockdevice_ids=sorted(waiting),
+                        hlus=unscanned,
+                        latencies={
+                            unicode(host): latency
+                            for host, latency in scan_latencies.items()
+                        },
+                    ).write()
+                elif counter > 1:
+                    with timings.phase('rescan'):
+                        self._rescan_zero_capacity(
+                            chain.from_iterable(wanted.values())
+                        )
+                with timings.phase('wait'):
+                    found = wait_for_devices(
+                        events,
+                        {
+                            blockdevice_id: partial(
+                                self._local_device, lun, bus_paths,
+                                all_paths=True,
+                            )
+                            for blockdevice_id, (lun, hlu, bus_paths)
+                            in waiting.items()
+                        },
+                        timeout=5 * counter,
+                        clock=self._clock,
+                    )
+                for blockdevice_id, device in found.items():
+                    devices[blockdevice_id] = device
+                    del waiting[blockdevice_id]
+                passes += 1
+                if waiting and counter > 5:
+                    elapsed_time = self._clock() - start_time
+                    for blockdevice_id in waiting:
+                        bus_paths = wanted[blockdevice_id]
+                        failures[blockdevice_id] = Timeout(
+                            "Device did not appear. "
+                            "Expected a device under {}. "
+                            "Waited {}s and performed {} scsi bus "
+                            "scans.".format(
+                                ', '.join(
+                                    bus_path.path for bus_path in bus_paths
+                                ),
+                                elapsed_time,
+                                counter,
+                            ),
+                            bus_paths, elapsed_time, counter
+                        )
+                    break
+                counter += 1
+        finally:
+            events.close()
+        Message.new(operation=u'wait_for_devices_output',
+                    blockdevice_ids=sorted(pending),
+                    passes=passes,
+                    timeouts=sorted(waiting),
+                    elapsed=self._clock() - start_time).write()
+        return devices
+
+    def _rescan_zero_capacity(self, bus_paths):
+        """
+        Rescan the devices under ``bus_paths`` whose capacity isn't yet
+        known.
+        """
+        for bus_path in bus_paths:
+            if not self._zero_capacity(bus_path):
+                continue
+            # The bus is available but the device is sometimes initially 0
+            # size until you force a rescan:
+
+            # (echo 1 > /sys/class/scsi_disk/1:0:0:219/device/rescan)
+            # Nov 07 04:55:40 00009bb1a4558a12 kernel: sd 1:0:0:219: [sdup] 16777216 512-byte logical blocks: (8.58 GB/8.00 GiB)
+            # Nov 07 04:55:40 00009bb1a4558a12 kernel: sdup: detected capacity change from 0 to 8589934592
+            rescan_device = bus_path.descendant(['device', 'rescan'])
+            with rescan_device.open('w') as f:
+                f.write('1\n')
+
+    def _delete_local_devices(self, hlu):
+        """
+        Remove the SCSI devices, on every FC host, and any multipath device
+        for ``hlu``.
+        """
+        scsi_devices = scsi_devices_for_hlu(hlu, self._sysfs)
+        if self._multipath:
+            # Remove the map before the paths under it disappear, or it will
+            # linger with every path failed.
+            devices = [
+                self._dev.child(block.basename())
+                for scsi_device in scsi_devices
+                for block in scsi_device.child('block').children()
+            ]
+            dm_device = multipath_device(devices, self._sysfs, self._dev)
+            if dm_device is not None:
+                flush_multipath_device(dm_device, self._sysfs)
+        for child in scsi_devices:
+            with child.child('delete').open('w') as f:
+                f.write('1\n')
 
     def _convert_volume_size(self, size):
         """
@@ -124,6 +381,9 @@ class EMCVnxBlockDeviceAPI(object):
             prefix, cluster_id, blockdevice_id = lun_name.rsplit('--', 2)
         except ValueError:
             return None
+        if prefix != LUN_NAME_PREFIX:
+            # For example, a spare LUN in the warm pool.
+            return None
         # XXX This is risky, but VNX LUN names must be <=64 characters.
         short_lun_cluster_id = str(cluster_id).split('-')[0]
         short_api_cluster_id = str(self._cluster_id).split('-')[0]
@@ -131,6 +391,192 @@ class EMCVnxBlockDeviceAPI(object):
             return None
         return blockdevice_id
 
+    def _volumes_from_inventory(self, luns, storage_groups):
+        """
+        :param list luns: LUN records with ``LUN_INVENTORY`` properties.
+        :param dict storage_groups: As returned by
+            ``EMCVNXClient.storage_groups``.
+        :returns: A ``list`` of ``BlockDeviceVolume`` for the LUNs which
+            belong to this cluster.
+        """
+        for volume in self._inventory.update(luns, storage_groups):
+            Message.new(operation=u'list_volumes_output',
+                        blockdevice_id=volume.blockdevice_id,
+                        size=volume.size,
+                        attached_to=volume.attached_to).write()
+        # Anything no longer attached here, perhaps detached by another
+        # process, must not be served from the device path map.
+        for blockdevice_id in self._device_path_map:
+            volume = self._inventory.volume(blockdevice_id)
+            if volume is None or volume.attached_to != self._hostname:
+                self._forget_device(blockdevice_id)
+        return self._inventory.volumes()
+
+    def allocation_unit(self):
+        allocation_unit = 1
+        Message.new(operation=u'allocation_unit',
+                    allocation_unit=allocation_unit).write()
+        return allocation_unit
+
+    def compute_instance_id(self):
+        Message.new(operation=u'compute_instance_id',
+                    hostname=self._hostname).write()
+        return self._hostname
+
+    # How many HLUs to try before giving up, when the array rejects them
+    # because they were taken since the storage group was listed.
+    _hlu_attempts = 5
+
+    def _conflict_error(self, blockdevice_id, alu, hlu, storage_groups):
+        """
+        :param dict storage_groups: Every storage group, as listed after the
+            array refused the last HLU tried for ``alu``.
+        :returns: The exception to raise: ``AlreadyAttachedVolume`` if the
+            LUN has meanwhile been added to any storage group, perhaps another
+            node's, or else ``HLUConflict``.
+        """
+        for group in storage_groups.values():
+            if alu in group.lunmap:
+                return AlreadyAttachedVolume(blockdevice_id)
+        return HLUConflict(blockdevice_id, alu, hlu)
+
+
+@implementer(IBlockDeviceAPI)
+class EMCVnxBlockDeviceAPI(_EMCVnxBlockDeviceAPIBase):
+
+    def __init__(self, cluster_id, spa_ip, storage_pool, hostname,
+                 storage_group, naviseccli_keys, naviseccli_workers=1,
+                 inventory_cache_ttl=0, inventory_cache_size=1024,
+                 naviseccli_output_format='text', multipath=False,
+                 warm_pool_depth=0, warm_pool_sizes=(),
+                 background_destroy=False, naviseccli_rate=0,
+                 naviseccli_burst=10, metrics_textfile=None,
+                 metrics_interval=60, naviseccli_path=CLI_PATH,
+                 naviseccli_debug=False, inventory_snapshot_max_age=0,
+                 inventory_snapshot_interval=None,
+                 hlu_reservation_directory=None):
+        """
+        :param bool multipath: Wait for each LUN on every FC host and use the
+            ``dm-multipath`` device which combines those paths, rather than
+            the SCSI disk on the first FC host.
+        :param int warm_pool_depth: How many spare LUNs of each of
+            ``warm_pool_sizes`` to keep for ``create_volume`` to claim.
+        :param list warm_pool_sizes: Sizes of spare LUNs, in GiB.
+        :param bool background_destroy: Have ``destroy_volume`` rename the
+            LUN out of the way and return, leaving a background thread to
+            destroy it.
+        :param float naviseccli_rate: If positive, the most ``naviseccli``
+            commands a second which all processes on this node may send to
+            the SP.  Commands then wait their turn by priority: mutations,
+            then listings of single objects, then whole inventory listings.
+        :param int naviseccli_burst: How many commands may be sent at once
+            after a quiet spell, when ``naviseccli_rate`` is set.
+        :param metrics_textfile: The path of a Prometheus textfile to which
+            latency histograms and counters are written every
+            ``metrics_interval`` seconds, along with an eliot ``metrics``
+            message.  Nothing is exported if this is ``None``.
+        :param naviseccli_path: The ``naviseccli`` to run, for example one
+            written by ``VNXEmulator.write_script`` to test without an array.
+        :param bool naviseccli_debug: Keep the ``naviseccli`` output each
+            storage group was parsed from as its ``raw_output``.
+        :param float inventory_snapshot_max_age: If positive, share one
+            listing of the array between every process on this node which
+            talks to the SP, answering inventory queries from it while it
+            is no older than this many seconds.
+        :param float inventory_snapshot_interval: How often the process
+            which writes the shared listing refreshes it.  Defaults to half
+            of ``inventory_snapshot_max_age``.
+        :param hlu_reservation_directory: The path of the directory in which
+            the HLUs being added to the storage group are reserved, shared by
+            every process on this node.  It must be writable by the agent.
+            Defaults to ``RESERVATION_DIRECTORY``.
+        """
+        _EMCVnxBlockDeviceAPIBase.__init__(
+            self, cluster_id, storage_pool, hostname, storage_group,
+            hlu_reservation_directory,
+        )
+        self._multipath = multipath
+        if naviseccli_workers > 1:
+            executor = PooledExecutor(workers=naviseccli_workers)
+        else:
+            executor = SerialExecutor()
+        if naviseccli_rate > 0:
+            executor = ScheduledExecutor(
+                executor,
+                TokenBucket(
+                    token_bucket_path(spa_ip), naviseccli_rate,
+                    naviseccli_burst,
+                ),
+            )
+        cache = TTLCache(
+            ttl=inventory_cache_ttl, max_entries=inventory_cache_size
+        )
+        snapshot = None
+        if inventory_snapshot_max_age > 0:
+            snapshot = SnapshotReader(
+                snapshot_path(spa_ip), inventory_snapshot_max_age
+            )
+        self._client = EMCVNXClient(
+            spa_ip, naviseccli_keys, executor=executor, cache=cache,
+            output_format=naviseccli_output_format, metrics=self._metrics,
+            naviseccli_path=naviseccli_path, debug=naviseccli_debug,
+            snapshot=snapshot,
+        )
+        self._warm_pool = None
+        if warm_pool_depth > 0 and warm_pool_sizes:
+            self._warm_pool = WarmPool(
+                self._client, storage_pool, cluster_id,
+                sizes=warm_pool_sizes, depth=warm_pool_depth,
+            )
+            self._warm_pool.start()
+        self._reaper = None
+        if background_destroy:
+            self._reaper = Reaper(self._client, cluster_id)
+            self._reaper.start()
+        self._metrics.add_collector(self._collect_metrics)
+        self._exporter = None
+        if metrics_textfile is not None:
+            self._exporter = MetricsExporter(
+                self._metrics, FilePath(metrics_textfile), metrics_interval
+            )
+            self._exporter.start()
+        self._snapshot_writer = None
+        if snapshot is not None:
+            if inventory_snapshot_interval is None:
+                inventory_snapshot_interval = inventory_snapshot_max_age / 2.0
+            self._snapshot_writer = SnapshotWriter(
+                self._client, snapshot.path, inventory_snapshot_interval,
+                EMCVNXClient.LUN_ATTACHMENT,
+            )
+            self._snapshot_writer.start()
+
+    def _collect_metrics(self):
+        if self._warm_pool is not None:
+            for size, spares in self._warm_pool.stats()['spares'].items():
+                yield (
+                    GAUGE, 'flocker_vnx_warm_pool_spares', {'size_gb': size},
+                    spares,
+                )
+            yield (
+                COUNTER, 'flocker_vnx_warm_pool_hits_total', {},
+                self._warm_pool.hits,
+            )
+            yield (
+                COUNTER, 'flocker_vnx_warm_pool_misses_total', {},
+                self._warm_pool.misses,
+            )
+        if self._reaper is not None:
+            stats = self._reaper.stats()
+            yield GAUGE, 'flocker_vnx_reaper_pending', {}, stats['pending']
+            yield (
+                COUNTER, 'flocker_vnx_reaper_destroyed_total', {},
+                stats['destroyed'],
+            )
+            yield (
+                COUNTER, 'flocker_vnx_reaper_retries_total', {},
+                stats['retries'],
+            )
+
     def create_volume(self, dataset_id, size):
         Message.new(operation=u'create_volume',
                     dataset_id=str(dataset_id),
@@ -141,9 +587,18 @@ class EMCVnxBlockDeviceAPI(object):
         lun_name = self._get_lun_name_from_blockdevice_id(
             volume.blockdevice_id
         )
+        size_gb = self._convert_volume_size(size)
+        if self._warm_pool is not None:
+            if self._warm_pool.claim(size_gb, lun_name):
+                Message.new(operation=u'create_volume_output',
+                            dataset_id=str(dataset_id),
+                            size=size,
+                            lun_name=lun_name,
+                            warm_pool=self._warm_pool.stats()).write()
+                return volume
         rc, out = self._client.create_volume(
             lun_name,
-            str(self._convert_volume_size(size)),
+            str(size_gb),
             self._pool
         )
         Message.new(operation=u'create_volume_output',
@@ -154,12 +609,19 @@ class EMCVnxBlockDeviceAPI(object):
                     out=out).write()
         if rc != 0:
             raise Exception(rc, out)
+        # Don't wait for the LUN to initialise here; attach_volumes will,
+        # if it gets to it first.
+        self._client.readiness.track(lun_name)
         return volume
 
     def destroy_volume(self, blockdevice_id):
         Message.new(operation=u'destroy_volume',
                     blockdevice_id=blockdevice_id).write()
         lun_name = self._get_lun_name_from_blockdevice_id(blockdevice_id)
+        self._forget_device(blockdevice_id)
+        if self._reaper is not None:
+            self._tombstone(blockdevice_id, lun_name)
+            return
         rc, out = self._client.destroy_volume(lun_name)
         Message.new(operation=u'destroy_volume_output',
                     blockdevice_id=blockdevice_id,
@@ -184,275 +646,423 @@ class EMCVnxBlockDeviceAPI(object):
         if rc != 0 and retry_attempt == max_retries: 
             raise Exception(rc, out)
 
-    def attach_volume(self, blockdevice_id, attach_to):
-        Message.new(operation=u'attach_volume',
+    def _tombstone(self, blockdevice_id, lun_name):
+        """
+        Rename the LUN of a volume so that it is no longer listed as one, and
+        leave the reaper to destroy it.
+        """
+        tombstone = self._reaper.tombstone_name(blockdevice_id)
+        rc, out = self._client.rename_volume(lun_name, tombstone)
+        Message.new(operation=u'destroy_volume_output',
                     blockdevice_id=blockdevice_id,
-                    attach_to=attach_to).write()
-        lun_name = self._get_lun_name_from_blockdevice_id(blockdevice_id)
-        lun = self._client.get_lun_by_name(lun_name)
-
-        if lun == {}:
-            raise UnknownVolume(blockdevice_id)
-        alu = lun['lun_id']
-
-        rc, out = self._client.get_storage_group(self._group)
+                    lun_name=lun_name,
+                    tombstone=tombstone,
+                    rc=rc,
+                    out=out).write()
         if rc != 0:
+            lun = self._client.get_lun_by_name(
+                lun_name, EMCVNXClient.LUN_INVENTORY
+            )
+            if lun is None:
+                raise UnknownVolume(blockdevice_id)
             raise Exception(rc, out)
+        self._reaper.bury(tombstone)
 
-        lunmap = self._client.parse_sg_content(out)['lunmap']
-        try:
-            # The LUN has already been added to this storage group....perhaps
-            # by a previous attempt to attach in which the OS device did not
-            # appear.
-            hlu = lunmap[alu]
-        except KeyError:
-            # Add LUN to storage group
-            hlu = self._choose_hlu(lunmap)
-            rc, out = self._client.add_volume_to_sg(str(hlu),
-                                                    str(alu),
-                                                    self._group)
-            if rc != 0:
-                if rc == 66:
-                    raise AlreadyAttachedVolume(blockdevice_id)
-                else:
-                    raise Exception(rc, out)
+    def attach_volume(self, blockdevice_id, attach_to):
+        return _only(self.attach_volumes, blockdevice_id, attach_to)
 
-        volume = _blockdevicevolume_from_blockdevice_id(
-            blockdevice_id=blockdevice_id,
-            size=int(lun['total_capacity_gb']*1024*1024*1024),
-            attached_to=unicode(attach_to)
+    def attach_volumes(self, blockdevice_ids, attach_to):
+        """
+        Attach several volumes to this node together.
+
+        The storage group is read once, HLUs are chosen for all of the LUNs
+        and their ``-addhlu`` commands are submitted as a pipeline.  A single
+        scan then looks for every LUN and all of the devices are waited for
+        at the same time.
+
+        :param list blockdevice_ids: The volumes to attach.
+        :param unicode attach_to: As for ``attach_volume``.
+        :returns: A ``dict`` mapping each blockdevice_id to its
+            ``BlockDeviceVolume``.
+        :raises BulkOperationFailed: If some volumes couldn't be attached.
+            The rest will have been.
+        """
+        blockdevice_ids = list(OrderedDict.fromkeys(blockdevice_ids))
+        with start_action(action_type=u'flocker_vnx:attach_volumes',
+                          blockdevice_ids=blockdevice_ids,
+                          attach_to=attach_to):
+            return self._attach_volumes(blockdevice_ids, attach_to)
+
+    def _attach_volumes(self, blockdevice_ids, attach_to):
+        for blockdevice_id in blockdevice_ids:
+            Message.new(operation=u'attach_volume',
+                        blockdevice_id=blockdevice_id,
+                        attach_to=attach_to).write()
+        failures = {}
+        timings = self._metrics.timings(
+            'flocker_vnx_attach_phase_seconds', u'flocker_vnx:attach_volumes'
         )
+        with timings.phase('lookup'):
+            luns = self._lookup_luns(blockdevice_ids, failures)
+        with timings.phase('ready'):
+            self._wait_until_ready(luns, failures)
+        with timings.phase('storage_group'):
+            lunmap = self._lunmap() if luns else {}
+            hlus = self._add_all_to_storage_group(luns, lunmap, failures)
 
-        # Rescan and wait for the expected bus 3 times and wait successively
-        # longer for the device to appear.
-        # Sometimes the bus doesn't appear until you rescan repeatedly.
-        # XXX Often it never appears....which is a problem
-        counter = 1
-        start_time = time.time()
-        # XXX This will only operate on the first available HLU bus
-        hlu_bus_path = _hlu_bus_paths(hlu)[0]
-        # /sys/class/scsi_disks/<fc_port>:0:0:<hlu>/device/block/ contains
-        # symlinks whose names are the device names that have been allocated eg
-        # sdvb.
-        block_device_pointers = hlu_bus_path.descendant(['device', 'block'])
-
-        # Do an early check to see if the device is already present.
-        if _directory_listable(block_device_pointers):
-            new_device = _device_paths_for_hlu_bus_path(hlu_bus_path)[0]
-            if _device_path_is_usable(new_device):
-                raise AlreadyAttachedVolume(blockdevice_id)
-
-        while True:
-            with open(os.devnull, 'w') as discard:
-                check_output(
-                    ["rescan-scsi-bus", "--luns={}".format(hlu)],
-                    stderr=discard
+        volumes = {}
+        pending = {}
+        for blockdevice_id, hlu in hlus.items():
+            lun = luns[blockdevice_id]
+            volumes[blockdevice_id] = _blockdevicevolume_from_blockdevice_id(
+                blockdevice_id=blockdevice_id,
+                size=int(lun.total_capacity_gb*1024*1024*1024),
+                attached_to=unicode(attach_to)
+            )
+            # /sys/class/scsi_disks/<fc_port>:0:0:<hlu>/device/block/
+            # contains symlinks whose names are the device names that have
+            # been allocated eg sdvb.
+            bus_paths = hlu_bus_paths(hlu, self._sysfs)
+            # Do an early check to see if the device is already present.
+            device = self._local_device(lun, bus_paths)
+            if device is not None:
+                self._remember_device(
+                    blockdevice_id, lun, hlu, bus_paths[0], device
                 )
-            try:
-                wait_for(
-                    predicate=lambda: _directory_listable(
-                        block_device_pointers
-                    ),
-                    timeout=5 * counter
+                failures[blockdevice_id] = AlreadyAttachedVolume(
+                    blockdevice_id
                 )
-                break
-            except Timeout:
-                if counter > 5:
-                    elapsed_time = time.time() - start_time
-                    raise Timeout(
-                        "HLU bus did not appear. "
-                        "Expected {}. "
-                        "Waited {}s and performed {} scsi bus rescans.".format(
-                            hlu_bus_path,
-                            elapsed_time,
-                            counter,
-                        ),
-                        hlu_bus_path, elapsed_time, counter
-                    )
-                else:
-                    counter += 1
-
-        # Once the bus is available we can discover the device path and check
-        # that the device path is usable It may not be usable. For example the
-        # device is sometimes initially 0 size until you force a rescan:
-
-        # (echo 1 > /sys/class/scsi_disk/1:0:0:219/device/rescan)
-        # Nov 07 04:55:40 00009bb1a4558a12 kernel: sd 1:0:0:219: [sdup] 16777216 512-byte logical blocks: (8.58 GB/8.00 GiB)
-        # Nov 07 04:55:40 00009bb1a4558a12 kernel: sdup: detected capacity change from 0 to 8589934592
-        # XXX This will only operate on one of the resulting device paths.
-        # /sys/class/scsi_disk/x:x:x:HLU/device/block/sdvb for example.
-        new_device = _device_paths_for_hlu_bus_path(hlu_bus_path)[0]
-        rescan_device = hlu_bus_path.descendant(['device', 'rescan'])
-        counter = 1
-        while True:
+                continue
+            pending[blockdevice_id] = (lun, hlu, bus_paths)
+
+        devices = self._wait_for_devices(pending, failures, timings)
+
+        for blockdevice_id, device in devices.items():
+            lun, hlu, bus_paths = pending[blockdevice_id]
+            self._remember_device(
+                blockdevice_id, lun, hlu, bus_paths[0], device
+            )
+            Message.new(
+                operation=u'attach_volume_output',
+                blockdevice_id=blockdevice_id,
+                attach_to=attach_to,
+                lun_name=lun.lun_name,
+                alu=lun.lun_id,
+                hlu=hlu,
+                device_path=repr(device),
+                timings=timings.phases,
+            ).write()
+        volumes = {
+            blockdevice_id: volume
+            for blockdevice_id, volume in volumes.items()
+            if blockdevice_id in devices
+        }
+        if failures:
+            raise BulkOperationFailed(failures, volumes)
+        return volumes
+
+    def _lookup_luns(self, blockdevice_ids, failures):
+        """
+        Find the LUN of each volume.
+
+        A single LUN is looked up by name, but listing every LUN once is
+        cheaper than looking up several of them one by one.
+
+        :param dict failures: ``UnknownVolume`` is added to this for each
+            volume which has no LUN.
+        :returns: A ``dict`` mapping blockdevice_id to ``LUN_ATTACHMENT``
+            records for each volume that has a LUN.
+        """
+        names = {
+            blockdevice_id: self._get_lun_name_from_blockdevice_id(
+                blockdevice_id
+            )
+            for blockdevice_id in blockdevice_ids
+        }
+        if len(names) == 1:
+            [(blockdevice_id, lun_name)] = names.items()
+            by_name = {
+                lun_name: self._client.get_lun_by_name(
+                    lun_name, EMCVNXClient.LUN_ATTACHMENT
+                )
+            }
+        else:
+            by_name = {
+                lun.lun_name: lun
+                for lun in self._client.get_all_luns(
+                    EMCVNXClient.LUN_ATTACHMENT
+                )
+            }
+        luns = {}
+        for blockdevice_id, lun_name in names.items():
+            lun = by_name.get(lun_name)
+            if lun is None:
+                failures[blockdevice_id] = UnknownVolume(blockdevice_id)
+            else:
+                luns[blockdevice_id] = lun
+        return luns
+
+    def _wait_until_ready(self, luns, failures, timeout=300):
+        """
+        Wait for those of ``luns`` which were created by this node and may
+        still be initialising, removing any which fault or don't become
+        ready.
+
+        :param dict luns: Maps blockdevice_id to LUN records.
+        :param dict failures: An exception is added to this for each LUN
+            which couldn't be used.
+        """
+        readiness = self._client.readiness
+        unsettled = {
+            lun.lun_name: blockdevice_id
+            for blockdevice_id, lun in luns.items()
+            if readiness.pending(lun.lun_name)
+        }
+        if not unsettled:
+            return
+        states = readiness.wait(list(unsettled), timeout)
+        for lun_name, blockdevice_id in unsettled.items():
+            state = states.get(lun_name, 'Unsettled')
+            if state == 'Ready':
+                continue
+            del luns[blockdevice_id]
+            if state is None:
+                failures[blockdevice_id] = UnknownVolume(blockdevice_id)
+            else:
+                failures[blockdevice_id] = Exception(
+                    "LUN is not ready", lun_name, state
+                )
+
+    def _add_all_to_storage_group(self, luns, lunmap, failures):
+        """
+        Make sure that every one of ``luns`` is in this node's storage
+        group, choosing their HLUs together.
+
+        :param dict luns: Maps blockdevice_id to LUN records.
+        :param dict lunmap: The storage group's ALU to HLU mapping.
+        :param dict failures: The exception is added to this for each LUN
+            which couldn't be added.
+        :returns: A ``dict`` mapping blockdevice_id to HLU.
+        """
+        hlus = {}
+        additions = []
+        for blockdevice_id, lun in luns.items():
+            alu = lun.lun_id
             try:
-                wait_for(
-                    predicate=lambda: _device_path_is_usable(new_device),
-                    timeout=5 * counter
+                # The LUN has already been added to this storage
+                # group....perhaps by a previous attempt to attach in which
+                # the OS device did not appear.
+                hlus[blockdevice_id] = lunmap[alu]
+                continue
+            except KeyError:
+                pass
+            try:
+                hlu = self._hlus.reserve(lunmap)
+            except HLUsExhausted as e:
+                failures[blockdevice_id] = e
+                continue
+            additions.append((blockdevice_id, alu, hlu))
+
+        results = self._client.add_volumes_to_sg(
+            [(str(addition[2]), str(addition[1])) for addition in additions],
+            self._group
+        )
+        for (blockdevice_id, alu, hlu), (rc, out) in zip(additions, results):
+            if rc == 0:
+                # The reservation is left to lapse; by then the HLU will be
+                # in every fresh listing of the storage group.
+                hlus[blockdevice_id] = hlu
+                continue
+            self._hlus.release(hlu)
+            try:
+                if rc != 66:
+                    raise Exception(rc, out)
+                # Something else took the HLU.  Carry on one at a time.
+                hlus[blockdevice_id] = self._add_to_storage_group(
+                    blockdevice_id, alu,
+                    self._lunmap_after_conflict(blockdevice_id, alu, hlu, 0)
                 )
-                break
-            except Timeout:
-                if counter > 5:
-                    elapsed_time = time.time() - start_time
-                    raise Timeout(
-                        "Device did not appear. "
-                        "Expected {}. "
-                        "Waited {}s and performed {} scsi bus rescans.".format(
-                            new_device,
-                            elapsed_time,
-                            counter,
-                        ),
-                        new_device, elapsed_time, counter
-                    )
-                else:
-                    with rescan_device.open('w') as f:
-                        f.write('1\n')
-                    counter += 1
-
-        Message.new(
-            operation=u'attach_volume_output',
-            blockdevice_id=blockdevice_id,
-            attach_to=attach_to,
-            lun_name=lun_name,
-            alu=alu,
-            hlu=hlu,
-            device_path=repr(new_device)
-        ).write()
-        return volume
+            except Exception as e:
+                failures[blockdevice_id] = e
+        return hlus
 
-    def detach_volume(self, blockdevice_id):
-        Message.new(operation=u'detach_volume',
-                    blockdevice_id=blockdevice_id).write()
-        lun_name = self._get_lun_name_from_blockdevice_id(blockdevice_id)
-        lun = self._client.get_lun_by_name(lun_name)
-        if lun == {}:
-            raise UnknownVolume(blockdevice_id)
-        alu = lun['lun_id']
+    def _add_to_storage_group(self, blockdevice_id, alu, lunmap):
+        """
+        Add the LUN ``alu`` to this node's storage group at a free HLU.
+
+        If the array rejects the HLU because something else has used it
+        since ``lunmap`` was read, read the storage group again and retry.
+
+        :returns: The HLU.
+        :raises AlreadyAttachedVolume: If the LUN turns out to be in a
+            storage group already.
+        :raises HLUConflict: If every HLU tried was refused although the
+            LUN isn't in any storage group.
+        """
+        for attempt in range(self._hlu_attempts):
+            hlu = self._hlus.reserve(lunmap)
+            rc, out = self._client.add_volume_to_sg(str(hlu),
+                                                    str(alu),
+                                                    self._group)
+            if rc == 0:
+                return hlu
+            self._hlus.release(hlu)
+            if rc != 66:
+                raise Exception(rc, out)
+            lunmap = self._lunmap_after_conflict(
+                blockdevice_id, alu, hlu, attempt
+            )
+        raise self._conflict_error(
+            blockdevice_id, alu, hlu, self._client.storage_groups()
+        )
+
+    def _lunmap(self):
+        """
+        :returns: The ALU to HLU mapping of this node's storage group.
+        """
         rc, out = self._client.get_storage_group(self._group)
         if rc != 0:
             raise Exception(rc, out)
+        return self._client.parse_sg_content(out).lunmap
 
-        lunmap = self._client.parse_sg_content(out)['lunmap']
-        try:
-            hlu = lunmap[alu]
-        except KeyError:
-            raise UnattachedVolume(blockdevice_id)
+    def _lunmap_after_conflict(self, blockdevice_id, alu, hlu, attempt):
+        """
+        Read the storage group again after the array refused to add ``alu``
+        at ``hlu``.
 
-        # Delete the specific buses that we're detached *before* we remove the
-        # LUN from the Storage group
-        for child in FilePath('/sys/bus/scsi/drivers/sd').children():
-            alu_suffix = ':{}'.format(hlu)
-            if child.basename().endswith(alu_suffix):
-                with child.child('delete').open('w') as f:
-                    f.write('1\n')
+        :raises AlreadyAttachedVolume: If that was because the LUN is
+            already in the group.
+        :returns: The new ``lunmap``.
+        """
+        lunmap = self._lunmap()
+        if alu in lunmap:
+            raise AlreadyAttachedVolume(blockdevice_id)
+        Message.new(operation=u'hlu_conflict',
+                    blockdevice_id=blockdevice_id,
+                    alu=alu,
+                    hlu=hlu,
+                    attempt=attempt).write()
+        return lunmap
 
-        rc, out = self._client.remove_volume_from_sg(str(hlu), self._group)
-        if rc != 0:
-            raise Exception(rc, out)
+    def detach_volume(self, blockdevice_id):
+        _only(self.detach_volumes, blockdevice_id)
 
-        Message.new(
-            operation=u'detach_volume_output',
-            blockdevice_id=blockdevice_id,
-            lun_name=lun_name,
-            alu=alu,
-            hlu=hlu,
-            rc=rc,
-            out=out,
-        ).write()
-
-    def _lun_storagegroup_map(self, cluster_lun_ids):
-        storage_groups = self._client.storage_groups()
-        lun_to_group = {}
-        for group_name, group in storage_groups.items():
-            for alu, hlu in group['lunmap'].items():
-                if alu not in cluster_lun_ids:
-                    continue
-                if alu in lun_to_group:
-                    raise Exception(
-                        group_name,
-                        group['lunmap'],
-                        alu,
-                        hlu,
-                        lun_to_group
+    def detach_volumes(self, blockdevice_ids):
+        """
+        Detach several volumes from this node together.
+
+        The storage group is read once and, after the local devices have
+        been removed, the ``-removehlu`` commands are submitted as a
+        pipeline.
+
+        :param list blockdevice_ids: The volumes to detach.
+        :returns: A ``list`` of the blockdevice_ids which were detached.
+        :raises BulkOperationFailed: If some volumes couldn't be detached.
+            The rest will have been.
+        """
+        blockdevice_ids = list(OrderedDict.fromkeys(blockdevice_ids))
+        with start_action(action_type=u'flocker_vnx:detach_volumes',
+                          blockdevice_ids=blockdevice_ids):
+            return self._detach_volumes(blockdevice_ids)
+
+    def _detach_volumes(self, blockdevice_ids):
+        for blockdevice_id in blockdevice_ids:
+            Message.new(operation=u'detach_volume',
+                        blockdevice_id=blockdevice_id).write()
+            self._forget_device(blockdevice_id)
+        failures = {}
+        timings = self._metrics.timings(
+            'flocker_vnx_detach_phase_seconds', u'flocker_vnx:detach_volumes'
+        )
+        with timings.phase('lookup'):
+            luns = self._lookup_luns(blockdevice_ids, failures)
+        with timings.phase('storage_group'):
+            lunmap = self._lunmap() if luns else {}
+
+        removals = []
+        with timings.phase('delete_devices'):
+            for blockdevice_id, lun in luns.items():
+                try:
+                    hlu = lunmap[lun.lun_id]
+                except KeyError:
+                    failures[blockdevice_id] = UnattachedVolume(
+                        blockdevice_id
                     )
-                lun_to_group[alu] = (group_name, group)
-        return lun_to_group
-
-    def _cluster_luns(self):
-        cluster_luns = []
-        for lun in self._client.get_all_luns():
-            blockdevice_id = self._get_blockdevice_id_from_lun_name(
-                lun['lun_name'].decode('ascii')
+                    continue
+                # Delete the specific buses that we're detached *before* we
+                # remove the LUN from the Storage group
+                try:
+                    self._delete_local_devices(hlu)
+                except Exception as e:
+                    # Leave this LUN mapped, but carry on with the others.
+                    failures[blockdevice_id] = e
+                    continue
+                removals.append((blockdevice_id, hlu))
+
+        with timings.phase('remove'):
+            results = self._client.remove_volumes_from_sg(
+                [str(removal[1]) for removal in removals], self._group
             )
-            if blockdevice_id is not None:
-                cluster_luns.append(lun)
-        return cluster_luns
+        detached = []
+        for (blockdevice_id, hlu), (rc, out) in zip(removals, results):
+            if rc != 0:
+                failures[blockdevice_id] = Exception(rc, out)
+                continue
+            lun = luns[blockdevice_id]
+            Message.new(
+                operation=u'detach_volume_output',
+                blockdevice_id=blockdevice_id,
+                lun_name=lun.lun_name,
+                alu=lun.lun_id,
+                hlu=hlu,
+                rc=rc,
+                out=out,
+                timings=timings.phases,
+            ).write()
+            detached.append(blockdevice_id)
+        if failures:
+            raise BulkOperationFailed(failures, detached)
+        return detached
 
     def list_volumes(self):
-        volumes = []
-        cluster_luns = self._cluster_luns()
-        lun_storage_group_map = self._lun_storagegroup_map(
-            cluster_lun_ids=[l['lun_id'] for l in cluster_luns]
+        luns, storage_groups = self._client.get_inventory(
+            EMCVNXClient.LUN_INVENTORY
         )
-        for each in cluster_luns:
-            lun_id = each['lun_id']
-            blockdevice_id = self._get_blockdevice_id_from_lun_name(
-                each['lun_name'].decode('ascii')
-            )
-
-            attached_to = None
-            try:
-                group_name, group = lun_storage_group_map[lun_id]
-            except KeyError:
-                # LUN is not attached anywhere.
-                pass
-            else:
-                if group_name == self._group:
-                    # LUN attached here.
-                    attached_to = unicode(self._hostname)
-                else:
-                    # Lun attached elsewhere.
-                    # A node can see that a LUN has been added to another
-                    # storage group but that's all.  It can't know whether the
-                    # host in that foreign storage group has created a device
-                    # for the LUN.  As far as it knows, it's non-manifest.  But
-                    # problems occur because our BlockDeviceDeployer reports it
-                    # as a non-manifest volume in the NodeState.  The control
-                    # service ends up seeing and reporting a DeployementState
-                    # where a dataset is both manifest on the other node and
-                    # non-manifest.
-                    # The workarounds for now is to list the volume as attached
-                    # to a non-existent compute_id. This only works because the
-                    # local deployer only reports the state of locally attached
-                    # and non-manifest datasets.
-                    attached_to = UNKNOWN_COMPUTE_ID
-
-            size = int(1024*1024*1024*each['total_capacity_gb'])
-            vol = _blockdevicevolume_from_blockdevice_id(
-                blockdevice_id=blockdevice_id,
-                size=size,
-                attached_to=attached_to)
-            Message.new(operation=u'list_volumes_output',
-                        blockdevice_id=blockdevice_id,
-                        size=size,
-                        attached_to=attached_to).write()
-            volumes.append(vol)
-        return volumes
+        return self._volumes_from_inventory(luns, storage_groups)
 
     def get_device_path(self, blockdevice_id):
         Message.new(operation=u'get_device_path',
                     blockdevice_id=blockdevice_id).write()
+        # Flocker asks for the device of every attached volume on every
+        # convergence loop, so answer from sysfs alone whenever possible.
+        device_path = self._known_device_path(blockdevice_id)
+        cached = device_path is not None
+        if not cached:
+            device_path = self._find_device_path(blockdevice_id)
+        Message.new(operation=u'get_device_path_output',
+                    blockdevice_id=blockdevice_id,
+                    device_path=device_path.path,
+                    cached=cached).write()
+        return device_path
+
+    def _find_device_path(self, blockdevice_id):
+        """
+        Ask the array which HLU ``blockdevice_id`` has in this node's storage
+        group and find its device, remembering it for next time.
+        """
         lun_name = self._get_lun_name_from_blockdevice_id(blockdevice_id)
-        lun = self._client.get_lun_by_name(lun_name)
-        if lun == {}:
+        lun = self._client.get_lun_by_name(
+            lun_name, EMCVNXClient.LUN_ATTACHMENT
+        )
+        if lun is None:
             raise UnknownVolume(blockdevice_id)
 
-        alu = lun['lun_id']
+        alu = lun.lun_id
 
         rc, out = self._client.get_storage_group(self._group)
         if rc != 0:
             raise Exception(rc, out)
-        lunmap = self._client.parse_sg_content(out)['lunmap']
+        lunmap = self._client.parse_sg_content(out).lunmap
         try:
             # The LUN has already been added to this storage group....perhaps
             # by a previous attempt to attach in which the OS device did not
@@ -460,36 +1070,41 @@ class EMCVnxBlockDeviceAPI(object):
             hlu = lunmap[alu]
         except KeyError:
             raise UnattachedVolume(blockdevice_id)
-        hlu_bus_path = _hlu_bus_paths(hlu)[0]
-
-        # XXX This will only operate on one of the resulting device paths.
-        # /sys/class/scsi_disk/x:x:x:HLU/device/block/sdvb for example.
-        device_path = _device_paths_for_hlu_bus_path(hlu_bus_path)[0]
-
-        if not _device_path_is_usable(device_path):
+        all_bus_paths = hlu_bus_paths(hlu, self._sysfs)
+        hlu_bus_path = all_bus_paths[0]
+        device_path = self._local_device(lun, all_bus_paths)
+        if device_path is None:
             raise UnattachedVolume(blockdevice_id)
-        Message.new(operation=u'get_device_path_output',
-                    blockdevice_id=blockdevice_id,
-                    device_path=device_path.path).write()
+        self._remember_device(
+            blockdevice_id, lun, hlu, hlu_bus_path, device_path
+        )
         return device_path
 
-    def allocation_unit(self):
-        allocation_unit = 1
-        Message.new(operation=u'allocation_unit',
-                    allocation_unit=allocation_unit).write()
-        return allocation_unit
 
-    def compute_instance_id(self):
-        Message.new(operation=u'compute_instance_id',
-                    hostname=self._hostname).write()
-        return self._hostname
-
-    def _choose_hlu(self, lun_map):
-        candidates = list(set(range(1, 256)) - set(lun_map.values()))
-        return candidates[random.randint(0, len(candidates)-1)]
+# Options of ``EMCVnxBlockDeviceAPI`` which rely on its background threads
+# or blocking executors, and so can't be used with ``asynchronous: true``.
+SYNCHRONOUS_ONLY_OPTIONS = frozenset([
+    'inventory_cache_ttl', 'inventory_cache_size', 'warm_pool_depth',
+    'warm_pool_sizes', 'background_destroy', 'naviseccli_rate',
+    'naviseccli_burst', 'metrics_textfile', 'metrics_interval',
+    'inventory_snapshot_max_age', 'inventory_snapshot_interval',
+])
 
 
-def api_factory(cluster_id, **kwargs):
+def api_factory(cluster_id, reactor=None, asynchronous=False, **kwargs):
+    if asynchronous:
+        unsupported = sorted(SYNCHRONOUS_ONLY_OPTIONS.intersection(kwargs))
+        if unsupported:
+            raise ValueError(
+                "These options can't be used with asynchronous: true",
+                unsupported,
+            )
+        from ._async_driver import AsyncEMCVnxBlockDeviceAPI
+        if reactor is None:
+            # Only asynchronous deployments need the reactor, so it isn't
+            # requested for every deployment in FLOCKER_BACKEND.
+            from twisted.internet import reactor
+        return AsyncEMCVnxBlockDeviceAPI(reactor, cluster_id, **kwargs)
     api = EMCVnxBlockDeviceAPI(cluster_id, **kwargs)
     return api
 
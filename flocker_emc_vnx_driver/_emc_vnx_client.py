@@ -1,254 +1,611 @@
-import re
 import time
 
-import subprocess
+from ._cache import TTLCache
+from ._executor import SerialExecutor, chain
+from ._metrics import COUNTER, GAUGE, Metrics
+from ._parsing import OUTPUT_FORMATS
+from ._readiness import ReadinessTracker
+from ._records import LUN, Pool
+from ._singleflight import SingleFlight
 
 
 CLI_PATH = '/opt/Navisphere/bin/naviseccli'
 
+# Inventory cache keys.
+_ALL_STORAGE_GROUPS = ('storage_groups',)
 
-def execute(*cmd):
-    try:
-        _PIPE = subprocess.PIPE
-        obj = subprocess.Popen(
-            cmd, stdin=_PIPE, stdout=_PIPE,
-            close_fds=True, shell=False)
-        out, err = obj.communicate()
-        obj.stdin.close()
-        _returncode = obj.returncode
-        return _returncode, out, err
-    finally:
-        time.sleep(0)
+# The scheduler statistics which are instantaneous values rather than totals.
+_SCHEDULER_GAUGES = frozenset(['queued', 'max_wait_seconds'])
+
+
+def _counted(lines, size):
+    """
+    Pass on ``lines``, adding their lengths to ``size[0]``.
+    """
+    for line in lines:
+        size[0] += len(line)
+        yield line
 
 
 class PropertyDescriptor(object):
-    def __init__(self, option, label, key, converter=None):
+    """
+    How to request and parse one property of an array object.
+
+    :ivar option: The ``naviseccli`` flag which makes a ``-list`` command
+        display this property, or ``None`` if the property is always
+        displayed.
+    :ivar xml_name: The ``NAME`` of the ``PARAMVALUE`` element holding this
+        property in ``-xml`` output.
+    """
+    def __init__(self, option, label, key, converter=None, xml_name=None):
         self.option = option
         self.label = label
         self.key = key
         self.converter = converter
+        self.xml_name = xml_name
 
 
 class EMCVNXClient(object):
 
     POOL_NAME = PropertyDescriptor(
-        '-name',
+        None,
         'Pool Name:\s*(.*)\s*',
-        'pool_name')
+        'pool_name',
+        xml_name='Pool Name')
 
     LUN_STATE = PropertyDescriptor(
         '-state',
         'Current State:\s*(.*)\s*',
-        'state')
+        'state',
+        xml_name='Current State')
     LUN_STATUS = PropertyDescriptor(
         '-status',
         'Status:\s*(.*)\s*',
-        'status')
+        'status',
+        xml_name='Status')
     LUN_NAME = PropertyDescriptor(
-        '-name',
+        None,
         'Name:\s*(.*)\s*',
-        'lun_name')
+        'lun_name',
+        xml_name='Name')
     LUN_CAPACITY = PropertyDescriptor(
         '-userCap',
         'User Capacity \(GBs\):\s*(.*)\s*',
         'total_capacity_gb',
-        float)
+        float,
+        xml_name='User Capacity (GBs)')
     LUN_ID = PropertyDescriptor(
-        '-id',
+        None,
         'LOGICAL UNIT NUMBER\s*(\d+)\s*',
         'lun_id',
-        int)
+        int,
+        xml_name='LOGICAL UNIT NUMBER')
 
     LUN_UID = PropertyDescriptor(
-        '-id',
+        '-uid',
         'UID:\s*([0-9A-F:]+)\s*',
         'lun_uid',
-        lambda val: val.replace(':', '').lower())
+        lambda val: val.replace(':', '').lower(),
+        xml_name='UID')
 
     LUN_ALL = [LUN_STATE, LUN_STATUS, LUN_NAME, LUN_CAPACITY, LUN_ID, LUN_UID]
 
-    def __init__(self, ip, key_path):
+    # Just enough to describe a LUN as a ``BlockDeviceVolume``.
+    LUN_INVENTORY = [LUN_NAME, LUN_ID, LUN_CAPACITY]
+
+    # Enough to attach a LUN and later recognise its device.
+    LUN_ATTACHMENT = LUN_INVENTORY + [LUN_UID]
+
+    def __init__(self, ip, key_path, executor=None, cache=None,
+                 output_format='text', metrics=None, naviseccli_path=CLI_PATH,
+                 debug=False, snapshot=None):
+        """
+        :param snapshot: A ``SnapshotReader`` to answer inventory queries
+            from instead of running ``naviseccli``, when it is recent
+            enough, or ``None``.
+        """
         self.ip = ip
         self.key_path = key_path
-        self.cli = (CLI_PATH, '-h', self.ip, '-secfilepath', self.key_path)
+        try:
+            self.output = OUTPUT_FORMATS[output_format](
+                keep_raw_output=debug
+            )
+        except KeyError:
+            raise ValueError(
+                "Unknown naviseccli output format", output_format
+            )
+        self.cli = (
+            (naviseccli_path, '-h', self.ip, '-secfilepath', self.key_path) +
+            self.output.cli_options
+        )
+        if executor is None:
+            executor = SerialExecutor()
+        self.executor = executor
+        if cache is None:
+            cache = TTLCache()
+        self.cache = cache
+        self.flights = SingleFlight()
+        self.snapshot = snapshot
+        # When this client last changed the array.  Snapshots taken before
+        # then may not show the change.
+        self._changed_at = 0
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        metrics.add_collector(self._collect_metrics)
+        self.readiness = ReadinessTracker(self)
 
         # This is a temporary fencing solution for a specific POC.
         # Please do not set ``base_lun`` for generic VNX usage.
         # self.next_lun = base_lun
 
+    def _list_command(self, obj, selector, props):
+        """
+        Build a ``-list`` command which asks the array to display only the
+        properties in ``props``.
+
+        :param str obj: The kind of object to list, eg ``lun``.
+        :param tuple selector: Arguments which choose the objects to list.
+        :param list props: The ``PropertyDescriptor`` instances to display.
+        """
+        options = []
+        for prop in props:
+            if prop.option is not None and prop.option not in options:
+                options.append(prop.option)
+        return self.cli + (obj, '-list') + selector + tuple(options)
+
     def check_pool(self, name):
-        cmd = self.cli + ('storagepool', '-list', '-name', name)
-        data = self._get_obj_props(cmd, [self.POOL_NAME])
-        return data != {}
-
-    def get_lun_by_name(self, name):
-        cmd = self.cli + ('lun', '-list', '-name', name)
-        return self._get_obj_props(cmd, self.LUN_ALL)
-
-    def get_all_luns(self):
-        cmd = self.cli + ('lun', '-list')
-        rc, out, err = execute(*cmd)
-        luns = []
-        if rc == 0:
-            raw_luns = out.split('\n\n')
-            for each in raw_luns:
-                if each == '':
-                    continue
-                lun = {
-                    prop.key:
-                        self._get_prop_value(each, prop)
-                    for prop in self.LUN_ALL
-                }
-                luns.append(lun)
+        props = [self.POOL_NAME]
+        cmd = self._list_command('storagepool', ('-name', name), props)
+        data = self._get_obj_props(cmd, props, self.POOL_NAME, Pool)
+        return data is not None
+
+    def get_lun_by_name(self, name, properties=None):
+        """
+        :returns: A ``LUN`` with ``properties``, or ``None`` if there is no
+            such LUN.
+        """
+        if properties is None:
+            properties = self.LUN_ALL
+        shared = self._shared(properties)
+        if shared is not None:
+            lun = shared.lun(name)
+            if lun is not None:
+                return lun
+        key = ('lun', name, tuple(prop.key for prop in properties))
+        lun = self.cache.get(key)
+        if lun is None:
+            generation = self.cache.generation()
+            lun = self.flights.do(
+                key + (generation,),
+                lambda: self._submit_lun_by_name(name, properties, key,
+                                                 generation)
+            )
+        return lun
+
+    def _submit_lun_by_name(self, name, properties, key, generation):
+        def store(result):
+            lun = self._parse_obj_props(result, properties, self.LUN_ID, LUN)
+            if lun is not None:
+                self.cache.set(key, lun, generation)
+            return lun
+        cmd = self._list_command('lun', ('-name', name), properties)
+        return chain(self._submit(cmd), store)
+
+    def _execute(self, cmd):
+        return self._submit(cmd).result()
+
+    def _submit(self, cmd, parse=None):
+        """
+        Submit ``cmd`` to the executor, recording its latency, return code
+        and the size of its output against its subcommand, eg ``lun -list``.
+        """
+        subcommand = ' '.join(cmd[len(self.cli):len(self.cli) + 2])
+        size = [0]
+        if parse is not None:
+            original = parse
+
+            def parse(lines):
+                return original(_counted(lines, size))
+        start = time.time()
+
+        def record(pending):
+            self.metrics.observe(
+                'flocker_vnx_naviseccli_seconds', time.time() - start,
+                subcommand=subcommand,
+            )
+            if pending._exc_info is not None:
+                rc = 'error'
+            else:
+                rc, out, err = pending._value
+                if parse is None:
+                    size[0] = len(out)
+            self.metrics.increment(
+                'flocker_vnx_naviseccli_commands_total',
+                subcommand=subcommand, rc=rc,
+            )
+            self.metrics.increment(
+                'flocker_vnx_naviseccli_output_bytes_total', size[0],
+                subcommand=subcommand,
+            )
+        pending = self.executor.submit(cmd, parse)
+        pending.add_callback(record)
+        return pending
+
+    def _collect_metrics(self):
+        yield COUNTER, 'flocker_vnx_cache_hits_total', {}, self.cache.hits
+        yield COUNTER, 'flocker_vnx_cache_misses_total', {}, self.cache.misses
+        for kind, stats in self.flights.stats().items():
+            for stat, value in stats.items():
+                yield (
+                    COUNTER, 'flocker_vnx_singleflight_{}_total'.format(stat),
+                    {'query': kind}, value,
+                )
+        yield (
+            GAUGE, 'flocker_vnx_executor_queue_depth', {},
+            self.executor.queue_depth,
+        )
+        yield (
+            GAUGE, 'flocker_vnx_executor_in_flight', {},
+            self.executor.in_flight,
+        )
+        if hasattr(self.executor, 'stats'):
+            for priority, stats in self.executor.stats().items():
+                for stat, value in stats.items():
+                    if stat in _SCHEDULER_GAUGES:
+                        kind, name = GAUGE, stat
+                    else:
+                        kind, name = COUNTER, stat + '_total'
+                    yield (
+                        kind, 'flocker_vnx_scheduler_' + name,
+                        {'priority': priority}, value,
+                    )
+        yield (
+            COUNTER, 'flocker_vnx_readiness_polls_total', {},
+            self.readiness.polls,
+        )
+        if self.snapshot is not None:
+            yield (
+                COUNTER, 'flocker_vnx_snapshot_hits_total', {},
+                self.snapshot.hits,
+            )
+            yield (
+                COUNTER, 'flocker_vnx_snapshot_misses_total', {},
+                self.snapshot.misses,
+            )
+
+    def _shared(self, properties):
+        """
+        :returns: The shared ``Snapshot`` if it lists ``properties`` of each
+            LUN and is recent enough, or ``None``.
+        """
+        if self.snapshot is None:
+            return None
+        return self.snapshot.read(
+            frozenset(prop.key for prop in properties), self._changed_at
+        )
+
+    def _invalidate_lun(self, name):
+        self._changed_at = time.time()
+        self.cache.invalidate(
+            lambda key: key[0] == 'luns' or key[:2] == ('lun', name)
+        )
+
+    def _invalidate_storage_groups(self, name=None):
+        """
+        Discard cached storage group listings, either for the group called
+        ``name`` or, if ``name`` is ``None``, for every group.
+        """
+        self._changed_at = time.time()
+        self.cache.invalidate(
+            lambda key: key == _ALL_STORAGE_GROUPS or (
+                key[0] == 'storage_group' and name in (None, key[1])
+            )
+        )
+
+    def get_all_luns(self, properties=None):
+        if properties is None:
+            properties = self.LUN_ALL
+        shared = self._shared(properties)
+        if shared is not None:
+            return shared.luns
+        luns = self.cache.get(self._all_luns_key(properties))
+        if luns is None:
+            generation = self.cache.generation()
+            luns = self._all_luns_flight(properties, generation).result()
+        return luns
+
+    def get_inventory(self, properties=None):
+        """
+        Fetch every LUN and every storage group on the array.
+
+        The two queries are submitted together so that an executor with more
+        than one worker runs them concurrently.
+
+        :param list properties: The LUN ``PropertyDescriptor`` instances to
+            fetch.
+        :returns: A ``tuple`` of the results of ``get_all_luns`` and
+            ``storage_groups``.
+        """
+        if properties is None:
+            properties = self.LUN_ALL
+        shared = self._shared(properties)
+        if shared is not None:
+            return shared.luns, shared.storage_groups
+        generation = self.cache.generation()
+        luns = self.cache.get(self._all_luns_key(properties))
+        groups = self.cache.get(_ALL_STORAGE_GROUPS)
+        if luns is None:
+            pending_luns = self._all_luns_flight(properties, generation)
+        if groups is None:
+            pending_groups = self._storage_groups_flight(generation)
+        if luns is None:
+            luns = pending_luns.result()
+        if groups is None:
+            groups = pending_groups.result()
+        return luns, groups
+
+    def list_inventory(self, properties):
+        """
+        List every LUN and every storage group on the array, bypassing the
+        cache and any shared snapshot.
+
+        :returns: A ``tuple`` of a ``list`` of ``LUN`` records and a ``dict``
+            like that returned by ``storage_groups``.
+        :raises Exception: If either listing fails.
+        """
+        pending_luns = self._submit_all_luns(properties)
+        pending_groups = self._submit(self._storage_groups_command())
+        rc, luns, err = pending_luns.result()
+        groups = self._parse_storage_groups(pending_groups.result())
+        if rc != 0:
+            raise Exception(rc, err)
+        return luns, groups
+
+    def _all_luns_flight(self, properties, generation):
+        """
+        Start listing every LUN, or join a listing already running.
+        """
+        key = self._all_luns_key(properties)
+        return self.flights.submit(
+            key + (generation,),
+            lambda: chain(
+                self._submit_all_luns(properties),
+                lambda result: self._store_luns(result, properties,
+                                                generation)
+            )
+        )
+
+    def _storage_groups_flight(self, generation):
+        """
+        Start listing every storage group, or join a listing already
+        running.
+        """
+        return self.flights.submit(
+            _ALL_STORAGE_GROUPS + (generation,),
+            lambda: chain(
+                self._submit(self._storage_groups_command()),
+                lambda result: self._store_storage_groups(result, generation)
+            )
+        )
+
+    def _store_luns(self, result, properties, generation):
+        rc, luns, err = result
+        if rc != 0:
+            return []
+        self.cache.set(self._all_luns_key(properties), luns, generation)
         return luns
 
-    def _get_obj_props(self, cmd, props):
-        rc, out, err = execute(*cmd)
-        data = {}
+    def _store_storage_groups(self, result, generation):
+        groups = self._parse_storage_groups(result)
+        self.cache.set(_ALL_STORAGE_GROUPS, groups, generation)
+        return groups
+
+    def _all_luns_key(self, properties):
+        return ('luns', tuple(prop.key for prop in properties))
+
+    def _submit_all_luns(self, properties):
+        """
+        Start listing every LUN, parsing the output as it is produced.
+        """
+        return self._submit(
+            self._list_command('lun', (), properties),
+            lambda lines: list(
+                self.output.records(properties, self.LUN_ID, lines, LUN)
+            )
+        )
+
+    def _get_obj_props(self, cmd, props, start, record_type):
+        return self._parse_obj_props(
+            self._execute(cmd), props, start, record_type
+        )
+
+    def _parse_obj_props(self, result, props, start, record_type):
+        rc, out, err = result
+        data = None
         if rc == 0:
-            data = {
-                prop.key:
-                    self._get_prop_value(out, prop)
-                for prop in props
-            }
+            data = self.output.parse_one(
+                props, start, out.splitlines(True), record_type
+            )
         return data
 
-    def _get_prop_value(self, out, prop):
-        label = prop.label
-        m = re.search(label, out)
-        if m:
-            if (prop.converter is not None):
-                try:
-                    return prop.converter(m.group(1))
-                except ValueError:
-                    return None
-            else:
-                return m.group(1)
-        else:
-            return None
-
     def create_volume(self, name, size, pool):
         # TODO: pass in lun number (below) for lun fencing.
         # '-poolName', pool, '-l', self.next_lun, '-name', name)
         cmd = ('lun', '-create', '-capacity', size, '-sq', 'gb',
                '-poolName', pool, '-name', name)
         cmd = self.cli + cmd
-        rc, out, err = execute(*cmd)
+        rc, out, err = self._execute(cmd)
+        self._invalidate_lun(name)
         # self.next_lun = self.next_lun + 1
         return rc, out
 
+    def get_lun_states(self):
+        """
+        List the state of every LUN, bypassing the cache.
+
+        :returns: A ``tuple`` of the return code and a ``list`` of records
+            with ``lun_name``, ``lun_id`` and ``state``.
+        """
+        return self.list_luns([self.LUN_NAME, self.LUN_ID, self.LUN_STATE])
+
+    def list_luns(self, properties):
+        """
+        List every LUN, bypassing the cache and any shared snapshot.
+
+        :returns: A ``tuple`` of the return code and a ``list`` of ``LUN``
+            records.
+        """
+        rc, luns, err = self._submit_all_luns(properties).result()
+        return rc, luns
+
     def wait_for_volume(self, name, timeout=300):
-        start = time.time()
-        while time.time() - start < timeout:
-            lun = self.get_lun_by_name(name)
-            if not lun:
-                return
-            elif lun['state'] in ['Ready', 'Faulted']:
-                return
-        raise Exception('Timeout when waiting for a volume')
+        """
+        Wait for a LUN to become ready or faulted, or to disappear.
+        """
+        if name not in self.readiness.wait([name], timeout):
+            raise Exception('Timeout when waiting for a volume')
 
     def destroy_volume(self, name):
-        cmd = ('lun', '-destroy', '-name', name,
-               '-forceDetach', '-o')
-        rc, out, err = execute(*(self.cli + cmd))
+        return self.destroy_volumes([name])[0]
+
+    def destroy_volumes(self, names):
+        """
+        Destroy several LUNs, submitting every command before waiting for any
+        of them.
+
+        :returns: A ``list`` of ``(rc, out)`` for each LUN, in order.
+        """
+        def invalidate():
+            for name in names:
+                self._invalidate_lun(name)
+            # ``-forceDetach`` also removes the LUN from its storage group.
+            self._invalidate_storage_groups()
+        return self._pipeline(
+            [('lun', '-destroy', '-name', name, '-forceDetach', '-o')
+             for name in names],
+            invalidate
+        )
+
+    def rename_volume(self, name, new_name):
+        cmd = ('lun', '-modify', '-name', name, '-newName', new_name, '-o')
+        rc, out, err = self._execute(self.cli + cmd)
+        self._invalidate_lun(name)
+        self._invalidate_lun(new_name)
         return rc, out
 
     def create_storage_group(self, name):
         cmd = ('storagegroup', '-create', '-gname', name)
-        rc, out, err = execute(*(self.cli + cmd))
+        rc, out, err = self._execute(self.cli + cmd)
         return rc, out
 
     def get_storage_group(self, name):
+        key = ('storage_group', name)
+        result = self.cache.get(key)
+        if result is None:
+            generation = self.cache.generation()
+            result = self.flights.do(
+                key + (generation,),
+                lambda: self._submit_storage_group(name, key, generation)
+            )
+        return result
+
+    def _submit_storage_group(self, name, key, generation):
+        def store(result):
+            rc, out, err = result
+            if rc == 0:
+                self.cache.set(key, (rc, out), generation)
+            return rc, out
         cmd = ('storagegroup', '-list', '-gname', name,
                '-host', '-iscsiAttributes')
-        rc, out, err = execute(*(self.cli + cmd))
-        return rc, out
+        return chain(self._submit(self.cli + cmd), store)
 
     def storage_groups(self):
-        cmd = ('storagegroup', '-list', '-host', '-iscsiAttributes')
-        rc, out, err = execute(*(self.cli + cmd))
+        shared = self._shared(())
+        if shared is not None:
+            return shared.storage_groups
+        groups = self.cache.get(_ALL_STORAGE_GROUPS)
+        if groups is None:
+            generation = self.cache.generation()
+            groups = self._storage_groups_flight(generation).result()
+        return groups
+
+    def _storage_groups_command(self):
+        return self.cli + (
+            'storagegroup', '-list', '-host', '-iscsiAttributes'
+        )
+
+    def _parse_storage_groups(self, result):
+        rc, out, err = result
         if rc != 0:
             raise Exception(rc, out, err)
-        groups = {}
-        for group_content in out.split('Storage Group Name:    '):
-            group_name, group_content = group_content.split('\n', 1)
-            group_name = group_name.strip()
-            group_info = self.parse_sg_content(group_content)
-            groups[group_name] = group_info
-        return groups
+        return self.output.storage_groups(out)
 
     def parse_sg_content(self, content):
-        lun_map = {}
-        data = {'storage_group_uid': None,
-                'lunmap': lun_map,
-                'raw_output': ''}
-        data['raw_output'] = content
-        re_storage_group_id = 'Storage Group UID:\s*(.*)\s*'
-        m = re.search(re_storage_group_id, content)
-        if m is not None:
-            data['storage_group_uid'] = m.group(1)
-
-        re_hlu_alu_pair = 'HLU\/ALU Pairs:\s*HLU Number' \
-                          '\s*ALU Number\s*[-\s]*(?P<lun_details>(\d+\s*)+)'
-        m = re.search(re_hlu_alu_pair, content)
-        if m is not None:
-            lun_details = m.group('lun_details').strip()
-            values = re.split('\s*', lun_details)
-            while (len(values) >= 2):
-                key = values.pop()
-                value = values.pop()
-                lun_map[int(key)] = int(value)
-        return data
+        return self.output.storage_group(content)
 
     def add_volume_to_sg(self, hlu, alu, sg_name):
-        cmd = ('storagegroup', '-addhlu', '-hlu', hlu,
-               '-alu', alu, '-gname', sg_name, '-o')
-        rc, out, err = execute(*(self.cli + cmd))
-        return rc, out
+        return self.add_volumes_to_sg([(hlu, alu)], sg_name)[0]
+
+    def add_volumes_to_sg(self, hlu_alu_pairs, sg_name):
+        """
+        Add several LUNs to a storage group, submitting every command before
+        waiting for any of them.
+
+        :param list hlu_alu_pairs: ``(hlu, alu)`` ``tuple`` instances.
+        :returns: A ``list`` of ``(rc, out)`` for each pair, in order.
+        """
+        return self._pipeline(
+            [('storagegroup', '-addhlu', '-hlu', hlu,
+              '-alu', alu, '-gname', sg_name, '-o')
+             for hlu, alu in hlu_alu_pairs],
+            lambda: self._invalidate_storage_groups(sg_name)
+        )
 
     def remove_volume_from_sg(self, hlu, sg_name):
-        cmd = ('storagegroup', '-removehlu', '-hlu', hlu,
-               '-gname', sg_name, '-o')
-        rc, out, err = execute(*(self.cli + cmd))
-        return rc, out
+        return self.remove_volumes_from_sg([hlu], sg_name)[0]
+
+    def remove_volumes_from_sg(self, hlus, sg_name):
+        """
+        Remove several LUNs from a storage group, submitting every command
+        before waiting for any of them.
+
+        :returns: A ``list`` of ``(rc, out)`` for each HLU, in order.
+        """
+        return self._pipeline(
+            [('storagegroup', '-removehlu', '-hlu', hlu,
+              '-gname', sg_name, '-o')
+             for hlu in hlus],
+            lambda: self._invalidate_storage_groups(sg_name)
+        )
+
+    def _pipeline(self, cmds, invalidate):
+        """
+        Submit every one of ``cmds`` and then collect their results, calling
+        ``invalidate`` once they have all finished.
+        """
+        pending = [self._submit(self.cli + cmd) for cmd in cmds]
+        results = []
+        try:
+            for result in pending:
+                rc, out, err = result.result()
+                results.append((rc, out))
+        finally:
+            invalidate()
+        return results
 
     def connect_host_to_sg(self, host, sg_name):
         cmd = ('storagegroup', '-connecthost', '-host', host,
                '-gname', sg_name, '-o')
-        rc, out, err = execute(*(self.cli + cmd))
+        rc, out, err = self._execute(self.cli + cmd)
         return rc, out
 
     def get_iscsi_targets(self):
         cmd = ('connection', '-getport', '-address', '-vlanid')
-        rc, out, err = execute(*(self.cli + cmd))
+        rc, out, err = self._execute(self.cli + cmd)
         if rc != 0:
             raise Exception("Get port failed")
-        iscsi_target_dict = {'A': [], 'B': []}
-        iscsi_spport_pat = r'(A|B)\s*' + \
-                           r'Port ID:\s+(\d+)\s*' + \
-                           r'Port WWN:\s+(iqn\S+)'
-        iscsi_vport_pat = r'Virtual Port ID:\s+(\d+)\s*' + \
-                          r'VLAN ID:\s*\S*\s*' + \
-                          r'IP Address:\s+(\S+)'
-        for spport_content in re.split(r'^SP:\s+|\nSP:\s*', out):
-            m_spport = re.match(iscsi_spport_pat, spport_content,
-                                flags=re.IGNORECASE)
-            if not m_spport:
-                continue
-            sp = m_spport.group(1)
-            port_id = int(m_spport.group(2))
-            iqn = m_spport.group(3)
-            for m_vport in re.finditer(iscsi_vport_pat, spport_content):
-                vport_id = int(m_vport.group(1))
-                ip_addr = m_vport.group(2)
-                if ip_addr.find('N/A') != -1:
-                    continue
-                iscsi_target_dict[sp].append({'SP': sp,
-                                              'Port ID': port_id,
-                                              'Port WWN': iqn,
-                                              'Virtual Port ID': vport_id,
-                                              'IP Address': ip_addr})
-        return iscsi_target_dict
+        return self.output.iscsi_targets(out)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,682 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+A stand-in for ``naviseccli`` which keeps an emulated VNX array in a local
+file, so that the driver can be exercised and load tested without an array.
+
+The emulator answers the commands which ``EMCVNXClient`` issues, in either
+text or ``-xml`` output, with configurable latency and injected failures.
+A storage group can be bound to fake ``sys`` and ``dev`` trees, as made by
+``make_host_tree``, in which the devices of the LUNs added to that group
+then appear when the host scans, as they would on a real node.
+"""
+
+import fcntl
+import json
+import os
+import random
+import re
+import stat
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from xml.sax.saxutils import escape, quoteattr
+
+from twisted.python.filepath import FilePath
+
+# Return codes, as given by the real ``naviseccli``.
+RC_LUN_BUSY = 8
+RC_NO_SUCH_LUN = 9
+RC_HLU_CONFLICT = 66
+RC_NO_SUCH_STORAGE_GROUP = 83
+RC_ERROR = 1
+
+_MESSAGES = {
+    RC_LUN_BUSY: 'The LUN is busy and cannot be destroyed at this time.\n',
+    RC_NO_SUCH_LUN: (
+        'Could not retrieve the specified (pool lun). '
+        'The (pool lun) may not exist\n'
+    ),
+    RC_HLU_CONFLICT: (
+        'An attempt to add a LUN to the storage group failed because the '
+        'host LUN number or the LUN is already in use.\n'
+    ),
+    RC_NO_SUCH_STORAGE_GROUP: (
+        'The group name or UID does not match any storage groups for this '
+        'array\n'
+    ),
+}
+
+
+def _failed(rc):
+    return rc, _MESSAGES.get(rc, 'Injected failure.\n')
+
+
+# The directory containing this package, for the scripts which run it.
+_PACKAGE_ROOT = FilePath(__file__).parent().parent()
+
+# Options which select the array and credentials rather than the command.
+_GLOBAL_OPTIONS = frozenset([
+    '-h', '-secfilepath', '-user', '-password', '-scope', '-port',
+])
+
+# Global options which take no value.
+_GLOBAL_FLAGS = frozenset(['-xml'])
+
+_XML_HEADER = (
+    '<?xml version="1.0" encoding="utf-8" ?>\n'
+    '<CIM CIMVERSION="2.0" DTDVERSION="2.0">\n'
+    '<MESSAGE ID="1" PROTOCOLVERSION="1.0">\n'
+    '<SIMPLERSP>\n'
+    '<METHODRESPONSE NAME="ExecuteCommand">\n'
+)
+_XML_FOOTER = '</METHODRESPONSE>\n</SIMPLERSP>\n</MESSAGE>\n</CIM>\n'
+
+
+def lun_uid(alu):
+    """
+    :returns: The UID of the emulated LUN ``alu``, in ``naviseccli``'s
+        colon separated form.
+    """
+    digits = '600601601E003600{:016X}'.format(alu)
+    return ':'.join(digits[i:i + 2] for i in range(0, len(digits), 2))
+
+
+def disk_name(index):
+    """
+    :returns: The ``index``th SCSI disk name, as the kernel assigns them:
+        ``sda`` ... ``sdz``, ``sdaa`` ...
+    """
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('a') + remainder) + letters
+    return 'sd' + letters
+
+
+def make_host_tree(root, fc_hosts=(1,)):
+    """
+    Create empty ``sys`` and ``dev`` trees under ``root`` with the given FC
+    hosts, for a storage group bound with ``VNXEmulator.bind_host``.
+
+    :returns: A ``tuple`` of the ``sys`` and ``dev`` ``FilePath`` objects.
+    """
+    sysfs = root.child('sys')
+    dev = root.child('dev')
+    for directory in (
+        dev, sysfs.child('block'), sysfs.descendant(['class', 'scsi_disk']),
+        sysfs.descendant(['bus', 'scsi', 'drivers', 'sd']),
+    ):
+        directory.makedirs()
+    for host in fc_hosts:
+        for host_class in ('fc_host', 'scsi_host'):
+            host_directory = sysfs.descendant(
+                ['class', host_class, 'host{}'.format(host)]
+            )
+            host_directory.makedirs()
+            if host_class == 'scsi_host':
+                host_directory.child('scan').touch()
+    return sysfs, dev
+
+
+def _parse(args):
+    """
+    :returns: A ``tuple`` of the object and action of a command, eg
+        ``('lun', '-list')``, and a ``dict`` of its options.  Options which
+        aren't followed by a value, such as ``-uid``, map to ``True``.
+    """
+    args = list(args)
+    words = []
+    options = {}
+    while args:
+        arg = args.pop(0)
+        if arg in _GLOBAL_OPTIONS:
+            del args[:1]
+        elif arg in _GLOBAL_FLAGS:
+            options[arg] = True
+        elif len(words) < 2:
+            words.append(arg)
+        elif args and not args[0].startswith('-'):
+            options[arg] = args.pop(0)
+        else:
+            options[arg] = True
+    words += [''] * (2 - len(words))
+    return tuple(words), options
+
+
+def _text_properties(out):
+    """
+    :returns: A generator of the ``(label, value)`` of each property in the
+        text output of a command, in order.  Each row of a storage group's
+        HLU/ALU table gives an ``HLU Number`` and an ``ALU Number``.
+    """
+    in_pairs = False
+    for line in out.splitlines():
+        lun = re.match(r'LOGICAL UNIT NUMBER (\d+)$', line)
+        pair = re.match(r'\s*(\d+)\s+(\d+)$', line)
+        if lun is not None:
+            yield 'LOGICAL UNIT NUMBER', lun.group(1)
+        elif in_pairs and pair is not None:
+            yield 'HLU Number', pair.group(1)
+            yield 'ALU Number', pair.group(2)
+        elif ':' in line:
+            label, value = [part.strip() for part in line.split(':', 1)]
+            in_pairs = label == 'HLU/ALU Pairs'
+            if value:
+                yield label, value
+
+
+def _xml(out):
+    """
+    :returns: The ``-xml`` form of text output, in which each property is a
+        ``PARAMVALUE`` element named after its label.
+    """
+    return _XML_HEADER + ''.join(
+        '<PARAMVALUE NAME={} TYPE="string"><VALUE>{}</VALUE>\n'
+        '</PARAMVALUE>\n'.format(quoteattr(label), escape(value))
+        for label, value in _text_properties(out)
+    ) + _XML_FOOTER
+
+
+class VNXEmulator(object):
+    """
+    An emulated VNX array, kept in the file at ``path``.
+
+    Every invocation locks the file, shared for queries and exclusively for
+    changes, so concurrent ``naviseccli`` processes see a consistent array.
+
+    The ``config`` of an emulator may contain:
+
+    ``latency``: Maps subcommands, eg ``"lun -list"``, or ``"*"`` for all
+        others, to seconds to sleep before answering.
+    ``faults``: Maps subcommands to a ``list`` of return codes which the next
+        invocations will fail with, in order.
+    ``fault_rates``: Maps subcommands to a ``dict`` of return codes and the
+        probability of each being returned instead of running the command.
+    ``ready_after``: Seconds for which a new LUN is ``Initializing``.
+    """
+    def __init__(self, path, clock=time.time, sleep=time.sleep,
+                 random=random.random):
+        self.path = path
+        self._clock = clock
+        self._sleep = sleep
+        self._random = random
+
+    def create(self, pools=('pool',), storage_groups=()):
+        """
+        Start a new, empty array.
+        """
+        with self._state(exclusive=True, create=True) as state:
+            state.clear()
+            state.update({
+                'pools': list(pools),
+                'luns': {},
+                'next_alu': 0,
+                'groups': {},
+                'config': {},
+            })
+            for name in storage_groups:
+                self._create_group(state, name)
+
+    def add_luns(self, names, capacity=8.0, pool='pool'):
+        """
+        Create many LUNs at once, without a ``naviseccli`` command each.
+
+        :returns: A ``list`` of the ALUs of the new LUNs, in order.
+        """
+        with self._state(exclusive=True) as state:
+            created = self._clock()
+            alus = []
+            for name in names:
+                alu = state['next_alu']
+                state['next_alu'] += 1
+                state['luns'][name] = {
+                    'alu': alu, 'capacity': float(capacity), 'pool': pool,
+                    'created': created,
+                }
+                alus.append(alu)
+            return alus
+
+    def add_hlus(self, storage_groups):
+        """
+        Add many LUNs to storage groups at once, creating the groups if need
+        be.
+
+        :param dict storage_groups: Maps storage group names to a ``list`` of
+            the ``(hlu, alu)`` pairs to add to each.
+        """
+        with self._state(exclusive=True) as state:
+            for name, hlu_alu_pairs in storage_groups.items():
+                if name not in state['groups']:
+                    self._create_group(state, name)
+                hlus = state['groups'][name]['hlus']
+                for hlu, alu in hlu_alu_pairs:
+                    hlus[str(hlu)] = alu
+
+    def configure(self, **config):
+        """
+        Update the ``config`` of the array.
+        """
+        with self._state(exclusive=True) as state:
+            state['config'].update(config)
+
+    def bind_host(self, storage_group, sysfs, dev):
+        """
+        Show the LUNs in ``storage_group`` as devices in the trees ``sysfs``
+        and ``dev``, on every FC host found there, once the host scans.
+
+        :returns: A ``HostBridge`` which watches for scans.  It must be
+            started.
+        """
+        with self._state(exclusive=True) as state:
+            group = state['groups'][storage_group]
+            group['host'] = {
+                'sysfs': sysfs.path, 'dev': dev.path, 'devices': {},
+                'pending': {}, 'next_disk': 0,
+            }
+        return HostBridge(self, storage_group, sysfs)
+
+    def scanned(self, storage_group):
+        """
+        Show the devices of every LUN added to the bound ``storage_group``
+        since its host last scanned.
+        """
+        with self._state(exclusive=True) as state:
+            host = state['groups'][storage_group]['host']
+            pending, host['pending'] = host['pending'], {}
+            for hlu, (alu, capacity) in sorted(
+                pending.items(), key=lambda item: int(item[0])
+            ):
+                self._add_devices(host, int(hlu), alu, capacity)
+
+    def write_script(self, path):
+        """
+        Write an executable at ``path`` which runs this emulator, for use as
+        the ``naviseccli_path`` of the driver.
+        """
+        path.setContent(
+            '#!{python}\n'
+            'import sys\n'
+            'sys.path.insert(0, {package!r})\n'
+            'from flocker_emc_vnx_driver._emulator import main\n'
+            'main(sys.argv[1:], {state!r})\n'.format(
+                python=sys.executable, package=_PACKAGE_ROOT.path,
+                state=self.path.path,
+            )
+        )
+        path.chmod(
+            stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH |
+            stat.S_IXOTH
+        )
+
+    @contextmanager
+    def _state(self, exclusive, create=False):
+        flags = os.O_RDWR | (os.O_CREAT if create else 0)
+        fd = os.open(self.path.path, flags, 0o644)
+        with os.fdopen(fd, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                content = f.read()
+                state = json.loads(content) if content else {}
+                yield state
+                if exclusive:
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(state, f, separators=(',', ':'))
+                    f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def execute(self, args):
+        """
+        Run one ``naviseccli`` command line.
+
+        :param list args: The arguments, without the program name.
+        :returns: A ``tuple`` of the return code and output.
+        """
+        (obj, action), options = _parse(args)
+        xml = options.pop('-xml', False)
+        subcommand = '{} {}'.format(obj, action)
+        handler, mutates = _COMMANDS.get((obj, action), (None, False))
+        if handler is None:
+            return RC_ERROR, 'Unsupported command: {}\n'.format(subcommand)
+        with self._state(exclusive=False) as state:
+            config = state['config']
+        delay = config.get('latency', {}).get(
+            subcommand, config.get('latency', {}).get('*', 0)
+        )
+        if delay:
+            self._sleep(delay)
+        queued = config.get('faults', {}).get(subcommand)
+        with self._state(exclusive=mutates or bool(queued)) as state:
+            rc = self._fault(state['config'], subcommand)
+            if rc is not None:
+                return _failed(rc)
+            rc, out = handler(self, state, options)
+        if xml and rc == 0:
+            out = _xml(out)
+        return rc, out
+
+    def _fault(self, config, subcommand):
+        queued = config.get('faults', {}).get(subcommand)
+        if queued:
+            return queued.pop(0)
+        rates = config.get('fault_rates', {}).get(subcommand, {})
+        for rc, probability in sorted(rates.items()):
+            if self._random() < probability:
+                return int(rc)
+        return None
+
+    def _create_group(self, state, name):
+        state['groups'][name] = {
+            'uid': lun_uid(len(state['groups']) + 0xFFFF0000),
+            'hlus': {},
+            'host': None,
+        }
+
+    def _lun_state(self, state, lun):
+        ready_after = state['config'].get('ready_after', 0)
+        if self._clock() < lun['created'] + ready_after:
+            return 'Initializing'
+        return 'Ready'
+
+    def _luns_by_alu(self, state):
+        return {lun['alu']: name for name, lun in state['luns'].items()}
+
+    def _format_lun(self, state, name, lun, options):
+        lines = [
+            'LOGICAL UNIT NUMBER {}'.format(lun['alu']),
+            'Name:  {}'.format(name),
+        ]
+        if '-uid' in options:
+            lines.append('UID:  {}'.format(lun_uid(lun['alu'])))
+        if '-state' in options:
+            lines.append(
+                'Current State:  {}'.format(self._lun_state(state, lun))
+            )
+        if '-status' in options:
+            lines.append('Status:  OK(0x0)')
+        if '-userCap' in options:
+            lines.append(
+                'User Capacity (GBs):  {:.3f}'.format(lun['capacity'])
+            )
+        return ''.join(line + '\n' for line in lines) + '\n'
+
+    def _lun_list(self, state, options):
+        if '-name' in options:
+            lun = state['luns'].get(options['-name'])
+            if lun is None:
+                return _failed(RC_NO_SUCH_LUN)
+            return 0, self._format_lun(state, options['-name'], lun, options)
+        return 0, ''.join(
+            self._format_lun(state, name, lun, options)
+            for name, lun in sorted(
+                state['luns'].items(), key=lambda item: item[1]['alu']
+            )
+        )
+
+    def _lun_create(self, state, options):
+        name = options.get('-name')
+        if options.get('-poolName') not in state['pools']:
+            return RC_ERROR, 'The specified pool does not exist.\n'
+        if name in state['luns']:
+            return RC_ERROR, 'The LUN name is already in use.\n'
+        alu = state['next_alu']
+        state['next_alu'] += 1
+        state['luns'][name] = {
+            'alu': alu,
+            'capacity': float(options['-capacity']),
+            'pool': options['-poolName'],
+            'created': self._clock(),
+        }
+        return 0, ''
+
+    def _lun_destroy(self, state, options):
+        lun = state['luns'].get(options.get('-name'))
+        if lun is None:
+            return _failed(RC_NO_SUCH_LUN)
+        for group in state['groups'].values():
+            for hlu, alu in group['hlus'].items():
+                if alu == lun['alu']:
+                    if '-forceDetach' not in options:
+                        return _failed(RC_LUN_BUSY)
+                    self._remove_hlu(group, hlu)
+        del state['luns'][options['-name']]
+        return 0, ''
+
+    def _lun_modify(self, state, options):
+        name = options.get('-name')
+        new_name = options.get('-newName')
+        if name not in state['luns']:
+            return _failed(RC_NO_SUCH_LUN)
+        if new_name in state['luns']:
+            return RC_ERROR, 'The LUN name is already in use.\n'
+        state['luns'][new_name] = state['luns'].pop(name)
+        return 0, ''
+
+    def _format_group(self, name, group):
+        lines = [
+            'Storage Group Name:    {}'.format(name),
+            'Storage Group UID:     {}'.format(group['uid']),
+        ]
+        if group['hlus']:
+            lines += [
+                'HLU/ALU Pairs:',
+                '',
+                '  HLU Number     ALU Number',
+                '  ----------     ----------',
+            ]
+            for hlu, alu in sorted(
+                group['hlus'].items(), key=lambda item: int(item[0])
+            ):
+                lines.append('    {:<16}{}'.format(hlu, alu))
+        lines.append('Shareable:             YES')
+        return ''.join(line + '\n' for line in lines) + '\n'
+
+    def _storagegroup_list(self, state, options):
+        if '-gname' in options:
+            group = state['groups'].get(options['-gname'])
+            if group is None:
+                return _failed(RC_NO_SUCH_STORAGE_GROUP)
+            return 0, self._format_group(options['-gname'], group)
+        return 0, ''.join(
+            self._format_group(name, group)
+            for name, group in sorted(state['groups'].items())
+        )
+
+    def _storagegroup_create(self, state, options):
+        if options.get('-gname') in state['groups']:
+            return RC_ERROR, 'The storage group already exists.\n'
+        self._create_group(state, options['-gname'])
+        return 0, ''
+
+    def _storagegroup_addhlu(self, state, options):
+        group = state['groups'].get(options.get('-gname'))
+        if group is None:
+            return _failed(RC_NO_SUCH_STORAGE_GROUP)
+        hlu, alu = options.get('-hlu'), int(options.get('-alu'))
+        name = self._luns_by_alu(state).get(alu)
+        if name is None:
+            return _failed(RC_NO_SUCH_LUN)
+        if hlu in group['hlus'] or alu in group['hlus'].values():
+            return _failed(RC_HLU_CONFLICT)
+        group['hlus'][hlu] = alu
+        if group['host'] is not None:
+            group['host']['pending'][hlu] = [
+                alu, state['luns'][name]['capacity']
+            ]
+        return 0, ''
+
+    def _storagegroup_removehlu(self, state, options):
+        group = state['groups'].get(options.get('-gname'))
+        if group is None:
+            return _failed(RC_NO_SUCH_STORAGE_GROUP)
+        if options.get('-hlu') not in group['hlus']:
+            return RC_ERROR, 'The HLU is not in the storage group.\n'
+        self._remove_hlu(group, options['-hlu'])
+        return 0, ''
+
+    def _storagegroup_connecthost(self, state, options):
+        if options.get('-gname') not in state['groups']:
+            return _failed(RC_NO_SUCH_STORAGE_GROUP)
+        return 0, ''
+
+    def _remove_hlu(self, group, hlu):
+        del group['hlus'][hlu]
+        if group['host'] is not None:
+            group['host']['pending'].pop(hlu, None)
+            self._remove_devices(group['host'], int(hlu))
+
+    def _host_paths(self, host):
+        return FilePath(host['sysfs']), FilePath(host['dev'])
+
+    def _add_devices(self, host, hlu, alu, capacity):
+        """
+        Make the LUN ``alu`` appear at ``hlu`` on every FC host of a bound
+        storage group.
+        """
+        sysfs, dev = self._host_paths(host)
+        names = []
+        for fc_host in sorted(
+                sysfs.descendant(['class', 'fc_host']).children()
+        ):
+            bus = '{}:0:0:{}'.format(fc_host.basename()[len('host'):], hlu)
+            name = disk_name(host['next_disk'])
+            host['next_disk'] += 1
+            names.append(name)
+            sysfs.descendant(
+                ['class', 'scsi_disk', bus, 'device', 'block', name]
+            ).makedirs()
+            sysfs.descendant(['bus', 'scsi', 'drivers', 'sd', bus]).makedirs()
+            device = sysfs.descendant(['block', name, 'device'])
+            device.makedirs()
+            device.child('wwid').setContent(
+                'naa.{}\n'.format(lun_uid(alu).replace(':', '').lower())
+            )
+            # Capacity in 512 byte sectors.
+            sysfs.descendant(['block', name, 'size']).setContent(
+                '{}\n'.format(int(capacity * 2 * 1024 * 1024))
+            )
+            dev.child(name).touch()
+        host['devices'][str(hlu)] = names
+
+    def _remove_devices(self, host, hlu):
+        sysfs, dev = self._host_paths(host)
+        for name in host['devices'].pop(str(hlu), []):
+            for path in (sysfs.descendant(['block', name]), dev.child(name)):
+                if path.exists():
+                    path.remove()
+        for directory in ('class/scsi_disk', 'bus/scsi/drivers/sd'):
+            for bus in sysfs.preauthChild(directory).children():
+                if bus.basename().endswith(':{}'.format(hlu)):
+                    bus.remove()
+
+    def _storagepool_list(self, state, options):
+        name = options.get('-name')
+        if name is not None and name not in state['pools']:
+            return RC_ERROR, 'The specified pool does not exist.\n'
+        return 0, ''.join(
+            'Pool Name:  {}\nPool ID:  {}\n\n'.format(pool, index)
+            for index, pool in enumerate(state['pools'])
+            if name in (None, pool)
+        )
+
+    def _connection_getport(self, state, options):
+        out = ''
+        for sp in ('A', 'B'):
+            out += (
+                'SP:  {sp}\n'
+                'Port ID:  4\n'
+                'Port WWN:  iqn.1992-04.com.emc:cx.emulated.{lower}4\n'
+                'iSCSI Alias:  0000.{lower}4\n'
+                '\n'
+                'Virtual Port ID:  0\n'
+                'VLAN ID:  Disabled\n'
+                'IP Address:  192.0.2.{address}\n'
+                '\n'
+            ).format(sp=sp, lower=sp.lower(), address=10 + ord(sp) - ord('A'))
+        return 0, out
+
+
+class HostBridge(object):
+    """
+    Watch the ``scan`` attributes of the FC hosts in a bound host tree and,
+    whenever one is written, show the devices of the LUNs which have been
+    added to the storage group since the last scan.
+
+    Any scan shows every such LUN, not only the HLUs it named, because the
+    writes of several scans between polls can't be told apart.
+    """
+    def __init__(self, emulator, storage_group, sysfs, interval=0.01):
+        self._emulator = emulator
+        self._storage_group = storage_group
+        self._sysfs = sysfs
+        self.interval = interval
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def poll(self):
+        """
+        Check the ``scan`` attributes once.
+        """
+        written = False
+        hosts = self._sysfs.descendant(['class', 'scsi_host'])
+        for scan in hosts.globChildren('host*/scan'):
+            if scan.getsize():
+                # Empty it before showing the devices, so that a scan
+                # written meanwhile is seen on the next poll.
+                scan.setContent('')
+                written = True
+        if written:
+            self._emulator.scanned(self._storage_group)
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="vnx-emulator-host"
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopping:
+            self.poll()
+            self._wake.wait(self.interval)
+
+
+# (object, action) -> (handler, whether it changes the array)
+_COMMANDS = {
+    ('lun', '-list'): (VNXEmulator._lun_list, False),
+    ('lun', '-create'): (VNXEmulator._lun_create, True),
+    ('lun', '-destroy'): (VNXEmulator._lun_destroy, True),
+    ('lun', '-modify'): (VNXEmulator._lun_modify, True),
+    ('storagegroup', '-list'): (VNXEmulator._storagegroup_list, False),
+    ('storagegroup', '-create'): (VNXEmulator._storagegroup_create, True),
+    ('storagegroup', '-addhlu'): (VNXEmulator._storagegroup_addhlu, True),
+    ('storagegroup', '-removehlu'): (
+        VNXEmulator._storagegroup_removehlu, True
+    ),
+    ('storagegroup', '-connecthost'): (
+        VNXEmulator._storagegroup_connecthost, False
+    ),
+    ('storagepool', '-list'): (VNXEmulator._storagepool_list, False),
+    ('connection', '-getport'): (VNXEmulator._connection_getport, False),
+}
+
+
+def main(args, state):
+    """
+    Run one command against the emulated array in the file ``state`` and
+    exit with its return code.
+    """
+    rc, out = VNXEmulator(FilePath(state)).execute(args)
+    sys.stdout.write(out)
+    sys.exit(rc)
@@ -0,0 +1,237 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Engines for running ``naviseccli`` commands on behalf of ``EMCVNXClient``.
+"""
+
+import subprocess
+import sys
+import threading
+from Queue import Queue
+
+from zope.interface import Interface, implementer
+
+
+def run(cmd, parse=None):
+    """
+    Run ``cmd`` to completion in the calling thread.
+
+    :param tuple cmd: The argv of the process to run.
+    :param parse: ``None`` to collect all of stdout, or a callable which
+        will be passed an iterator over the lines of stdout as they are
+        produced and whose result replaces stdout in the returned ``tuple``.
+    :returns: A ``tuple`` of the return code, stdout (or its parsed form)
+        and stderr of the process.
+    """
+    _PIPE = subprocess.PIPE
+    obj = subprocess.Popen(
+        cmd, stdin=_PIPE, stdout=_PIPE,
+        close_fds=True, shell=False)
+    if parse is None:
+        out, err = obj.communicate()
+        return obj.returncode, out, err
+    obj.stdin.close()
+    try:
+        out = parse(iter(obj.stdout.readline, ''))
+        # Drain anything the parser didn't need so the process can exit.
+        for _ in iter(lambda: obj.stdout.read(65536), ''):
+            pass
+    finally:
+        obj.stdout.close()
+        obj.wait()
+    return obj.returncode, out, None
+
+
+class CommandResult(object):
+    """
+    The eventual outcome of a command submitted to an ``ICommandExecutor``.
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._exc_info = None
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def _complete(self, value):
+        self._value = value
+        self._finish()
+
+    def _fail(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_callback(self, callback):
+        """
+        Call ``callback`` with this object once the command has finished, at
+        once if it already has.
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def done(self):
+        """
+        :returns: ``True`` if the command has finished, ``False`` otherwise.
+        """
+        return self._done.is_set()
+
+    def result(self):
+        """
+        Block until the command has finished.
+
+        :returns: The ``(rc, out, err)`` ``tuple`` of the command.
+        :raises: Whatever exception prevented the command from running.
+        """
+        self._done.wait()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+
+def chain(pending, f):
+    """
+    :param CommandResult pending: The outcome of a command.
+    :param f: A callable to apply to the value of ``pending``.
+    :returns: A ``CommandResult`` for the value of ``f``, or for whatever
+        exception ``pending`` or ``f`` raised.
+    """
+    result = CommandResult()
+
+    def complete(pending):
+        try:
+            value = f(pending.result())
+        except:
+            result._fail(sys.exc_info())
+        else:
+            result._complete(value)
+    pending.add_callback(complete)
+    return result
+
+
+class ICommandExecutor(Interface):
+    """
+    Something which runs ``naviseccli`` processes.
+    """
+    def submit(cmd, parse=None):
+        """
+        Arrange for ``cmd`` to be run.
+
+        :param tuple cmd: The argv of the process to run.
+        :param parse: An optional callable which consumes the lines of
+            stdout as they arrive.  See ``run``.
+        :returns: A ``CommandResult``.
+        """
+
+
+@implementer(ICommandExecutor)
+class SerialExecutor(object):
+    """
+    Run every command to completion in the thread which submits it.
+    """
+    queue_depth = 0
+    in_flight = 0
+
+    def submit(self, cmd, parse=None):
+        result = CommandResult()
+        try:
+            value = run(cmd, parse)
+        except:
+            result._fail(sys.exc_info())
+        else:
+            result._complete(value)
+        return result
+
+
+_STOP = object()
+
+
+@implementer(ICommandExecutor)
+class PooledExecutor(object):
+    """
+    Run commands on a bounded pool of worker threads so that independent
+    array queries can proceed in parallel.
+
+    Workers are started lazily, on the first submission.
+
+    :ivar int workers: The maximum number of concurrent ``naviseccli``
+        processes.
+    """
+    def __init__(self, workers):
+        if workers < 1:
+            raise ValueError("workers must be at least 1", workers)
+        self.workers = workers
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._threads = []
+
+    @property
+    def queue_depth(self):
+        """
+        The number of submitted commands which have not yet started.
+        """
+        return self._queue.qsize()
+
+    @property
+    def in_flight(self):
+        """
+        The number of commands which are currently running.
+        """
+        with self._lock:
+            return self._in_flight
+
+    def submit(self, cmd, parse=None):
+        result = CommandResult()
+        self._start()
+        self._queue.put((cmd, parse, result))
+        return result
+
+    def stop(self):
+        """
+        Finish the commands already submitted and then stop all workers.
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(_STOP)
+        for thread in threads:
+            thread.join()
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._work,
+                    name="naviseccli-worker-{}".format(len(self._threads)),
+                )
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            cmd, parse, result = item
+            with self._lock:
+                self._in_flight += 1
+            try:
+                value = run(cmd, parse)
+            except:
+                result._fail(sys.exc_info())
+            else:
+                result._complete(value)
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
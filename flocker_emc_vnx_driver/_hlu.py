@@ -0,0 +1,160 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Allocation of host LUN numbers within a storage group.
+"""
+
+import fcntl
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from twisted.python.filepath import FilePath
+
+FIRST_HLU = 1
+LAST_HLU = 255
+
+RESERVATION_DIRECTORY = FilePath('/var/run/flocker_emc_vnx_driver')
+
+
+def shared_state_path(directory, name, suffix):
+    """
+    :returns: The ``FilePath`` in ``directory`` of the file holding the state
+        for ``name`` which every process on this node shares.
+    """
+    return directory.child(re.sub(r'[^A-Za-z0-9_.-]', '_', name) + suffix)
+
+
+def make_state_directory(directory):
+    """
+    Create ``directory`` if it doesn't exist yet.
+    """
+    if not directory.exists():
+        try:
+            directory.makedirs()
+        except OSError:
+            # Another process got there first.
+            pass
+
+
+class HLUsExhausted(Exception):
+    """
+    Every HLU in a storage group is in use or reserved.
+    """
+
+
+class HLUConflict(Exception):
+    """
+    The array refused every HLU chosen for a LUN because each was already in
+    use, although the LUN itself isn't in any storage group.
+    """
+
+
+def hlu_bitmap(hlus):
+    """
+    :returns: An ``int`` with the bit for each of ``hlus`` set.
+    """
+    bitmap = 0
+    for hlu in hlus:
+        bitmap |= 1 << hlu
+    return bitmap
+
+
+def lowest_free_hlu(bitmap, first=FIRST_HLU, last=LAST_HLU):
+    """
+    :param int bitmap: The HLUs which are in use, as from ``hlu_bitmap``.
+    :returns: The lowest HLU from ``first`` to ``last`` inclusive whose bit
+        isn't set, or ``None`` if there isn't one.
+    """
+    bitmap |= (1 << first) - 1
+    # The lowest clear bit of ``bitmap`` is the only bit set in this.
+    hlu = (~bitmap & (bitmap + 1)).bit_length() - 1
+    if hlu > last:
+        return None
+    return hlu
+
+
+class HLUAllocator(object):
+    """
+    Choose HLUs for the LUNs added to one storage group.
+
+    Each HLU handed out is reserved in a file shared by every process on this
+    node, so concurrent attaches choose different HLUs without waiting for
+    the array to reject all but one of them.  The lowest free HLU is always
+    chosen, so a nearly full group fails predictably with ``HLUsExhausted``.
+
+    :ivar int ttl: Seconds after which a reservation lapses.  By then the
+        HLU is either in the storage group or was never used.
+    :ivar directory: The ``FilePath`` of the directory holding the
+        reservation files of every storage group.
+    """
+    def __init__(self, storage_group, directory=RESERVATION_DIRECTORY,
+                 ttl=60, clock=time.time):
+        self.storage_group = storage_group
+        self.ttl = ttl
+        self._clock = clock
+        self.directory = directory
+        self._path = shared_state_path(directory, storage_group, '.hlu')
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _reservations(self):
+        """
+        Lock the reservation file and read it.
+
+        :returns: A context manager giving a ``dict`` mapping reserved HLUs
+            to their expiry times.  Changes made to it are written back.
+        """
+        with self._lock:
+            make_state_directory(self.directory)
+            fd = os.open(self._path.path, os.O_RDWR | os.O_CREAT, 0o644)
+            with os.fdopen(fd, 'r+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    now = self._clock()
+                    reservations = {}
+                    for line in f:
+                        try:
+                            hlu, expiry = line.split()
+                            hlu, expiry = int(hlu), float(expiry)
+                        except ValueError:
+                            continue
+                        if expiry > now:
+                            reservations[hlu] = expiry
+                    yield reservations
+                    f.seek(0)
+                    f.truncate()
+                    for hlu, expiry in sorted(reservations.items()):
+                        f.write('{} {!r}\n'.format(hlu, expiry))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def reserve(self, lunmap):
+        """
+        Choose an HLU which is neither in ``lunmap`` nor reserved, and
+        reserve it.
+
+        :param dict lunmap: The storage group's current ALU to HLU mapping.
+        :returns: The HLU.
+        :raises HLUsExhausted: If there is no such HLU.
+        """
+        with self._reservations() as reservations:
+            hlu = lowest_free_hlu(
+                hlu_bitmap(lunmap.values()) | hlu_bitmap(reservations)
+            )
+            if hlu is None:
+                raise HLUsExhausted(
+                    self.storage_group, len(lunmap), len(reservations)
+                )
+            reservations[hlu] = self._clock() + self.ttl
+        return hlu
+
+    def release(self, hlu):
+        """
+        Give up the reservation of an HLU which wasn't used after all.
+        """
+        with self._reservations() as reservations:
+            reservations.pop(hlu, None)
@@ -0,0 +1,240 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+An indexed model of the array's LUNs and storage groups, kept up to date by
+diffing each fresh listing against the last.
+"""
+
+import threading
+
+from flocker.node.agents.loopback import (
+    _blockdevicevolume_from_blockdevice_id,
+)
+
+
+class Inventory(object):
+    """
+    The LUNs and storage group mappings last listed from the array, indexed
+    by LUN name, ALU, blockdevice_id and storage group, with a
+    ``BlockDeviceVolume`` for each LUN which belongs to this cluster.
+
+    ``update`` only re-examines the LUNs and storage groups which differ
+    from the previous listing, and an unchanged LUN keeps the same volume,
+    so listing an idle array costs little more than comparing the records.
+
+    :param blockdevice_id_for_name: A callable which returns the
+        blockdevice_id of a LUN name, or ``None`` if the LUN isn't one of
+        this cluster's volumes.
+    :param unicode storage_group: The storage group of this node.
+    :param unicode hostname: ``attached_to`` for volumes in
+        ``storage_group``.
+    :param unicode foreign: ``attached_to`` for volumes in any other storage
+        group.
+    """
+    def __init__(self, blockdevice_id_for_name, storage_group, hostname,
+                 foreign):
+        self._blockdevice_id_for_name = blockdevice_id_for_name
+        self._group = storage_group
+        self._hostname = hostname
+        self._foreign = foreign
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._luns_snapshot = None
+        self._groups_snapshot = None
+        # lun_name -> LUN record
+        self._by_name = {}
+        # alu -> LUN record
+        self._by_alu = {}
+        # blockdevice_id -> LUN record
+        self._by_blockdevice_id = {}
+        # lun_name -> blockdevice_id, or None for other LUNs
+        self._blockdevice_ids = {}
+        # storage group name -> ALU to HLU mapping
+        self._lunmaps = {}
+        # alu -> storage group name
+        self._group_of_alu = {}
+        # blockdevice_id -> BlockDeviceVolume
+        self._volumes = {}
+        self._volume_list = []
+
+    def lun_by_name(self, name):
+        return self._by_name.get(name)
+
+    def lun_by_alu(self, alu):
+        return self._by_alu.get(alu)
+
+    def lun_by_blockdevice_id(self, blockdevice_id):
+        return self._by_blockdevice_id.get(blockdevice_id)
+
+    def lunmap(self, storage_group):
+        """
+        :returns: The ALU to HLU mapping of ``storage_group``, or ``None``
+            if there is no such group.
+        """
+        return self._lunmaps.get(storage_group)
+
+    def storage_group_of(self, alu):
+        """
+        :returns: The name of the storage group which ``alu`` is in, or
+            ``None``.
+        """
+        return self._group_of_alu.get(alu)
+
+    def volume(self, blockdevice_id):
+        return self._volumes.get(blockdevice_id)
+
+    def volumes(self):
+        """
+        :returns: A ``list`` of the ``BlockDeviceVolume`` of every LUN in
+            this cluster.  It is shared between callers until the inventory
+            changes, so must not be modified.
+        """
+        return self._volume_list
+
+    def update(self, luns, storage_groups):
+        """
+        Bring the inventory up to date with a listing of the array.
+
+        :param list luns: LUN records with ``LUN_INVENTORY`` properties.
+        :param dict storage_groups: As returned by
+            ``EMCVNXClient.storage_groups``.
+        :returns: A ``list`` of the ``BlockDeviceVolume`` of each volume
+            which is new or has changed.
+        :raises Exception: If one of this cluster's LUNs is in more than one
+            storage group.
+        """
+        with self._lock:
+            if (luns is self._luns_snapshot and
+                    storage_groups is self._groups_snapshot):
+                # The same cached listing as last time.
+                return []
+            try:
+                changed = self._update_luns(luns)
+                changed |= self._update_storage_groups(storage_groups)
+                updated = self._update_volumes(changed)
+            except:
+                # Start again from scratch next time.
+                self._reset()
+                raise
+            self._luns_snapshot = luns
+            self._groups_snapshot = storage_groups
+            return updated
+
+    def _update_luns(self, luns):
+        """
+        :returns: The ``set`` of blockdevice_ids whose LUNs have appeared,
+            changed or disappeared.
+        """
+        changed = set()
+        seen = set()
+        for lun in luns:
+            name = lun.lun_name
+            seen.add(name)
+            old = self._by_name.get(name)
+            if old == lun:
+                continue
+            if old is not None:
+                self._forget_lun(old)
+            blockdevice_id = self._blockdevice_id_for_name(
+                name.decode('ascii')
+            )
+            self._by_name[name] = lun
+            self._by_alu[lun.lun_id] = lun
+            self._blockdevice_ids[name] = blockdevice_id
+            if blockdevice_id is not None:
+                self._by_blockdevice_id[blockdevice_id] = lun
+                changed.add(blockdevice_id)
+        if len(seen) != len(self._by_name):
+            for name in set(self._by_name) - seen:
+                blockdevice_id = self._blockdevice_ids.get(name)
+                self._forget_lun(self._by_name.pop(name))
+                del self._blockdevice_ids[name]
+                if blockdevice_id is not None:
+                    changed.add(blockdevice_id)
+        return changed
+
+    def _forget_lun(self, lun):
+        # A renamed LUN may already be indexed under its new name.
+        if self._by_alu.get(lun.lun_id) is lun:
+            del self._by_alu[lun.lun_id]
+        blockdevice_id = self._blockdevice_ids.get(lun.lun_name)
+        if self._by_blockdevice_id.get(blockdevice_id) is lun:
+            del self._by_blockdevice_id[blockdevice_id]
+
+    def _update_storage_groups(self, storage_groups):
+        """
+        :returns: The ``set`` of blockdevice_ids whose LUNs have been added
+            to or removed from a storage group.
+        """
+        added = []
+        removed = []
+        for name, group in storage_groups.items():
+            lunmap = group.lunmap
+            old = self._lunmaps.get(name, {})
+            if lunmap == old:
+                continue
+            removed.extend((name, alu) for alu in old if alu not in lunmap)
+            added.extend(
+                (name, alu, hlu, lunmap) for alu, hlu in lunmap.items()
+                if alu not in old
+            )
+            self._lunmaps[name] = lunmap
+        for name in set(self._lunmaps) - set(storage_groups):
+            removed.extend((name, alu) for alu in self._lunmaps.pop(name))
+
+        changed = set()
+        # Apply every removal first so that a LUN which moved between groups
+        # isn't mistaken for a LUN in both.
+        for name, alu in removed:
+            if self._group_of_alu.get(alu) == name:
+                del self._group_of_alu[alu]
+                changed.add(self._blockdevice_id_of_alu(alu))
+        for name, alu, hlu, lunmap in added:
+            current = self._group_of_alu.get(alu)
+            blockdevice_id = self._blockdevice_id_of_alu(alu)
+            if current is not None and current != name:
+                if blockdevice_id is not None:
+                    raise Exception(name, lunmap, alu, hlu, current)
+                continue
+            self._group_of_alu[alu] = name
+            changed.add(blockdevice_id)
+        changed.discard(None)
+        return changed
+
+    def _blockdevice_id_of_alu(self, alu):
+        lun = self._by_alu.get(alu)
+        if lun is None:
+            return None
+        return self._blockdevice_ids[lun.lun_name]
+
+    def _attached_to(self, alu):
+        group = self._group_of_alu.get(alu)
+        if group is None:
+            return None
+        if group == self._group:
+            return self._hostname
+        # A node can see that a LUN has been added to another storage group
+        # but not whether that host has a device for it, so the volume is
+        # reported as attached to a compute instance which doesn't exist.
+        return self._foreign
+
+    def _update_volumes(self, changed):
+        updated = []
+        for blockdevice_id in changed:
+            lun = self._by_blockdevice_id.get(blockdevice_id)
+            if lun is None:
+                self._volumes.pop(blockdevice_id, None)
+                continue
+            volume = _blockdevicevolume_from_blockdevice_id(
+                blockdevice_id=blockdevice_id,
+                size=int(1024*1024*1024*lun.total_capacity_gb),
+                attached_to=self._attached_to(lun.lun_id),
+            )
+            if self._volumes.get(blockdevice_id) != volume:
+                self._volumes[blockdevice_id] = volume
+                updated.append(volume)
+        if changed:
+            self._volume_list = list(self._volumes.values())
+        return updated
@@ -0,0 +1,301 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Latency histograms and counters for array commands and device discovery,
+exportable as a Prometheus textfile and as eliot fields.
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from eliot import Message, start_action, write_traceback
+
+# The kinds of metric which collectors report.
+COUNTER = u'counter'
+GAUGE = u'gauge'
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300,
+)
+
+
+class Histogram(object):
+    """
+    Counts of observations no greater than each of ``buckets``.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return unicode(value).replace(
+        u'\\', u'\\\\'
+    ).replace(u'"', u'\\"').replace(u'\n', u'\\n')
+
+
+def _series(name, labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return name
+    return u'{}{{{}}}'.format(name, u','.join(
+        u'{}="{}"'.format(key, _escape(value)) for key, value in pairs
+    ))
+
+
+class Metrics(object):
+    """
+    A thread-safe registry of histograms, counters and gauges.
+
+    Each metric is identified by a name and a ``dict`` of labels.  Totals
+    kept by other objects, and gauges, are read when the metrics are
+    exported, from callables added with ``add_collector``.
+    """
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._collectors = []
+
+    def observe(self, name, value, **labels):
+        """
+        Add ``value`` to the histogram ``name``.
+        """
+        with self._lock:
+            key = (name, _labels(labels))
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        """
+        Add ``amount`` to the counter ``name``.
+        """
+        with self._lock:
+            key = (name, _labels(labels))
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observe the seconds spent in a ``with`` block in the histogram
+        ``name``, whether or not it raises.
+        """
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.observe(name, self._clock() - start, **labels)
+
+    def timings(self, name, action_type=None):
+        """
+        :returns: A ``Timings`` for one operation, whose phases are observed
+            in the histogram ``name`` and, if ``action_type`` is given, are
+            nested eliot actions of the type ``<action_type>:<phase>``.
+        """
+        return Timings(self, name, self._clock, action_type)
+
+    def add_collector(self, collector):
+        """
+        :param collector: A callable returning an iterable of
+            ``(kind, name, labels, value)`` metrics, called at each export.
+            ``kind`` is ``COUNTER`` for totals which only ever increase,
+            whose names end in ``_total``, or ``GAUGE``.
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def _collect(self):
+        """
+        :returns: A ``dict`` mapping ``COUNTER`` and ``GAUGE`` to ``dict``
+            instances mapping each collected series to its value.
+        """
+        with self._lock:
+            collectors = list(self._collectors)
+        collected = {COUNTER: {}, GAUGE: {}}
+        for collector in collectors:
+            try:
+                for kind, name, labels, value in collector():
+                    collected[kind][(name, _labels(labels))] = value
+            except Exception:
+                write_traceback()
+        return collected
+
+    def snapshot(self):
+        """
+        :returns: A ``dict``, suitable as an eliot field, mapping each
+            series to the count and sum of its histogram or the value of its
+            counter or gauge.
+        """
+        collected = self._collect()
+        with self._lock:
+            result = {
+                _series(name, labels): {
+                    u'count': histogram.count, u'sum': histogram.sum,
+                }
+                for (name, labels), histogram in self._histograms.items()
+            }
+            for (name, labels), value in self._counters.items():
+                result[_series(name, labels)] = value
+        for values in collected.values():
+            for (name, labels), value in values.items():
+                result[_series(name, labels)] = value
+        return result
+
+    def prometheus_text(self):
+        """
+        :returns: Every metric in the Prometheus text exposition format.
+        """
+        collected = self._collect()
+        lines = []
+
+        def by_name(items, kind):
+            last = None
+            for (name, labels), value in sorted(items):
+                if name != last:
+                    lines.append(u'# TYPE {} {}'.format(name, kind))
+                    last = name
+                yield name, labels, value
+
+        with self._lock:
+            histograms = [
+                (key, (list(h.buckets), list(h.counts), h.count, h.sum))
+                for key, h in self._histograms.items()
+            ]
+            counters = list(self._counters.items())
+        counters += collected[COUNTER].items()
+        for name, labels, (buckets, counts, count, total) in by_name(
+            histograms, u'histogram'
+        ):
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(u'{} {}'.format(
+                    _series(name + u'_bucket', labels, [(u'le', bound)]),
+                    cumulative,
+                ))
+            lines.append(u'{} {}'.format(
+                _series(name + u'_bucket', labels, [(u'le', u'+Inf')]), count
+            ))
+            lines.append(u'{} {!r}'.format(
+                _series(name + u'_sum', labels), total
+            ))
+            lines.append(u'{} {}'.format(
+                _series(name + u'_count', labels), count
+            ))
+        for name, labels, value in by_name(counters, COUNTER):
+            lines.append(u'{} {}'.format(_series(name, labels), value))
+        for name, labels, value in by_name(collected[GAUGE].items(), GAUGE):
+            lines.append(u'{} {}'.format(_series(name, labels), value))
+        return u''.join(line + u'\n' for line in lines)
+
+    def write_textfile(self, path):
+        """
+        Replace the file at ``path`` with ``prometheus_text``, atomically so
+        that a collector never reads it half written.
+
+        :param FilePath path: Usually in the node exporter's textfile
+            directory, with a ``.prom`` extension.
+        """
+        temporary = path.temporarySibling()
+        with temporary.open('w') as f:
+            f.write(self.prometheus_text().encode('utf-8'))
+        os.rename(temporary.path, path.path)
+
+
+class Timings(object):
+    """
+    The seconds spent in each phase of one operation.
+
+    :ivar dict phases: Maps each phase name to its total seconds, for use as
+        an eliot field.
+    """
+    def __init__(self, metrics, name, clock, action_type=None):
+        self._metrics = metrics
+        self._name = name
+        self._clock = clock
+        self._action_type = action_type
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, phase):
+        """
+        Time a ``with`` block as ``phase``.
+
+        :returns: A context manager giving the eliot action of the phase, to
+            which success fields can be added, or ``None``.
+        """
+        start = self._clock()
+        try:
+            if self._action_type is None:
+                yield None
+            else:
+                with start_action(
+                    action_type=u'{}:{}'.format(self._action_type, phase)
+                ) as action:
+                    yield action
+        finally:
+            elapsed = self._clock() - start
+            self.phases[phase] = self.phases.get(phase, 0) + elapsed
+            self._metrics.observe(self._name, elapsed, phase=phase)
+
+
+class MetricsExporter(object):
+    """
+    Periodically write ``Metrics`` to a Prometheus textfile and to the eliot
+    log.
+
+    :ivar textfile: A ``FilePath`` to write, or ``None``.
+    :ivar int interval: Seconds between exports.
+    """
+    def __init__(self, metrics, textfile=None, interval=60):
+        self._metrics = metrics
+        self.textfile = textfile
+        self.interval = interval
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def export(self):
+        if self.textfile is not None:
+            self._metrics.write_textfile(self.textfile)
+        Message.new(operation=u'metrics',
+                    metrics=self._metrics.snapshot()).write()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="vnx-metrics")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.interval)
+            try:
+                self.export()
+            except Exception:
+                write_traceback()
@@ -0,0 +1,379 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Parsers for the output of ``naviseccli``.
+
+``TextOutput`` scrapes the default, human oriented output.  ``XMLOutput``
+asks ``naviseccli`` for ``-xml`` output and reads it incrementally.  Both
+produce the records defined in ``_records``.
+"""
+
+import re
+from xml.etree.cElementTree import XMLParser
+
+from ._records import StorageGroup
+
+
+class RecordParser(object):
+    """
+    Extract ``PropertyDescriptor`` values from ``-list`` output which
+    describes one object per blank-line separated block.
+
+    All of the descriptor labels are combined into a single compiled pattern
+    so each line is examined once, no matter how many properties are wanted.
+
+    :param record_type: The ``_records`` class to parse each block into.  It
+        has an attribute named after the key of every descriptor.
+    """
+    def __init__(self, properties, record_type):
+        self._properties = list(properties)
+        self._record_type = record_type
+        alternatives = []
+        for index, prop in enumerate(self._properties):
+            alternatives.append('(?P<p{}>{})'.format(index, prop.label))
+        self._pattern = re.compile(
+            r'\s*(?:{})'.format('|'.join(alternatives))
+        )
+        # Each label has exactly one group of its own, which directly follows
+        # the named group wrapping it.
+        self._value_groups = {
+            'p{}'.format(index): (
+                prop, self._pattern.groupindex['p{}'.format(index)] + 1
+            )
+            for index, prop in enumerate(self._properties)
+        }
+
+    def records(self, lines):
+        """
+        Parse ``lines`` incrementally.
+
+        :param lines: An iterable of lines of ``naviseccli`` output.
+        :returns: A generator of records, one per block, with each
+            descriptor's parsed value or ``None``.
+        """
+        wanted = len(self._properties)
+        record = None
+        found = set()
+        for line in lines:
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                if record is not None:
+                    yield record
+                record, found = None, set()
+                continue
+            if record is None:
+                record = self._record_type()
+            if len(found) == wanted:
+                continue
+            match = self._pattern.match(line)
+            if match is None:
+                continue
+            name = match.lastgroup
+            if name in found:
+                # As with a search of the whole block, the first match wins.
+                continue
+            found.add(name)
+            prop, group = self._value_groups[name]
+            setattr(record, prop.key, _convert(prop, match.group(group)))
+        if record is not None:
+            yield record
+
+    def parse_one(self, lines):
+        """
+        :returns: The first record in ``lines``, or ``None`` if there is
+            none.
+        """
+        for record in self.records(lines):
+            return record
+        return None
+
+
+def _convert(prop, value):
+    if prop.converter is None:
+        return value
+    try:
+        return prop.converter(value)
+    except ValueError:
+        return None
+
+
+_parsers = {}
+
+
+def record_parser(properties, record_type):
+    """
+    :returns: A ``RecordParser`` for ``properties``, reusing a previously
+        compiled one where possible.
+    """
+    key = (record_type,) + tuple(prop.key for prop in properties)
+    try:
+        return _parsers[key]
+    except KeyError:
+        parser = _parsers[key] = RecordParser(properties, record_type)
+        return parser
+
+
+class TextOutput(object):
+    """
+    Parse the default text output of ``naviseccli``.
+
+    :param bool keep_raw_output: Whether to keep the output each storage
+        group was parsed from, for debugging.
+    """
+    cli_options = ()
+
+    def __init__(self, keep_raw_output=False):
+        self.keep_raw_output = keep_raw_output
+
+    def records(self, properties, start, lines, record_type):
+        """
+        Parse object records incrementally.
+
+        :param list properties: The ``PropertyDescriptor`` instances to
+            extract.
+        :param PropertyDescriptor start: The property which begins each
+            record.  Text records are separated by blank lines instead.
+        :param lines: An iterable of lines of ``naviseccli`` output.
+        :param record_type: The ``_records`` class to parse into.
+        :returns: A generator of ``record_type`` instances.
+        """
+        return record_parser(properties, record_type).records(lines)
+
+    def parse_one(self, properties, start, lines, record_type):
+        """
+        :returns: The first record in ``lines``, or ``None`` if there is
+            none.
+        """
+        return record_parser(properties, record_type).parse_one(lines)
+
+    def storage_groups(self, out):
+        """
+        :returns: A ``dict`` mapping storage group names to the result of
+            ``storage_group`` for each.
+        """
+        groups = {}
+        for group_content in out.split('Storage Group Name:    '):
+            if not group_content.strip():
+                continue
+            group_name, group_content = group_content.split('\n', 1)
+            group_name = group_name.strip()
+            group_info = self.storage_group(group_content)
+            group_info.name = group_name
+            groups[group_name] = group_info
+        return groups
+
+    def storage_group(self, content):
+        """
+        :returns: A ``StorageGroup`` with the ``storage_group_uid`` of the
+            group and its ``lunmap`` from ALU to HLU.
+        """
+        lun_map = {}
+        data = StorageGroup(lunmap=lun_map)
+        if self.keep_raw_output:
+            data.raw_output = content
+        re_storage_group_id = 'Storage Group UID:\s*(.*)\s*'
+        m = re.search(re_storage_group_id, content)
+        if m is not None:
+            data.storage_group_uid = m.group(1)
+
+        re_hlu_alu_pair = 'HLU\/ALU Pairs:\s*HLU Number' \
+                          '\s*ALU Number\s*[-\s]*(?P<lun_details>(\d+\s*)+)'
+        m = re.search(re_hlu_alu_pair, content)
+        if m is not None:
+            lun_details = m.group('lun_details').strip()
+            values = re.split('\s*', lun_details)
+            while (len(values) >= 2):
+                key = values.pop()
+                value = values.pop()
+                lun_map[int(key)] = int(value)
+        return data
+
+    def iscsi_targets(self, out):
+        """
+        :returns: A ``dict`` mapping each SP to a ``list`` of its iSCSI
+            virtual ports.
+        """
+        iscsi_target_dict = {'A': [], 'B': []}
+        iscsi_spport_pat = r'(A|B)\s*' + \
+                           r'Port ID:\s+(\d+)\s*' + \
+                           r'Port WWN:\s+(iqn\S+)'
+        iscsi_vport_pat = r'Virtual Port ID:\s+(\d+)\s*' + \
+                          r'VLAN ID:\s*\S*\s*' + \
+                          r'IP Address:\s+(\S+)'
+        for spport_content in re.split(r'^SP:\s+|\nSP:\s*', out):
+            m_spport = re.match(iscsi_spport_pat, spport_content,
+                                flags=re.IGNORECASE)
+            if not m_spport:
+                continue
+            sp = m_spport.group(1)
+            port_id = int(m_spport.group(2))
+            iqn = m_spport.group(3)
+            for m_vport in re.finditer(iscsi_vport_pat, spport_content):
+                vport_id = int(m_vport.group(1))
+                ip_addr = m_vport.group(2)
+                if ip_addr.find('N/A') != -1:
+                    continue
+                iscsi_target_dict[sp].append({'SP': sp,
+                                              'Port ID': port_id,
+                                              'Port WWN': iqn,
+                                              'Virtual Port ID': vport_id,
+                                              'IP Address': ip_addr})
+        return iscsi_target_dict
+
+
+class _ParamValueTarget(object):
+    """
+    An ``XMLParser`` target which collects the ``(NAME, VALUE)`` pair of
+    every ``PARAMVALUE`` element without building a tree.
+    """
+    def __init__(self):
+        self.pairs = []
+        self._name = None
+        self._text = []
+        self._in_value = False
+
+    def start(self, tag, attrib):
+        if tag == 'PARAMVALUE':
+            self._name = attrib.get('NAME')
+            self._text = []
+        elif tag == 'VALUE':
+            self._in_value = True
+
+    def data(self, data):
+        if self._in_value:
+            self._text.append(data)
+
+    def end(self, tag):
+        if tag == 'VALUE':
+            self._in_value = False
+        elif tag == 'PARAMVALUE' and self._name is not None:
+            self.pairs.append((self._name, u''.join(self._text).strip()))
+            self._name = None
+
+    def close(self):
+        pass
+
+
+def _xml_pairs(lines):
+    """
+    Feed ``lines`` of XML to a parser one at a time.
+
+    :returns: A generator of ``(name, value)`` pairs, one per
+        ``PARAMVALUE``, yielded as soon as each element is closed.
+    """
+    target = _ParamValueTarget()
+    parser = XMLParser(target=target)
+    for line in lines:
+        parser.feed(line)
+        for pair in target.pairs:
+            yield pair
+        del target.pairs[:]
+    parser.close()
+    for pair in target.pairs:
+        yield pair
+
+
+class XMLOutput(object):
+    """
+    Parse the ``-xml`` output of ``naviseccli``.
+
+    Every property is a ``PARAMVALUE`` element named after its text label and
+    the properties of successive objects follow each other without nesting,
+    so a record ends where the property which starts the next one appears.
+    """
+    cli_options = ('-xml',)
+
+    def __init__(self, keep_raw_output=False):
+        self.keep_raw_output = keep_raw_output
+
+    def records(self, properties, start, lines, record_type):
+        by_name = {prop.xml_name: prop for prop in properties}
+        record = None
+        found = set()
+        for name, value in _xml_pairs(lines):
+            if name == start.xml_name:
+                if record is not None:
+                    yield record
+                record = record_type()
+                found = set()
+            if record is None or name in found:
+                continue
+            prop = by_name.get(name)
+            if prop is not None:
+                found.add(name)
+                setattr(
+                    record, prop.key, _convert(prop, value.encode('utf-8'))
+                )
+        if record is not None:
+            yield record
+
+    def parse_one(self, properties, start, lines, record_type):
+        for record in self.records(properties, start, lines, record_type):
+            return record
+        return None
+
+    def _storage_groups(self, content):
+        name = None
+        data = None
+        hlu = None
+        for key, value in _xml_pairs([content]):
+            value = value.encode('utf-8')
+            if key == 'Storage Group Name':
+                if data is not None:
+                    yield name, data
+                name = value
+                data = StorageGroup(name=name, lunmap={})
+            elif data is None:
+                continue
+            elif key == 'Storage Group UID':
+                data.storage_group_uid = value
+            elif key == 'HLU Number':
+                hlu = int(value)
+            elif key == 'ALU Number' and hlu is not None:
+                data.lunmap[int(value)] = hlu
+                hlu = None
+        if data is not None:
+            yield name, data
+
+    def storage_groups(self, out):
+        return dict(self._storage_groups(out))
+
+    def storage_group(self, content):
+        for name, data in self._storage_groups(content):
+            if self.keep_raw_output:
+                data.raw_output = content
+            return data
+        return StorageGroup(lunmap={})
+
+    def iscsi_targets(self, out):
+        iscsi_target_dict = {'A': [], 'B': []}
+        port = None
+        vport_id = None
+        for key, value in _xml_pairs([out]):
+            value = value.encode('utf-8')
+            if key == 'SP':
+                port = {'SP': value.upper()}
+            elif port is None:
+                continue
+            elif key == 'Port ID':
+                port['Port ID'] = int(value)
+            elif key == 'Port WWN':
+                port['Port WWN'] = value
+            elif key == 'Virtual Port ID':
+                vport_id = int(value)
+            elif key == 'IP Address' and vport_id is not None:
+                if (port['SP'] in iscsi_target_dict and
+                        port.get('Port WWN', '').startswith('iqn') and
+                        value.find('N/A') == -1):
+                    iscsi_target_dict[port['SP']].append(
+                        dict(port, **{'Virtual Port ID': vport_id,
+                                      'IP Address': value})
+                    )
+                vport_id = None
+        return iscsi_target_dict
+
+
+OUTPUT_FORMATS = {
+    'text': TextOutput,
+    'xml': XMLOutput,
+}
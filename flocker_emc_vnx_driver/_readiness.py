@@ -0,0 +1,196 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Tracking of newly created LUNs until the array reports them ready.
+"""
+
+import random
+import threading
+import time
+
+from eliot import Message, write_traceback
+
+# The states in which a LUN will stay without further intervention.
+SETTLED_STATES = frozenset(['Ready', 'Faulted'])
+
+
+class LUNReadiness(object):
+    """
+    The eventual state of one tracked LUN.
+
+    :ivar state: The settled state of the LUN, or ``None`` if it no longer
+        exists.  Only meaningful once ``done`` returns ``True``.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.state = None
+        self._settled = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def done(self):
+        return self._settled.is_set()
+
+    def wait(self, timeout):
+        """
+        :returns: ``True`` if the LUN settled within ``timeout`` seconds.
+        """
+        self._settled.wait(timeout)
+        return self.done()
+
+    def add_callback(self, callback):
+        """
+        Call ``callback`` with this object once the LUN has settled, at once
+        if it already has.
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _settle(self, state):
+        with self._lock:
+            self.state = state
+            self._settled.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class ReadinessTracker(object):
+    """
+    Poll the state of every tracked LUN with a single ``lun -list``.
+
+    Polling starts ``initial_delay`` seconds after a LUN is first tracked
+    and backs off exponentially, up to ``max_delay``, while any tracked LUN
+    is still unsettled.  Each delay is randomised between half and all of
+    its nominal value so that many nodes don't poll the SP in step.
+
+    :ivar client: An ``EMCVNXClient``.
+    :ivar bool background: Whether to poll from a thread of our own, started
+        when a LUN is first tracked.  Otherwise ``poll`` must be called.
+    """
+    def __init__(self, client, initial_delay=0.5, max_delay=10,
+                 uniform=random.uniform, clock=time.time, background=True):
+        self._client = client
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self._uniform = uniform
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._pending = {}
+        self._delay = initial_delay
+        self._thread = None
+        self._stopping = False
+        self.background = background
+        self.polls = 0
+
+    def pending(self, name):
+        """
+        :returns: ``True`` if the LUN called ``name`` is being tracked and
+            hasn't settled.
+        """
+        with self._condition:
+            return name in self._pending
+
+    def track(self, name):
+        """
+        Start tracking the LUN called ``name``.
+
+        :returns: Its ``LUNReadiness``.
+        """
+        with self._condition:
+            readiness = self._pending.get(name)
+            if readiness is None:
+                readiness = self._pending[name] = LUNReadiness(name)
+                self._delay = self.initial_delay
+                self._start()
+                if len(self._pending) == 1:
+                    # The poller is idle.
+                    self._condition.notify()
+            return readiness
+
+    def wait(self, names, timeout):
+        """
+        Wait for several LUNs to settle, tracking any not already tracked.
+
+        :returns: A ``dict`` mapping the name of each LUN which settled
+            within ``timeout`` seconds to its state.
+        """
+        deadline = self._clock() + timeout
+        settled = {}
+        for readiness in [self.track(name) for name in names]:
+            if readiness.wait(max(0, deadline - self._clock())):
+                settled[readiness.name] = readiness.state
+        return settled
+
+    def poll(self):
+        """
+        List the state of every LUN once and settle those tracked LUNs which
+        are ready, faulted or gone.
+
+        :returns: The number of seconds to wait before polling again.
+        """
+        self.polls += 1
+        rc, luns = self._client.get_lun_states()
+        if rc == 0:
+            states = {lun.lun_name: lun.state for lun in luns}
+            with self._condition:
+                settled = [
+                    (readiness, states.get(name))
+                    for name, readiness in self._pending.items()
+                    if states.get(name) in SETTLED_STATES
+                    or name not in states
+                ]
+                for readiness, state in settled:
+                    del self._pending[readiness.name]
+            for readiness, state in settled:
+                Message.new(operation=u'lun_settled',
+                            lun_name=readiness.name,
+                            state=state).write()
+                readiness._settle(state)
+        with self._condition:
+            delay = self._delay
+            self._delay = min(self._delay * 2, self.max_delay)
+        return self._uniform(delay / 2.0, delay)
+
+    def _start(self):
+        if self.background and self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="vnx-lun-readiness"
+            )
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        delay = None
+        while True:
+            with self._condition:
+                if not self._pending:
+                    while not self._pending and not self._stopping:
+                        self._condition.wait()
+                    delay = None
+                if self._stopping:
+                    return
+                if delay is None:
+                    delay = self._uniform(
+                        self.initial_delay / 2.0, self.initial_delay
+                    )
+                # Also gives LUNs created in the same burst a chance to be
+                # included in the same poll.
+                self._condition.wait(delay)
+                if self._stopping:
+                    return
+            try:
+                delay = self.poll()
+            except Exception:
+                write_traceback()
+                delay = self.max_delay
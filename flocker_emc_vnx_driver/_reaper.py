@@ -0,0 +1,185 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Destruction of LUNs in the background, after ``destroy_volume`` has
+returned.
+"""
+
+import threading
+import time
+
+from eliot import Message, write_traceback
+
+TOMBSTONE_NAME_PREFIX = 'flockerrm'
+
+# naviseccli return codes for ``lun -destroy``.
+_LUN_BUSY = 8
+_NO_SUCH_LUN = 9
+
+
+class Reaper(object):
+    """
+    Destroy tombstoned LUNs in batches.
+
+    A volume is tombstoned by renaming its LUN to
+    ``flockerrm--<cluster>--<blockdevice_id>``, which no longer looks like a
+    volume.  Each pass destroys up to ``batch_size`` of the tombstones which
+    are due, with their commands pipelined.  A tombstone which can't be
+    destroyed yet, usually because the LUN is busy, is retried after a delay
+    which doubles from ``initial_delay`` up to ``max_delay``.
+
+    Every ``reload_interval`` seconds the array is listed again, so that
+    tombstones left by a process which crashed are destroyed too.
+
+    :ivar int destroyed: How many LUNs have been destroyed.
+    :ivar int retries: How many destroy attempts will be retried.
+    """
+    def __init__(self, client, cluster_id, batch_size=16, initial_delay=1,
+                 max_delay=60, interval=300, reload_interval=900,
+                 clock=time.time):
+        self._client = client
+        self.prefix = '{}--{}--'.format(
+            TOMBSTONE_NAME_PREFIX, str(cluster_id).split('-')[0]
+        )
+        self.batch_size = batch_size
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.interval = interval
+        self.reload_interval = reload_interval
+        self._clock = clock
+        self._next_load = 0
+        self._lock = threading.Lock()
+        # LUN name -> (number of failed attempts, time of next attempt)
+        self._tombstones = {}
+        self.destroyed = 0
+        self.retries = 0
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def tombstone_name(self, blockdevice_id):
+        return self.prefix + str(blockdevice_id)
+
+    def bury(self, name):
+        """
+        Arrange for the tombstoned LUN called ``name`` to be destroyed.
+        """
+        with self._lock:
+            self._tombstones.setdefault(name, (0, self._clock()))
+        self._wake.set()
+
+    def load(self):
+        """
+        Find this cluster's tombstones on the array, for example those left
+        by a previous process.
+
+        The array is always asked afresh, since a cached listing or shared
+        snapshot may not show them yet.
+
+        :raises Exception: If the LUNs can't be listed.
+        """
+        rc, luns = self._client.list_luns(self._client.LUN_INVENTORY)
+        if rc != 0:
+            raise Exception(rc, luns)
+        for lun in luns:
+            if lun.lun_name.startswith(self.prefix):
+                self.bury(lun.lun_name)
+
+    def reap(self):
+        """
+        Try to destroy one batch of the tombstones which are due.
+
+        :returns: The number of seconds until the next tombstone is due, or
+            ``None`` if there are none left.
+        """
+        now = self._clock()
+        with self._lock:
+            due = sorted(
+                name for name, (attempts, when) in self._tombstones.items()
+                if when <= now
+            )[:self.batch_size]
+        if due:
+            results = self._client.destroy_volumes(due)
+            busy = []
+            with self._lock:
+                for name, (rc, out) in zip(due, results):
+                    if rc in (0, _NO_SUCH_LUN):
+                        del self._tombstones[name]
+                        self.destroyed += 1
+                        continue
+                    attempts, _ = self._tombstones[name]
+                    delay = min(
+                        self.initial_delay * 2 ** attempts, self.max_delay
+                    )
+                    self._tombstones[name] = (attempts + 1, now + delay)
+                    self.retries += 1
+                    busy.append((name, rc, out))
+                remaining = len(self._tombstones)
+            for name, rc, out in busy:
+                if rc != _LUN_BUSY:
+                    Message.new(operation=u'reap_failed',
+                                lun_name=name,
+                                rc=rc,
+                                out=out).write()
+            Message.new(operation=u'reap',
+                        attempted=len(due),
+                        busy=len(busy),
+                        remaining=remaining).write()
+        with self._lock:
+            if not self._tombstones:
+                return None
+            return max(
+                0, min(when for _, when in self._tombstones.values()) - now
+            )
+
+    def stats(self):
+        """
+        :returns: A ``dict`` of the number of tombstones still to be
+            destroyed, the number destroyed and the number of retries.
+        """
+        with self._lock:
+            return {
+                'pending': len(self._tombstones),
+                'destroyed': self.destroyed,
+                'retries': self.retries,
+            }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="vnx-reaper")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _step(self):
+        """
+        Find the tombstones on the array again if that is due, and try to
+        destroy one batch.
+
+        :returns: The number of seconds to wait before the next step.
+        """
+        if self._clock() >= self._next_load:
+            self._next_load = self._clock() + self.reload_interval
+            try:
+                self.load()
+            except Exception:
+                write_traceback()
+        try:
+            delay = self.reap()
+        except Exception:
+            write_traceback()
+            delay = self.max_delay
+        if delay is None:
+            delay = self.interval
+        return min(delay, max(0, self._next_load - self._clock()))
+
+    def _run(self):
+        while not self._stopping:
+            delay = self._step()
+            if delay > 0:
+                self._wake.wait(delay)
+                self._wake.clear()
@@ -0,0 +1,76 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Compact records of the objects listed by ``naviseccli``.
+
+A listing of a large array holds one record per LUN, so these are slotted
+classes rather than ``dict`` instances.  Properties which weren't asked for
+are ``None``.
+"""
+
+
+class _Record(object):
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return all(
+            getattr(self, name) == getattr(other, name)
+            for name in self.__slots__
+        )
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    # Records are filled in as they are parsed.
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({})'.format(
+            type(self).__name__,
+            ', '.join(
+                '{}={!r}'.format(name, getattr(self, name))
+                for name in self.__slots__
+            )
+        )
+
+
+class LUN(_Record):
+    """
+    :ivar int lun_id: The ALU.
+    :ivar str lun_name:
+    :ivar str lun_uid: Lower case hex digits, without colons.
+    :ivar float total_capacity_gb:
+    :ivar str state: For example ``Ready`` or ``Initializing``.
+    :ivar str status: For example ``OK(0x0)``.
+    """
+    __slots__ = (
+        'lun_id', 'lun_name', 'lun_uid', 'total_capacity_gb', 'state',
+        'status',
+    )
+
+
+class Pool(_Record):
+    """
+    :ivar str pool_name:
+    """
+    __slots__ = ('pool_name',)
+
+
+class StorageGroup(_Record):
+    """
+    :ivar str name:
+    :ivar str storage_group_uid:
+    :ivar dict lunmap: Maps the ALU of each LUN in the group to its HLU.
+    :ivar str raw_output: The ``naviseccli`` output the group was parsed
+        from, if it was kept for debugging, or ``None``.
+    """
+    __slots__ = ('name', 'storage_group_uid', 'lunmap', 'raw_output')
@@ -0,0 +1,149 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Summarise attach and detach latency from the eliot logs of many nodes.
+"""
+
+import json
+import math
+import sys
+from argparse import ArgumentParser
+from collections import defaultdict
+
+ACTION_PREFIX = u'flocker_vnx:'
+
+
+def percentile(values, fraction):
+    """
+    :param list values: Sorted numbers.
+    :returns: The nearest-rank ``fraction`` percentile of ``values``.
+    """
+    rank = max(0, int(math.ceil(fraction * len(values))) - 1)
+    return values[rank]
+
+
+def _messages(lines):
+    """
+    Parse the eliot messages in ``lines``, skipping anything which isn't
+    one.  The output of ``journalctl -o json`` is unwrapped.
+    """
+    for line in lines:
+        try:
+            message = json.loads(line)
+        except ValueError:
+            continue
+        if not isinstance(message, dict):
+            continue
+        if u'MESSAGE' in message and u'task_uuid' not in message:
+            try:
+                message = json.loads(message[u'MESSAGE'])
+            except (TypeError, ValueError):
+                continue
+        if isinstance(message, dict) and u'task_uuid' in message:
+            yield message
+
+
+class LatencyReport(object):
+    """
+    The durations of the driver's eliot actions, and the outcome of its
+    device waits, gathered from any number of logs.
+
+    The phases of one attach or detach are summed, so a phase which is
+    repeated, such as each scan of the bus, contributes its total.
+    """
+    def __init__(self):
+        self._started = {}
+        # action_type -> operation key -> seconds
+        self._durations = defaultdict(lambda: defaultdict(float))
+        self._failed = defaultdict(int)
+        self._passes = []
+        self._waited = 0
+        self._timeouts = 0
+        self._hlu_conflicts = 0
+
+    def read(self, lines):
+        for message in _messages(lines):
+            action_type = message.get(u'action_type', u'')
+            if action_type.startswith(ACTION_PREFIX):
+                self._action(action_type, message)
+            operation = message.get(u'operation')
+            if operation == u'wait_for_devices_output':
+                self._passes.append(message.get(u'passes', 0))
+                self._waited += len(message.get(u'blockdevice_ids', []))
+                self._timeouts += len(message.get(u'timeouts', []))
+            elif operation == u'hlu_conflict':
+                self._hlu_conflicts += 1
+
+    def _action(self, action_type, message):
+        task_level = tuple(message.get(u'task_level', ()))
+        key = (message[u'task_uuid'], task_level[:-1])
+        status = message.get(u'action_status')
+        if status == u'started':
+            self._started[key] = message[u'timestamp']
+            return
+        start = self._started.pop(key, None)
+        if start is None:
+            return
+        if status == u'failed':
+            self._failed[action_type] += 1
+        # Group a phase with the attach or detach it is part of.
+        if action_type.count(u':') > 1:
+            operation = (key[0], key[1][:-1])
+        else:
+            operation = key
+        self._durations[action_type][operation] += (
+            message[u'timestamp'] - start
+        )
+
+    def render(self):
+        """
+        :returns: The report, as text.
+        """
+        lines = [u'{:<40} {:>7} {:>9} {:>9} {:>9} {:>7}'.format(
+            u'action', u'count', u'p50', u'p95', u'p99', u'failed'
+        )]
+        for action_type in sorted(self._durations):
+            durations = sorted(self._durations[action_type].values())
+            lines.append(
+                u'{:<40} {:>7} {:>9.3f} {:>9.3f} {:>9.3f} {:>7}'.format(
+                    action_type[len(ACTION_PREFIX):], len(durations),
+                    percentile(durations, 0.5), percentile(durations, 0.95),
+                    percentile(durations, 0.99), self._failed[action_type],
+                )
+            )
+        lines.append(u'')
+        if self._passes:
+            passes = sorted(self._passes)
+            lines.append(
+                u'device waits: {}, passes p50 {} p95 {} max {}'.format(
+                    len(passes), percentile(passes, 0.5),
+                    percentile(passes, 0.95), passes[-1],
+                )
+            )
+        if self._waited:
+            lines.append(u'device timeouts: {} of {} ({:.2%})'.format(
+                self._timeouts, self._waited,
+                float(self._timeouts) / self._waited,
+            ))
+        lines.append(u'HLU conflicts: {}'.format(self._hlu_conflicts))
+        return u''.join(line + u'\n' for line in lines)
+
+
+def main(argv=None, stdin=sys.stdin, stdout=sys.stdout):
+    parser = ArgumentParser(
+        description=u'Print latency percentiles for each phase of the VNX '
+                    u'driver\'s attaches and detaches, from eliot logs.'
+    )
+    parser.add_argument(
+        u'logs', nargs=u'*',
+        help=u'Files of eliot JSON messages, for example one per node.  '
+             u'Standard input is read if none are given.'
+    )
+    options = parser.parse_args(argv)
+    report = LatencyReport()
+    if not options.logs:
+        report.read(stdin)
+    for path in options.logs:
+        with open(path) as f:
+            report.read(f)
+    stdout.write(report.render().encode('utf-8'))
@@ -0,0 +1,265 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Admission control for the ``naviseccli`` commands sent to one SP.
+"""
+
+import fcntl
+import heapq
+import itertools
+import os
+import sys
+import threading
+import time
+
+from zope.interface import implementer
+
+from ._executor import CommandResult, ICommandExecutor
+from ._hlu import (
+    RESERVATION_DIRECTORY, make_state_directory, shared_state_path,
+)
+
+# Priority classes, most urgent first.
+MUTATION = 0
+ATTACH = 1
+INVENTORY = 2
+
+PRIORITY_NAMES = {
+    MUTATION: 'mutation',
+    ATTACH: 'attach',
+    INVENTORY: 'inventory',
+}
+
+# The subcommand actions which change the array.
+_MUTATING_ACTIONS = frozenset([
+    '-create', '-destroy', '-addhlu', '-removehlu', '-modify', '-connecthost',
+])
+
+# Options which narrow a read down to a single object.
+_SELECTORS = frozenset(['-name', '-gname'])
+
+
+def classify(cmd):
+    """
+    :param tuple cmd: The argv of a ``naviseccli`` process.
+    :returns: The priority class of ``cmd``.  Actions which change the array
+        are a ``MUTATION``, reads of a single named object are ``ATTACH`` and
+        any other read is ``INVENTORY``.
+    """
+    if _MUTATING_ACTIONS.intersection(cmd):
+        return MUTATION
+    if _SELECTORS.intersection(cmd):
+        return ATTACH
+    return INVENTORY
+
+
+def token_bucket_path(ip, directory=RESERVATION_DIRECTORY):
+    """
+    :returns: The ``FilePath`` of the token bucket shared by every process on
+        this node which talks to the SP at ``ip``.
+    """
+    return shared_state_path(directory, ip, '.tokens')
+
+
+class TokenBucket(object):
+    """
+    Admit up to ``rate`` commands a second, in bursts of up to ``burst``.
+
+    The bucket is kept in a file under ``fcntl.flock`` so that every process
+    using the same file shares one limit.
+
+    :ivar float rate: Tokens added each second.
+    :ivar int burst: The most tokens the bucket holds.
+    """
+    def __init__(self, path, rate, burst, clock=time.time):
+        if rate <= 0:
+            raise ValueError("rate must be positive", rate)
+        self.path = path
+        self.rate = float(rate)
+        self.burst = burst
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def take(self):
+        """
+        Take a token if there is one.
+
+        :returns: ``0`` if a token was taken, otherwise the number of seconds
+            until there will be one.
+        """
+        with self._lock:
+            make_state_directory(self.path.parent())
+            fd = os.open(self.path.path, os.O_RDWR | os.O_CREAT, 0o644)
+            with os.fdopen(fd, 'r+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    now = self._clock()
+                    try:
+                        tokens, stamp = [float(v) for v in f.read().split()]
+                    except ValueError:
+                        tokens, stamp = self.burst, now
+                    tokens = min(
+                        self.burst, tokens + max(0, now - stamp) * self.rate
+                    )
+                    if tokens >= 1:
+                        tokens -= 1
+                        wait = 0
+                    else:
+                        wait = (1 - tokens) / self.rate
+                    f.seek(0)
+                    f.truncate()
+                    f.write('{!r} {!r}\n'.format(tokens, now))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        return wait
+
+
+@implementer(ICommandExecutor)
+class ScheduledExecutor(object):
+    """
+    Hand commands to another ``ICommandExecutor`` in priority order, no
+    faster than a ``TokenBucket`` allows.
+
+    Commands wait here, rather than in the wrapped executor's own queue, so
+    that a mutation submitted behind a burst of inventory listings is run
+    first.  Commands of the same class run in the order submitted.
+
+    :ivar int max_in_flight: How many commands may be handed on and not yet
+        finished.  Defaults to the wrapped executor's ``workers``, or 1.
+    """
+    def __init__(self, executor, bucket=None, max_in_flight=None,
+                 classify=classify, clock=time.time):
+        self._executor = executor
+        self._bucket = bucket
+        if max_in_flight is None:
+            max_in_flight = getattr(executor, 'workers', 1)
+        self.max_in_flight = max_in_flight
+        self._classify = classify
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._queue = []
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        self._stopping = False
+        self._thread = None
+        self._stats = {
+            priority: {'dispatched': 0, 'wait_seconds': 0.0,
+                       'max_wait_seconds': 0.0}
+            for priority in PRIORITY_NAMES
+        }
+
+    @property
+    def queue_depth(self):
+        """
+        The number of submitted commands which have not yet been handed on.
+        """
+        with self._condition:
+            return len(self._queue)
+
+    @property
+    def in_flight(self):
+        """
+        The number of commands which have been handed on and not finished.
+        """
+        with self._condition:
+            return self._in_flight
+
+    def submit(self, cmd, parse=None):
+        result = CommandResult()
+        with self._condition:
+            heapq.heappush(self._queue, (
+                self._classify(cmd), next(self._sequence), self._clock(),
+                cmd, parse, result,
+            ))
+            self._start()
+            self._condition.notify()
+        return result
+
+    def stats(self):
+        """
+        :returns: A ``dict`` mapping the name of each priority class to a
+            ``dict`` of the number of its commands queued and dispatched, and
+            the total and greatest number of seconds they spent queued.
+        """
+        with self._condition:
+            queued = dict.fromkeys(PRIORITY_NAMES, 0)
+            for item in self._queue:
+                queued[item[0]] += 1
+            return {
+                name: dict(self._stats[priority], queued=queued[priority])
+                for priority, name in PRIORITY_NAMES.items()
+            }
+
+    def stop(self):
+        """
+        Hand on the commands already submitted and then stop.
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="naviseccli-scheduler"
+            )
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopping and (
+                    not self._queue or self._in_flight >= self.max_in_flight
+                ):
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                if self._in_flight >= self.max_in_flight:
+                    self._condition.wait()
+                    continue
+            if self._bucket is not None:
+                delay = self._bucket.take()
+                if delay > 0:
+                    # A submission wakes us early, and the next token goes
+                    # to whatever is then at the head of the queue.
+                    with self._condition:
+                        self._condition.wait(delay)
+                    continue
+            with self._condition:
+                priority, _, submitted, cmd, parse, result = heapq.heappop(
+                    self._queue
+                )
+                self._in_flight += 1
+                wait = self._clock() - submitted
+                stats = self._stats[priority]
+                stats['dispatched'] += 1
+                stats['wait_seconds'] += wait
+                stats['max_wait_seconds'] = max(
+                    stats['max_wait_seconds'], wait
+                )
+            self._dispatch(cmd, parse, result)
+
+    def _dispatch(self, cmd, parse, result):
+        try:
+            pending = self._executor.submit(cmd, parse)
+        except:
+            self._finished()
+            result._fail(sys.exc_info())
+            return
+        pending.add_callback(lambda pending: self._forward(pending, result))
+
+    def _forward(self, pending, result):
+        self._finished()
+        if pending._exc_info is not None:
+            result._fail(pending._exc_info)
+        else:
+            result._complete(pending._value)
+
+    def _finished(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
@@ -0,0 +1,85 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Coalescing of identical array queries which are in flight at once.
+"""
+
+import sys
+import threading
+
+from ._executor import CommandResult
+
+
+class SingleFlight(object):
+    """
+    Share one outcome between every caller which asks for the same key
+    while a query for it is running.
+
+    The first caller for a key starts the query.  Any caller asking for that
+    key before the query has finished gets the same ``CommandResult``, so it
+    neither runs a process of its own nor parses the output again.  Keys
+    should include the cache generation so that a query started before an
+    invalidation isn't shared with callers who need a fresh answer.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._stats = {}
+
+    def submit(self, key, start):
+        """
+        :param tuple key: Identifies the query.  ``key[0]`` names the kind of
+            query in ``stats``.
+        :param start: A callable which starts the query and returns a
+            ``CommandResult``.  Called only if no query for ``key`` is in
+            flight.
+        :returns: A ``CommandResult`` for the outcome of the query.
+        """
+        with self._lock:
+            stats = self._stats.setdefault(
+                key[0], {'executed': 0, 'shared': 0}
+            )
+            flight = self._flights.get(key)
+            if flight is not None:
+                stats['shared'] += 1
+                return flight
+            flight = self._flights[key] = CommandResult()
+            stats['executed'] += 1
+        try:
+            pending = start()
+        except:
+            self._land(key)
+            flight._fail(sys.exc_info())
+            return flight
+        pending.add_callback(lambda pending: self._complete(key, pending))
+        return flight
+
+    def do(self, key, start):
+        """
+        Like ``submit`` but wait for the outcome.
+
+        :returns: The value of the query.
+        :raises: Whatever exception the query failed with.
+        """
+        return self.submit(key, start).result()
+
+    def stats(self):
+        """
+        :returns: A ``dict`` mapping each kind of query to a ``dict`` of the
+            number of queries which were run and the number of callers which
+            shared a query already running instead.
+        """
+        with self._lock:
+            return {kind: dict(stats) for kind, stats in self._stats.items()}
+
+    def _land(self, key):
+        with self._lock:
+            return self._flights.pop(key)
+
+    def _complete(self, key, pending):
+        # Later callers start a new query, or find the result in the cache.
+        flight = self._land(key)
+        if pending._exc_info is not None:
+            flight._fail(pending._exc_info)
+        else:
+            flight._complete(pending._value)
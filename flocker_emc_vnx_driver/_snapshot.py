@@ -0,0 +1,280 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+An inventory of the array shared by every process on a node which talks to
+it.
+
+One process at a time, whichever holds the snapshot's lock, lists the array
+every few seconds and atomically replaces the snapshot file.  Every other
+client reads that file instead of running ``naviseccli``, for as long as the
+snapshot is recent enough, so the load on the SP no longer grows with the
+number of agents and scripts on each node.
+
+The first line of the file carries a digest of the listing, so readers only
+decode the listing again when the array has actually changed.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+
+from eliot import Message, write_traceback
+
+from ._hlu import (
+    RESERVATION_DIRECTORY, make_state_directory, shared_state_path,
+)
+from ._records import LUN, StorageGroup
+
+# The first line of a snapshot file is
+# ``<MAGIC> <VERSION> <taken_at> <digest> <lun property keys>``.
+MAGIC = 'VNXSNAP'
+VERSION = 1
+
+
+def snapshot_path(ip, directory=RESERVATION_DIRECTORY):
+    """
+    :returns: The ``FilePath`` of the snapshot shared by every process on
+        this node which talks to the SP at ``ip``.
+    """
+    return shared_state_path(directory, ip, '.snapshot')
+
+
+class Snapshot(object):
+    """
+    A listing of every LUN and storage group on the array.
+
+    :ivar float taken_at: When the listing started.
+    :ivar frozenset keys: The keys of the LUN properties which were listed.
+    :ivar list luns: ``LUN`` records.
+    :ivar dict storage_groups: Maps storage group names to
+        ``StorageGroup`` records.
+    """
+    def __init__(self, taken_at, keys, luns, storage_groups):
+        self.taken_at = taken_at
+        self.keys = keys
+        self.luns = luns
+        self.storage_groups = storage_groups
+        self._by_name = {lun.lun_name: lun for lun in luns}
+
+    def lun(self, name):
+        """
+        :returns: The ``LUN`` called ``name``, or ``None``.
+        """
+        return self._by_name.get(name)
+
+
+def encode(taken_at, keys, luns, storage_groups):
+    """
+    :param list keys: The LUN property keys to include, in order.
+    :returns: The content of a snapshot file.
+    """
+    body = json.dumps({
+        'luns': [[getattr(lun, key) for key in keys] for lun in luns],
+        'storage_groups': [
+            [name, group.storage_group_uid, sorted(group.lunmap.items())]
+            for name, group in storage_groups.items()
+        ],
+    }, sort_keys=True, separators=(',', ':'))
+    header = '{} {} {!r} {} {}\n'.format(
+        MAGIC, VERSION, taken_at, hashlib.sha1(body).hexdigest(),
+        ','.join(keys),
+    )
+    return header + body
+
+
+def _native(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _header(content):
+    """
+    :returns: The ``taken_at``, digest and LUN property keys from the first
+        line of a snapshot, or ``None`` if it isn't a snapshot this code can
+        read.
+    """
+    fields = content.readline().split()
+    if len(fields) not in (4, 5) or fields[:2] != [MAGIC, str(VERSION)]:
+        return None
+    try:
+        taken_at = float(fields[2])
+    except ValueError:
+        return None
+    keys = tuple(fields[4].split(',')) if len(fields) == 5 else ()
+    return taken_at, fields[3], keys
+
+
+def _decode(taken_at, keys, body):
+    data = json.loads(body)
+    luns = []
+    for values in data['luns']:
+        lun = LUN()
+        for key, value in zip(keys, values):
+            setattr(lun, key, _native(value))
+        luns.append(lun)
+    storage_groups = {}
+    for name, uid, pairs in data['storage_groups']:
+        name = _native(name)
+        storage_groups[name] = StorageGroup(
+            name=name, storage_group_uid=_native(uid), lunmap=dict(pairs),
+        )
+    return Snapshot(taken_at, frozenset(keys), luns, storage_groups)
+
+
+class SnapshotReader(object):
+    """
+    Read the snapshot at ``path``, decoding it again only when the writer
+    has published a different listing.
+
+    :ivar float max_age: Snapshots taken longer ago than this many seconds
+        are ignored.
+    :ivar int hits: Reads answered by the snapshot.
+    :ivar int misses: Reads which found no usable snapshot.
+    """
+    def __init__(self, path, max_age, clock=time.time):
+        self.path = path
+        self.max_age = max_age
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._listing = None
+        self._snapshot = None
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, keys, newer_than=0):
+        """
+        :param frozenset keys: The LUN property keys the caller needs.
+        :param float newer_than: Ignore snapshots taken at or before this
+            time, for example because this process changed the array then.
+        :returns: A ``Snapshot`` no older than ``max_age`` with ``keys``,
+            or ``None``.
+        """
+        with self._lock:
+            try:
+                snapshot = self._load()
+            except Exception:
+                write_traceback()
+                snapshot = None
+            if (snapshot is None or
+                    not keys <= snapshot.keys or
+                    snapshot.taken_at <= newer_than or
+                    self._clock() - snapshot.taken_at > self.max_age):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return snapshot
+
+    def _load(self):
+        try:
+            f = self.path.open('rb')
+        except IOError:
+            return None
+        with f:
+            header = _header(f)
+            if header is None:
+                return None
+            taken_at, digest, keys = header
+            if (digest, keys) != self._listing:
+                self._snapshot = _decode(taken_at, keys, f.read())
+                self._listing = (digest, keys)
+            elif taken_at != self._snapshot.taken_at:
+                # The same listing, taken again: keep the decoded records.
+                previous = self._snapshot
+                self._snapshot = Snapshot(
+                    taken_at, previous.keys, previous.luns,
+                    previous.storage_groups,
+                )
+            return self._snapshot
+
+
+class SnapshotWriter(object):
+    """
+    List the array every ``interval`` seconds and replace the snapshot at
+    ``path``, provided no other process on this node is already doing so.
+
+    The writer holds an exclusive ``fcntl.flock`` on a lock file next to
+    the snapshot for as long as it runs, so another process takes over at
+    its next interval once the writer stops or exits.
+
+    :ivar client: An ``EMCVNXClient``.
+    :ivar list properties: The LUN ``PropertyDescriptor`` instances to
+        list.
+    """
+    def __init__(self, client, path, interval, properties, clock=time.time):
+        self._client = client
+        self.path = path
+        self.interval = interval
+        self.properties = properties
+        self._clock = clock
+        self._lock_file = None
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def _claim(self):
+        """
+        :returns: ``True`` if this is the writer for ``path``.
+        """
+        if self._lock_file is not None:
+            return True
+        make_state_directory(self.path.parent())
+        f = open(self.path.siblingExtension('.lock').path, 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            f.close()
+            return False
+        self._lock_file = f
+        return True
+
+    def _release(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def publish(self):
+        """
+        List the array and replace the snapshot, if this is the writer.
+
+        :returns: ``True`` if a snapshot was written.
+        """
+        if not self._claim():
+            return False
+        taken_at = self._clock()
+        luns, storage_groups = self._client.list_inventory(self.properties)
+        temporary = self.path.temporarySibling()
+        with temporary.open('w') as f:
+            f.write(encode(
+                taken_at, [prop.key for prop in self.properties], luns,
+                storage_groups,
+            ))
+        os.rename(temporary.path, self.path.path)
+        Message.new(operation=u'inventory_snapshot',
+                    luns=len(luns),
+                    storage_groups=len(storage_groups),
+                    seconds=self._clock() - taken_at).write()
+        return True
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="vnx-snapshot")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._release()
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                self.publish()
+            except Exception:
+                write_traceback()
+            self._wake.wait(self.interval)
@@ -0,0 +1,184 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+A pool of spare LUNs which ``create_volume`` can claim instead of waiting
+for the array to create one.
+"""
+
+import threading
+from collections import deque
+from uuid import uuid4
+
+from eliot import Message, write_traceback
+
+SPARE_NAME_PREFIX = 'flockerspare'
+
+
+class WarmPool(object):
+    """
+    Keep up to ``depth`` spare LUNs of each of several sizes.
+
+    Spares are named ``flockerspare--<cluster>--<size>--<random>`` so that
+    they are never mistaken for a volume, and so that every node of a cluster
+    can claim spares created by any other.  A claim renames the spare to the
+    volume's LUN name; if another node renamed it first, the next spare is
+    tried.
+
+    :ivar list sizes: The sizes, in GiB, for which spares are kept.
+    :ivar int depth: How many spares of each size to keep.
+    :ivar int hits: How many claims were satisfied by a spare.
+    :ivar int misses: How many claims found no spare.
+    """
+    def __init__(self, client, storage_pool, cluster_id, sizes, depth,
+                 interval=60):
+        self._client = client
+        self._pool = storage_pool
+        self._prefix = '{}--{}--'.format(
+            SPARE_NAME_PREFIX, str(cluster_id).split('-')[0]
+        )
+        self.sizes = sorted(set(sizes))
+        self.depth = depth
+        self.interval = interval
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._spares = {size: deque() for size in self.sizes}
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def _spare_name(self, size):
+        return '{}{}--{}'.format(self._prefix, size, uuid4().hex[:12])
+
+    def _spare_size(self, lun_name):
+        """
+        :returns: The size class of the spare called ``lun_name``, or
+            ``None`` if it isn't one of this cluster's spares.
+        """
+        if not lun_name.startswith(self._prefix):
+            return None
+        try:
+            size = int(lun_name[len(self._prefix):].split('--', 1)[0])
+        except ValueError:
+            return None
+        if size not in self._spares:
+            return None
+        return size
+
+    def load(self):
+        """
+        Find the spares which already exist on the array, for example those
+        created before this process started or by other nodes.
+
+        The array is always asked afresh: a cached listing may still show
+        spares which have since been claimed, or miss new ones, and the
+        pool would then be refilled to the wrong depth.
+
+        :raises Exception: If the LUNs can't be listed.
+        """
+        found = {size: [] for size in self.sizes}
+        rc, luns = self._client.list_luns(self._client.LUN_INVENTORY)
+        if rc != 0:
+            raise Exception(rc, luns)
+        for lun in luns:
+            size = self._spare_size(lun.lun_name)
+            if size is not None:
+                found[size].append(lun.lun_name)
+        with self._lock:
+            for size, names in found.items():
+                self._spares[size] = deque(sorted(names))
+
+    def claim(self, size, lun_name):
+        """
+        Rename a spare of ``size`` GiB to ``lun_name``.
+
+        :returns: ``True`` if a spare was claimed, ``False`` if the caller
+            must create the LUN itself.
+        """
+        while size in self._spares:
+            with self._lock:
+                try:
+                    spare = self._spares[size].popleft()
+                except IndexError:
+                    break
+            rc, out = self._client.rename_volume(spare, lun_name)
+            Message.new(operation=u'warm_pool_claim',
+                        spare=spare,
+                        lun_name=lun_name,
+                        rc=rc,
+                        out=out).write()
+            if rc == 0:
+                with self._lock:
+                    self.hits += 1
+                self._wake.set()
+                return True
+            # Most likely claimed by another node; try the next one.
+        with self._lock:
+            self.misses += 1
+        self._wake.set()
+        return False
+
+    def refill(self):
+        """
+        Create spares until there are ``depth`` of each size.
+        """
+        for size in self.sizes:
+            while len(self._spares[size]) < self.depth:
+                if self._stopping:
+                    return
+                name = self._spare_name(size)
+                rc, out = self._client.create_volume(
+                    name, str(size), self._pool
+                )
+                Message.new(operation=u'warm_pool_refill',
+                            spare=name,
+                            size=size,
+                            rc=rc,
+                            out=out).write()
+                if rc != 0:
+                    break
+                self._client.wait_for_volume(name)
+                with self._lock:
+                    self._spares[size].append(name)
+
+    def stats(self):
+        """
+        :returns: A ``dict`` of the hit and miss counts and the number of
+            spares of each size.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'spares': {
+                    size: len(spares)
+                    for size, spares in self._spares.items()
+                },
+            }
+
+    def start(self):
+        """
+        Start refilling the pool in a background thread, after each claim and
+        every ``interval`` seconds.
+        """
+        self._thread = threading.Thread(
+            target=self._run, name="vnx-warm-pool"
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                self.load()
+                self.refill()
+            except Exception:
+                write_traceback()
+            self._wake.wait(self.interval)
+            self._wake.clear()
@@ -14,9 +14,13 @@ import yaml
 from uuid import uuid4
 
 from bitmath import GiB
+from twisted.python.filepath import FilePath
 
 from .. import EMCVnxBlockDeviceAPI
+from .._devices import SysfsPollingSource
 from .._driver import UNKNOWN_COMPUTE_ID
+from .._emulator import VNXEmulator, make_host_tree
+from .._hlu import HLUAllocator
 
 from flocker.node.agents.test.test_blockdevice import (
     make_iblockdeviceapi_tests, detach_destroy_volumes
@@ -41,7 +45,39 @@ def emcvnxblockdeviceapi_for_test(cluster_id, test_case):
     keys = config['naviseccli_keys']
     group = config['storage_group']
     host = config['hostname']
-    api = EMCVnxBlockDeviceAPI(cluster_id, ip, pool, host, group, keys)
+    api = EMCVnxBlockDeviceAPI(
+        cluster_id, ip, pool, host, group, keys,
+        hlu_reservation_directory=config.get('hlu_reservation_directory'),
+    )
+    test_case.addCleanup(detach_destroy_volumes, api)
+    return api
+
+
+def emulated_emcvnxblockdeviceapi_for_test(cluster_id, test_case):
+    """
+    Create a ``EMCVnxBlockDeviceAPI`` instance which runs a ``VNXEmulator``
+    instead of ``naviseccli`` and finds devices in fake ``sys`` and ``dev``
+    trees, so that no array or FC fabric is needed.
+
+    :returns: A ``EMCVnxBlockDeviceAPI`` instance
+    """
+    root = FilePath(test_case.mktemp())
+    root.makedirs()
+    emulator = VNXEmulator(root.child('array.json'))
+    emulator.create(pools=['pool'], storage_groups=['node1'])
+    naviseccli = root.child('naviseccli')
+    emulator.write_script(naviseccli)
+    sysfs, dev = make_host_tree(root)
+    bridge = emulator.bind_host('node1', sysfs, dev)
+    bridge.start()
+    test_case.addCleanup(bridge.stop)
+    api = EMCVnxBlockDeviceAPI(
+        cluster_id, '192.0.2.1', 'pool', u'node1', 'node1', '/keys',
+        naviseccli_path=naviseccli.path,
+        hlu_reservation_directory=root.child('run').path,
+    )
+    api._sysfs, api._dev = sysfs, dev
+    api._open_device_events = lambda: SysfsPollingSource(interval=0.01)
     test_case.addCleanup(detach_destroy_volumes, api)
     return api
 
@@ -76,7 +112,7 @@ class EMCVnxBlockDeviceAPIInterfaceTests(
         lun_name = self.api._get_lun_name_from_blockdevice_id(
             volume.blockdevice_id
         )
-        alu = self.api._client.get_lun_by_name(lun_name)['lun_id']
+        alu = self.api._client.get_lun_by_name(lun_name).lun_id
         storage_groups = self.api._client.storage_groups()
         foreign_storage_group_name, foreign_storage_group = [
             (group_name, group)
@@ -84,9 +120,9 @@ class EMCVnxBlockDeviceAPIInterfaceTests(
             if group_name != self.api._group
             and re.match(r'Docker\d+', group_name)
         ][0]
-        hlu = self.api._choose_hlu(
-            foreign_storage_group['lunmap']
-        )
+        hlu = HLUAllocator(
+            foreign_storage_group_name, directory=self.api._hlus.directory
+        ).reserve(foreign_storage_group.lunmap)
         rc, out = self.api._client.add_volume_to_sg(
             str(hlu), str(alu), foreign_storage_group_name
         )
@@ -104,3 +140,21 @@ class EMCVnxBlockDeviceAPIInterfaceTests(
             [volume.set('attached_to', UNKNOWN_COMPUTE_ID)],
             self.api.list_volumes()
         )
+
+
+class EmulatedEMCVnxBlockDeviceAPIInterfaceTests(
+        make_iblockdeviceapi_tests(
+            blockdevice_api_factory=(
+                lambda test_case: emulated_emcvnxblockdeviceapi_for_test(
+                    unicode(uuid4()).split('-')[0],
+                    test_case)
+            ),
+            minimum_allocatable_size=int(GiB(8).to_Byte().value),
+            device_allocation_unit=int(GiB(8).to_Byte().value),
+            unknown_blockdevice_id_factory=lambda test: unicode(uuid4())
+        )
+):
+    """
+    Interface adherence Tests for ``EMCVnxBlockDeviceAPI`` against an
+    emulated array.
+    """
@@ -0,0 +1,460 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Tests for ``flocker_emc_vnx_driver._async_driver``.
+"""
+
+from uuid import uuid4
+
+from twisted.internet.error import ProcessDone, ProcessTerminated
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from flocker.node.agents.blockdevice import (
+    AlreadyAttachedVolume, UnattachedVolume, UnknownVolume,
+)
+
+from .._async_driver import AsyncEMCVnxBlockDeviceAPI, AsyncEMCVNXClient
+from .._devices import Timeout
+from .._driver import FLOCKER_BACKEND, api_factory
+from .._emulator import (
+    RC_HLU_CONFLICT, RC_LUN_BUSY, VNXEmulator, make_host_tree,
+)
+from .._hlu import HLUConflict
+from .test_devices import FakeEventSource
+
+SIZE = 8 * 1024 ** 3
+
+
+class FakeThreadPool(object):
+    """
+    Run each function at once, in the calling thread.
+
+    :ivar bool running: Whether a function is being run.
+    """
+    running = False
+
+    def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+        self.running = True
+        try:
+            result = f(*args, **kwargs)
+        except Exception:
+            onResult(False, Failure())
+        else:
+            onResult(True, result)
+        finally:
+            self.running = False
+
+
+class FakeReactor(Clock):
+    """
+    A ``Clock`` which answers the ``naviseccli`` processes it is asked to
+    spawn from a ``VNXEmulator`` and does thread pool work synchronously.
+
+    :ivar bool hold: Keep new processes running until ``release`` is called,
+        rather than answering them at once.
+    :ivar list commands: The arguments of every process spawned.
+    """
+    def __init__(self, emulator):
+        Clock.__init__(self)
+        self.emulator = emulator
+        self.hold = False
+        self.commands = []
+        self.threadpool = FakeThreadPool()
+        self._held = []
+
+    def spawnProcess(self, protocol, executable, args=(), env={}, path=None,
+                     uid=None, gid=None, usePTY=0, childFDs=None):
+        self.commands.append(tuple(args[1:]))
+        if self.hold:
+            self._held.append((protocol, args[1:]))
+        else:
+            self._answer(protocol, args[1:])
+
+    def _answer(self, protocol, args):
+        rc, out = self.emulator.execute(args)
+        protocol.outReceived(out)
+        if rc == 0:
+            reason = ProcessDone(0)
+        else:
+            reason = ProcessTerminated(exitCode=rc)
+        protocol.processEnded(Failure(reason))
+
+    def release(self):
+        """
+        Answer the processes which are being held.
+        """
+        held, self._held = self._held, []
+        for protocol, args in held:
+            self._answer(protocol, args)
+
+    def running(self):
+        return len(self._held)
+
+    def getThreadPool(self):
+        return self.threadpool
+
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+class AsyncTestsMixin(object):
+    """
+    Set up an emulated array and host tree for the asynchronous API.
+    """
+    def setUp(self):
+        root = FilePath(self.mktemp())
+        root.makedirs()
+        self.emulator = VNXEmulator(root.child('array.json'))
+        self.emulator.create(storage_groups=['node1'])
+        self.sysfs, self.dev = make_host_tree(root)
+        self.emulator.bind_host('node1', self.sysfs, self.dev)
+        self.reactor = FakeReactor(self.emulator)
+        self.api = AsyncEMCVnxBlockDeviceAPI(
+            self.reactor, cluster_id=uuid4(), spa_ip='192.0.2.1',
+            storage_pool='pool', hostname=u'node1', storage_group=u'node1',
+            naviseccli_keys='/keys',
+            hlu_reservation_directory=root.child('run').path,
+        )
+        self.api._sysfs, self.api._dev = self.sysfs, self.dev
+        self.scan_when_waiting()
+
+    def scan_when_waiting(self):
+        """
+        Show the devices of newly added LUNs once the device wait begins.
+        """
+        self.api._open_device_events = lambda: FakeEventSource(
+            self.reactor, [lambda: self.emulator.scanned('node1')]
+        )
+
+    def create(self):
+        return self.successResultOf(self.api.create_volume(uuid4(), SIZE))
+
+    def subcommands(self):
+        return [args[4:6] for args in self.reactor.commands]
+
+
+class AsyncClientTests(AsyncTestsMixin, SynchronousTestCase):
+    """
+    Tests for ``AsyncEMCVNXClient``.
+    """
+    def test_workers(self):
+        """
+        No more than ``workers`` ``naviseccli`` processes run at once.
+        """
+        client = AsyncEMCVNXClient(
+            self.reactor, '192.0.2.1', '/keys', workers=1
+        )
+        self.reactor.hold = True
+        results = [client.get_storage_group('node1') for _ in range(2)]
+        running = self.reactor.running()
+        self.reactor.release()
+        self.reactor.release()
+        self.assertEqual(
+            (1, [0, 0]),
+            (running, [self.successResultOf(d)[0] for d in results])
+        )
+
+    def test_unlimited(self):
+        """
+        By default every command runs at once.
+        """
+        client = AsyncEMCVNXClient(self.reactor, '192.0.2.1', '/keys')
+        self.reactor.hold = True
+        for _ in range(3):
+            client.get_storage_group('node1')
+        self.assertEqual(3, self.reactor.running())
+
+
+class CreateDestroyTests(AsyncTestsMixin, SynchronousTestCase):
+    """
+    Tests for ``AsyncEMCVnxBlockDeviceAPI.create_volume`` and
+    ``destroy_volume``.
+    """
+    def test_create(self):
+        """
+        ``create_volume`` creates a LUN of the requested size in the pool.
+        """
+        volume = self.create()
+        lun = self.successResultOf(
+            self.api._client.get_lun_by_name(
+                self.api._get_lun_name_from_blockdevice_id(
+                    volume.blockdevice_id
+                )
+            )
+        )
+        self.assertEqual(
+            (SIZE, None, 8.0), (volume.size, volume.attached_to,
+                                lun.total_capacity_gb)
+        )
+
+    def test_create_failure(self):
+        """
+        ``create_volume`` fails if ``naviseccli`` does.
+        """
+        self.emulator.configure(faults={'lun -create': [1]})
+        self.failureResultOf(
+            self.api.create_volume(uuid4(), SIZE), Exception
+        )
+
+    def test_destroy(self):
+        """
+        A destroyed volume is no longer listed and can't be destroyed again.
+        """
+        volume = self.create()
+        self.successResultOf(self.api.destroy_volume(volume.blockdevice_id))
+        self.assertEqual([], self.successResultOf(self.api.list_volumes()))
+        self.failureResultOf(
+            self.api.destroy_volume(volume.blockdevice_id), UnknownVolume
+        )
+
+    def test_destroy_busy(self):
+        """
+        While the LUN is busy, ``destroy_volume`` tries again a second later
+        without blocking the reactor.
+        """
+        volume = self.create()
+        self.emulator.configure(faults={'lun -destroy': [RC_LUN_BUSY] * 2})
+        d = self.api.destroy_volume(volume.blockdevice_id)
+        self.assertNoResult(d)
+        self.reactor.advance(1)
+        self.assertNoResult(d)
+        self.reactor.advance(1)
+        self.successResultOf(d)
+        self.assertEqual(
+            [('lun', '-destroy')] * 3,
+            [command for command in self.subcommands()
+             if command == ('lun', '-destroy')]
+        )
+
+    def test_destroy_busy_too_long(self):
+        """
+        ``destroy_volume`` gives up after three retries.
+        """
+        volume = self.create()
+        self.emulator.configure(faults={'lun -destroy': [RC_LUN_BUSY] * 4})
+        d = self.api.destroy_volume(volume.blockdevice_id)
+        self.reactor.pump([1] * 3)
+        self.failureResultOf(d, Exception)
+
+
+class AttachDetachTests(AsyncTestsMixin, SynchronousTestCase):
+    """
+    Tests for ``AsyncEMCVnxBlockDeviceAPI.attach_volume``,
+    ``detach_volume`` and ``list_volumes``.
+    """
+    def setUp(self):
+        AsyncTestsMixin.setUp(self)
+        self.volume = self.create()
+
+    def attach(self):
+        return self.successResultOf(
+            self.api.attach_volume(self.volume.blockdevice_id, u'node1')
+        )
+
+    def test_attach(self):
+        """
+        ``attach_volume`` adds the LUN to the storage group, scans for it and
+        waits for its device.
+        """
+        attached = self.attach()
+        self.assertEqual(
+            (u'node1', self.dev.child('sda'),
+             [('storagegroup', '-addhlu')]),
+            (attached.attached_to,
+             self.successResultOf(
+                 self.api.get_device_path(self.volume.blockdevice_id)
+             ),
+             [command for command in self.subcommands()
+              if command == ('storagegroup', '-addhlu')])
+        )
+
+    def test_scanned(self):
+        """
+        The HLU of the LUN is scanned for on the FC host.
+        """
+        self.attach()
+        self.assertEqual(
+            '0 0 1\n',
+            self.sysfs.descendant(
+                ['class', 'scsi_host', 'host1', 'scan']
+            ).getContent()
+        )
+
+    def test_already_attached(self):
+        """
+        Attaching a volume whose device is already present fails with
+        ``AlreadyAttachedVolume``.
+        """
+        self.attach()
+        self.failureResultOf(
+            self.api.attach_volume(self.volume.blockdevice_id, u'node1'),
+            AlreadyAttachedVolume
+        )
+
+    def test_probes_in_thread(self):
+        """
+        ``attach_volume`` and ``get_device_path`` look for local devices in
+        the thread pool rather than reading sysfs on the reactor thread.
+        """
+        probes = []
+
+        def record(f):
+            def probe(*args, **kwargs):
+                probes.append(
+                    (f.__name__, self.reactor.threadpool.running)
+                )
+                return f(*args, **kwargs)
+            return probe
+        self.api._local_device = record(self.api._local_device)
+        self.api._known_device_path = record(self.api._known_device_path)
+        self.attach()
+        self.api._forget_device(self.volume.blockdevice_id)
+        self.successResultOf(
+            self.api.get_device_path(self.volume.blockdevice_id)
+        )
+        self.assertEqual(
+            set([('_local_device', True), ('_known_device_path', True)]),
+            set(probes)
+        )
+
+    def test_timeout(self):
+        """
+        If the device never appears, ``attach_volume`` scans again and waits
+        longer, six times, before failing with ``Timeout``.
+        """
+        events = []
+
+        def open_events():
+            events.append(FakeEventSource(self.reactor, []))
+            return events[-1]
+        self.api._open_device_events = open_events
+        d = self.api.attach_volume(self.volume.blockdevice_id, u'node1')
+        self.failureResultOf(d, Timeout)
+        self.assertEqual(
+            (6, 5 + 10 + 15 + 20 + 25 + 30),
+            (events[0].waits, self.reactor.seconds())
+        )
+
+    def test_foreign_group(self):
+        """
+        If every HLU is refused because the LUN has meanwhile been added to
+        another node's storage group, attaching fails with
+        ``AlreadyAttachedVolume``.
+        """
+        self.emulator.configure(
+            faults={'storagegroup -addhlu': [RC_HLU_CONFLICT] * 5}
+        )
+        self.emulator.add_hlus({'node2': [(3, 0)]})
+        self.failureResultOf(
+            self.api.attach_volume(self.volume.blockdevice_id, u'node1'),
+            AlreadyAttachedVolume
+        )
+
+    def test_conflicts_exhausted(self):
+        """
+        If every HLU is refused although the LUN isn't in any storage group,
+        attaching fails with ``HLUConflict``.
+        """
+        self.emulator.configure(
+            faults={'storagegroup -addhlu': [RC_HLU_CONFLICT] * 5}
+        )
+        self.failureResultOf(
+            self.api.attach_volume(self.volume.blockdevice_id, u'node1'),
+            HLUConflict
+        )
+
+    def test_unknown(self):
+        """
+        Attaching a volume which doesn't exist fails with ``UnknownVolume``.
+        """
+        self.failureResultOf(
+            self.api.attach_volume(u'block-{}'.format(uuid4()), u'node1'),
+            UnknownVolume
+        )
+
+    def test_detach(self):
+        """
+        ``detach_volume`` removes the device and the LUN from the storage
+        group.
+        """
+        self.attach()
+        self.successResultOf(
+            self.api.detach_volume(self.volume.blockdevice_id)
+        )
+        self.assertEqual(
+            ([None], False),
+            ([volume.attached_to
+              for volume in self.successResultOf(self.api.list_volumes())],
+             self.dev.child('sda').exists())
+        )
+
+    def test_detach_unattached(self):
+        """
+        Detaching a volume which isn't attached fails with
+        ``UnattachedVolume``.
+        """
+        self.failureResultOf(
+            self.api.detach_volume(self.volume.blockdevice_id),
+            UnattachedVolume
+        )
+
+    def test_list_volumes(self):
+        """
+        ``list_volumes`` lists every volume of the cluster, with those in
+        this node's storage group attached to it.
+        """
+        other = self.create()
+        self.attach()
+        self.assertEqual(
+            {self.volume.blockdevice_id: u'node1',
+             other.blockdevice_id: None},
+            {volume.blockdevice_id: volume.attached_to
+             for volume in self.successResultOf(self.api.list_volumes())}
+        )
+
+
+class APIFactoryTests(SynchronousTestCase):
+    """
+    Tests for ``api_factory`` with ``asynchronous: true``.
+    """
+    def make(self, **kwargs):
+        return api_factory(
+            uuid4(), reactor=Clock(), asynchronous=True, spa_ip='192.0.2.1',
+            storage_pool='pool', hostname=u'node1', storage_group=u'node1',
+            naviseccli_keys='/keys', **kwargs
+        )
+
+    def test_options(self):
+        """
+        The options which don't need background threads are accepted.
+        """
+        api = self.make(
+            multipath=True, naviseccli_workers=4,
+            naviseccli_output_format='xml', naviseccli_path='/bin/vnx',
+            naviseccli_debug=True,
+        )
+        self.assertEqual(
+            (True, 4, '/bin/vnx', True),
+            (api._multipath, api._client._semaphore.limit,
+             api._client._commands.cli[0],
+             api._client._commands.output.keep_raw_output)
+        )
+
+    def test_synchronous_only(self):
+        """
+        Options which need the synchronous API's background threads are
+        rejected, naming them.
+        """
+        e = self.assertRaises(
+            ValueError, self.make, warm_pool_depth=2, background_destroy=True
+        )
+        self.assertEqual(['background_destroy', 'warm_pool_depth'], e.args[1])
+
+    def test_reactor_not_required(self):
+        """
+        Synchronous deployments aren't given a reactor.
+        """
+        self.assertFalse(FLOCKER_BACKEND.needs_reactor)
@@ -0,0 +1,78 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Tests for ``flocker_emc_vnx_driver._benchmark``.
+"""
+
+import json
+from StringIO import StringIO
+
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._benchmark import CASES, Fleet, main, run
+
+
+class FleetTests(SynchronousTestCase):
+    """
+    Tests for ``Fleet``.
+    """
+    def test_inventory(self):
+        """
+        A tenth of the LUNs belong to another cluster and half are mapped,
+        evenly, among the storage groups.
+        """
+        fleet = Fleet(FilePath(self.mktemp()), 40, 2)
+        volumes = fleet.api.list_volumes()
+        self.assertEqual(
+            # Two of the 20 mapped LUNs are another cluster's.
+            (36, 18, [u'node1', u'node2']),
+            (len(volumes),
+             len([v for v in volumes if v.attached_to is not None]),
+             sorted(fleet.api._client.storage_groups()))
+        )
+
+
+class RunTests(SynchronousTestCase):
+    """
+    Tests for ``run`` and ``main``.
+    """
+    def test_results(self):
+        """
+        ``run`` times each case at each scale, with its memory use.
+        """
+        cases = [case for case in CASES if case[0] != 'attach_detach']
+        results = run(FilePath(self.mktemp()), [(10, 1), (20, 2)], cases, 2)
+        self.assertEqual(
+            ([(name, luns) for luns in (10, 20) for name, _ in cases],
+             [2] * len(results), True),
+            ([(r['case'], r['luns']) for r in results],
+             [len(r['seconds']) for r in results],
+             all(r['peak_rss_kb'] > 0 and r['min'] <= r['median']
+                 for r in results))
+        )
+
+    def test_compare(self):
+        """
+        ``main`` writes the results as JSON and prints how long each case
+        took relative to a baseline.
+        """
+        baseline = FilePath(self.mktemp())
+        baseline.setContent(json.dumps({'results': [{
+            'case': 'parse_sg_content', 'luns': 100, 'storage_groups': 1,
+            'min': 1e-9,
+        }]}))
+        output = FilePath(self.mktemp())
+        stdout = StringIO()
+        main(['--case', 'parse_sg_content', '--repeats', '1',
+              '--output', output.path, '--compare', baseline.path,
+              '--directory', self.mktemp()],
+             stdout=stdout)
+        results = json.loads(output.getContent())['results']
+        # Only the first scale has a baseline, so only it has a ratio.
+        lines = stdout.getvalue().splitlines()[1:]
+        self.assertEqual(
+            (['parse_sg_content'] * 2, [7, 6]),
+            ([result['case'] for result in results],
+             [len(line.split()) for line in lines])
+        )
@@ -0,0 +1,73 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Tests for ``flocker_emc_vnx_driver._cache``.
+"""
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._cache import TTLCache
+
+
+class TTLCacheTests(SynchronousTestCase):
+    """
+    Tests for ``TTLCache``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = TTLCache(
+            ttl=10, max_entries=2, clock=self.clock.seconds
+        )
+
+    def test_disabled(self):
+        """
+        A cache with a ``ttl`` of zero never stores anything.
+        """
+        cache = TTLCache(ttl=0)
+        cache.set('key', 'value')
+        self.assertIs(None, cache.get('key'))
+
+    def test_expiry(self):
+        """
+        Entries are returned until ``ttl`` seconds after they were stored.
+        """
+        self.cache.set('key', 'value')
+        self.clock.advance(9)
+        self.assertEqual('value', self.cache.get('key'))
+        self.clock.advance(1)
+        self.assertIs(None, self.cache.get('key'))
+
+    def test_evicts_least_recently_used(self):
+        """
+        Storing more than ``max_entries`` entries discards the entry which was
+        used least recently.
+        """
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEqual(
+            (1, None, 3),
+            (self.cache.get('a'), self.cache.get('b'), self.cache.get('c'))
+        )
+
+    def test_invalidate(self):
+        """
+        ``invalidate`` discards the entries whose keys match the predicate.
+        """
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.invalidate(lambda key: key == 'a')
+        self.assertEqual(
+            (None, 2), (self.cache.get('a'), self.cache.get('b'))
+        )
+
+    def test_stale_generation(self):
+        """
+        A value fetched before an invalidation is not stored.
+        """
+        generation = self.cache.generation()
+        self.cache.invalidate(lambda key: True)
+        self.cache.set('a', 1, generation)
+        self.assertIs(None, self.cache.get('a'))
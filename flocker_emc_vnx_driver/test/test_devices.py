@@ -0,0 +1,442 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Tests for ``flocker_emc_vnx_driver._devices``.
+"""
+
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+from zope.interface import implementer
+from zope.interface.verify import verifyObject
+
+from .._devices import (
+    DeviceState, IDeviceEventSource, SysfsPollingSource,
+    _is_device_event, device_still_attached, hlu_bus_paths,
+    multipath_device, path_devices, probe_block_device,
+    ready_multipath_device, scan_hlus, wait_for_devices,
+)
+
+
+def make_fake_host(test_case, fc_hosts=(1,)):
+    """
+    Create empty ``sys`` and ``dev`` trees with the given FC hosts.
+
+    :returns: A ``tuple`` of the ``sys`` and ``dev`` ``FilePath`` objects.
+    """
+    root = FilePath(test_case.mktemp())
+    sysfs = root.child('sys')
+    dev = root.child('dev')
+    dev.makedirs()
+    for host in fc_hosts:
+        for host_class in ('fc_host', 'scsi_host'):
+            sysfs.descendant(
+                ['class', host_class, 'host{}'.format(host)]
+            ).makedirs()
+    return sysfs, dev
+
+
+def add_fake_device(sysfs, dev, host, hlu, name, size):
+    """
+    Make a SCSI disk appear in the fake trees created by ``make_fake_host``.
+    """
+    block = sysfs.descendant(
+        ['class', 'scsi_disk', '{}:0:0:{}'.format(host, hlu),
+         'device', 'block', name]
+    )
+    if not block.exists():
+        block.makedirs()
+    # On a real system /sys/block/<name> is the same directory.
+    sys_block = sysfs.descendant(['block', name])
+    if not sys_block.exists():
+        sys_block.makedirs()
+    sys_block.child('size').setContent('{}\n'.format(size))
+    dev.child(name).touch()
+
+
+def set_fake_wwid(sysfs, name, wwid):
+    """
+    Give a device created by ``add_fake_device`` a wwid.
+    """
+    device = sysfs.descendant(['block', name, 'device'])
+    if not device.exists():
+        device.makedirs()
+    device.child('wwid').setContent(wwid + '\n')
+
+
+def add_fake_multipath(sysfs, dev, name, slaves, size):
+    """
+    Make a device-mapper device built from ``slaves`` appear in the fake
+    trees created by ``make_fake_host``.
+    """
+    block = sysfs.descendant(['block', name])
+    block.child('slaves').makedirs()
+    block.child('size').setContent('{}\n'.format(size))
+    for slave in slaves:
+        block.descendant(['slaves', slave]).touch()
+        holders = sysfs.descendant(['block', slave, 'holders'])
+        if not holders.exists():
+            holders.makedirs()
+        holders.child(name).touch()
+    dev.child(name).touch()
+
+
+@implementer(IDeviceEventSource)
+class FakeEventSource(object):
+    """
+    Deliver a scripted sequence of changes, one per ``wait``.
+
+    :ivar list changes: Callables, each run by one call to ``wait``.
+    """
+    def __init__(self, clock, changes):
+        self.clock = clock
+        self.changes = list(changes)
+        self.waits = 0
+
+    def wait(self, timeout):
+        self.waits += 1
+        if self.changes:
+            self.changes.pop(0)()
+            return True
+        self.clock.advance(timeout)
+        return False
+
+    def close(self):
+        pass
+
+
+class IsDeviceEventTests(SynchronousTestCase):
+    """
+    Tests for ``_is_device_event``.
+    """
+    def test_block(self):
+        """
+        Events from the block subsystem are device events.
+        """
+        self.assertTrue(
+            _is_device_event(
+                'add@/devices/pci0000:00/host1/target1:0:0/1:0:0:5/block/sdb'
+                '\0ACTION=add\0SUBSYSTEM=block\0DEVNAME=sdb\0'
+            )
+        )
+
+    def test_other(self):
+        """
+        Events from unrelated subsystems are not device events.
+        """
+        self.assertFalse(
+            _is_device_event('add@/module/foo\0ACTION=add\0SUBSYSTEM=module')
+        )
+
+
+class WaitForDevicesTests(SynchronousTestCase):
+    """
+    Tests for ``wait_for_devices``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.sysfs, self.dev = make_fake_host(self)
+        self.finders = {
+            name: lambda name=name: (
+                self.dev.child(name)
+                if probe_block_device(self.dev.child(name), self.sysfs)
+                is DeviceState.READY else None
+            )
+            for name in ('sdb', 'sdc')
+        }
+
+    def test_interface(self):
+        """
+        The sources provide ``IDeviceEventSource``.
+        """
+        self.assertTrue(
+            verifyObject(IDeviceEventSource, SysfsPollingSource())
+        )
+
+    def test_all(self):
+        """
+        ``wait_for_devices`` returns once every device has been found, in
+        whatever order they appear.
+        """
+        events = FakeEventSource(self.clock, [
+            lambda: add_fake_device(self.sysfs, self.dev, 1, 6, 'sdc', 1),
+            lambda: add_fake_device(self.sysfs, self.dev, 1, 5, 'sdb', 1),
+        ])
+        self.assertEqual(
+            {'sdb': self.dev.child('sdb'), 'sdc': self.dev.child('sdc')},
+            wait_for_devices(events, self.finders, 10, self.clock.seconds)
+        )
+
+    def test_partial(self):
+        """
+        After the timeout, ``wait_for_devices`` returns the devices found so
+        far.
+        """
+        events = FakeEventSource(self.clock, [
+            lambda: add_fake_device(self.sysfs, self.dev, 1, 6, 'sdc', 1),
+        ])
+        self.assertEqual(
+            {'sdc': self.dev.child('sdc')},
+            wait_for_devices(events, self.finders, 10, self.clock.seconds)
+        )
+
+
+class ScanHLUsTests(SynchronousTestCase):
+    """
+    Tests for ``scan_hlus``.
+    """
+    def test_scans_every_host(self):
+        """
+        ``scan_hlus`` writes a targeted triplet for each HLU to the ``scan``
+        attribute of every FC host and reports how long each took.
+        """
+        sysfs, dev = make_fake_host(self, fc_hosts=(1, 3))
+        latencies = scan_hlus([16, 17], sysfs)
+        self.assertEqual(
+            ([1, 3], ['0 0 17\n', '0 0 17\n']),
+            (sorted(latencies),
+             [sysfs.descendant(
+                 ['class', 'scsi_host', 'host{}'.format(host), 'scan']
+             ).getContent() for host in (1, 3)])
+        )
+
+    def test_failure(self):
+        """
+        A failure to scan any host is raised once every scan has finished.
+        """
+        sysfs, dev = make_fake_host(self, fc_hosts=(1, 3))
+        sysfs.descendant(['class', 'scsi_host', 'host3']).remove()
+        self.assertRaises(IOError, scan_hlus, [17], sysfs)
+
+
+class ProbeBlockDeviceTests(SynchronousTestCase):
+    """
+    Tests for ``probe_block_device``.
+    """
+    def setUp(self):
+        self.sysfs, self.dev = make_fake_host(self)
+
+    def test_absent(self):
+        """
+        A device without a device node is absent.
+        """
+        self.assertIs(
+            DeviceState.ABSENT,
+            probe_block_device(self.dev.child('sdb'), self.sysfs)
+        )
+
+    def test_zero_capacity(self):
+        """
+        A device whose sysfs size is zero has zero capacity.
+        """
+        add_fake_device(self.sysfs, self.dev, 1, 5, 'sdb', 0)
+        self.assertIs(
+            DeviceState.ZERO_CAPACITY,
+            probe_block_device(self.dev.child('sdb'), self.sysfs)
+        )
+
+    def test_ready(self):
+        """
+        A device with a non-zero sysfs size is ready.
+        """
+        add_fake_device(self.sysfs, self.dev, 1, 5, 'sdb', 16777216)
+        self.assertIs(
+            DeviceState.READY,
+            probe_block_device(self.dev.child('sdb'), self.sysfs)
+        )
+
+    def test_size_from_device_node(self):
+        """
+        Without a sysfs entry, the size is found by seeking to the end of the
+        device node.
+        """
+        self.dev.child('sdb').setContent('x' * 512)
+        self.assertIs(
+            DeviceState.READY,
+            probe_block_device(self.dev.child('sdb'), self.sysfs)
+        )
+
+
+class DeviceStillAttachedTests(SynchronousTestCase):
+    """
+    Tests for ``device_still_attached``.
+    """
+    def setUp(self):
+        self.sysfs, self.dev = make_fake_host(self)
+        add_fake_device(self.sysfs, self.dev, 1, 5, 'sdb', 16777216)
+        self.hlu_bus_path = hlu_bus_paths(5, self.sysfs)[0]
+        self.device = self.dev.child('sdb')
+
+    def set_wwid(self, wwid):
+        set_fake_wwid(self.sysfs, 'sdb', wwid)
+
+    def test_attached(self):
+        """
+        A ready device still under its bus path is attached.
+        """
+        self.assertTrue(
+            device_still_attached(
+                self.device, self.hlu_bus_path, None, self.sysfs
+            )
+        )
+
+    def test_moved(self):
+        """
+        A device which is no longer under the bus path it was found at is
+        not attached.
+        """
+        other_bus_path = self.sysfs.descendant(
+            ['class', 'scsi_disk', '1:0:0:6']
+        )
+        self.assertFalse(
+            device_still_attached(
+                self.device, other_bus_path, None, self.sysfs
+            )
+        )
+
+    def test_removed(self):
+        """
+        A device whose node has gone is not attached.
+        """
+        self.device.remove()
+        self.assertFalse(
+            device_still_attached(
+                self.device, self.hlu_bus_path, None, self.sysfs
+            )
+        )
+
+    def test_same_wwid(self):
+        """
+        A device whose wwid is the LUN UID is attached.
+        """
+        self.set_wwid('naa.600601601e0036003a3a5e1b1bc8e511')
+        self.assertTrue(
+            device_still_attached(
+                self.device, self.hlu_bus_path,
+                '600601601e0036003a3a5e1b1bc8e511', self.sysfs
+            )
+        )
+
+    def test_different_wwid(self):
+        """
+        A device whose wwid belongs to some other LUN is not attached.
+        """
+        self.set_wwid('naa.600601601e0036003a3a5e1b1bc8e511')
+        self.assertFalse(
+            device_still_attached(
+                self.device, self.hlu_bus_path,
+                '600601601e0036009999999999999999', self.sysfs
+            )
+        )
+
+    def test_multipath(self):
+        """
+        A multipath device is attached if the disks it is made of are the
+        LUN.
+        """
+        self.set_wwid('naa.600601601e0036003a3a5e1b1bc8e511')
+        add_fake_multipath(self.sysfs, self.dev, 'dm-0', ['sdb'], 16777216)
+        self.assertTrue(
+            device_still_attached(
+                self.dev.child('dm-0'), self.hlu_bus_path,
+                '600601601e0036003a3a5e1b1bc8e511', self.sysfs
+            )
+        )
+
+    def test_multipath_no_paths(self):
+        """
+        A multipath device without any disks is not attached.
+        """
+        add_fake_multipath(self.sysfs, self.dev, 'dm-0', [], 16777216)
+        self.assertFalse(
+            device_still_attached(
+                self.dev.child('dm-0'), self.hlu_bus_path, None, self.sysfs
+            )
+        )
+
+
+LUN_UID = '600601601e0036003a3a5e1b1bc8e511'
+
+
+class MultipathTests(SynchronousTestCase):
+    """
+    Tests for ``path_devices``, ``multipath_device`` and
+    ``ready_multipath_device``.
+    """
+    def setUp(self):
+        self.sysfs, self.dev = make_fake_host(self, fc_hosts=(1, 2))
+        self.bus_paths = hlu_bus_paths(5, self.sysfs)
+
+    def add_path(self, host, name, wwid=LUN_UID):
+        add_fake_device(self.sysfs, self.dev, host, 5, name, 16777216)
+        set_fake_wwid(self.sysfs, name, 'naa.' + wwid)
+
+    def test_path_devices(self):
+        """
+        ``path_devices`` finds the disk for the LUN on each FC host.
+        """
+        self.add_path(1, 'sdb')
+        self.add_path(2, 'sdc')
+        self.assertEqual(
+            [self.dev.child('sdb'), self.dev.child('sdc')],
+            path_devices(self.bus_paths, LUN_UID, self.sysfs, self.dev)
+        )
+
+    def test_path_devices_other_lun(self):
+        """
+        ``path_devices`` ignores disks which belong to another LUN.
+        """
+        self.add_path(1, 'sdb')
+        self.add_path(2, 'sdc', wwid='600601601e0036009999999999999999')
+        self.assertEqual(
+            [self.dev.child('sdb')],
+            path_devices(self.bus_paths, LUN_UID, self.sysfs, self.dev)
+        )
+
+    def test_multipath_device(self):
+        """
+        ``multipath_device`` finds the device-mapper device holding all of
+        the paths.
+        """
+        self.add_path(1, 'sdb')
+        self.add_path(2, 'sdc')
+        add_fake_multipath(
+            self.sysfs, self.dev, 'dm-3', ['sdb', 'sdc'], 16777216
+        )
+        self.assertEqual(
+            self.dev.child('dm-3'),
+            multipath_device(
+                [self.dev.child('sdb'), self.dev.child('sdc')],
+                self.sysfs, self.dev
+            )
+        )
+
+    def test_no_multipath_device(self):
+        """
+        ``multipath_device`` returns ``None`` before ``multipathd`` has
+        assembled the paths.
+        """
+        self.add_path(1, 'sdb')
+        self.assertIs(
+            None,
+            multipath_device([self.dev.child('sdb')], self.sysfs, self.dev)
+        )
+
+    def test_ready_multipath_device(self):
+        """
+        ``ready_multipath_device`` finds nothing until the LUN has appeared
+        on every FC host and been assembled into a multipath device.
+        """
+        found = []
+        for change in [
+            lambda: self.add_path(1, 'sdb'),
+            lambda: self.add_path(2, 'sdc'),
+            lambda: add_fake_multipath(
+                self.sysfs, self.dev, 'dm-0', ['sdb', 'sdc'], 16777216
+            ),
+        ]:
+            change()
+            found.append(ready_multipath_device(
+                self.bus_paths, LUN_UID, self.sysfs, self.dev
+            ))
+        self.assertEqual([None, None, self.dev.child('dm-0')], found)
@@ -0,0 +1,430 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Tests for ``flocker_emc_vnx_driver._driver``.
+"""
+
+import json
+from uuid import uuid4
+
+from eliot import add_destination, remove_destination
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+from zope.interface import implementer
+
+from flocker.node.agents.blockdevice import (
+    AlreadyAttachedVolume, UnknownVolume,
+)
+
+from .._executor import CommandResult, ICommandExecutor
+from .._driver import EMCVnxBlockDeviceAPI
+from .._driver import BulkOperationFailed
+from .._hlu import HLUConflict
+from .._report import LatencyReport
+from .test_devices import (
+    FakeEventSource, add_fake_device, add_fake_multipath, make_fake_host,
+)
+
+LUN_UID = '600601601e0036003a3a5e1b1bc8e511'
+
+LUN_OUTPUT = """\
+LOGICAL UNIT NUMBER 7
+Name:  {name}
+UID:  60:06:01:60:1E:00:36:00:3A:3A:5E:1B:1B:C8:E5:11
+User Capacity (GBs):  8.000
+
+"""
+
+STORAGE_GROUP_OUTPUT = """\
+Storage Group Name:    node1
+Storage Group UID:     6C:E9:6A:4A:27:CB:E5:11:A9:85:00:60:16:3A:33:3A
+HLU/ALU Pairs:
+
+  HLU Number     ALU Number
+  ----------     ----------
+    5               7
+"""
+
+FOREIGN_STORAGE_GROUP_OUTPUT = """\
+Storage Group Name:    node2
+Storage Group UID:     6C:E9:6A:4A:27:CB:E5:11:A9:85:00:60:16:3A:33:3B
+HLU/ALU Pairs:
+
+  HLU Number     ALU Number
+  ----------     ----------
+    3               8
+"""
+
+
+@implementer(ICommandExecutor)
+class FakeExecutor(object):
+    """
+    Answer ``lun -list`` and ``storagegroup -list`` with canned output.
+
+    :ivar dict results: Maps an action, eg ``-addhlu``, to a ``list`` of
+        ``(rc, out)`` results to give, in order, for that action.
+    :ivar list commands: Every command submitted.
+    """
+    def __init__(self, lun_output, storage_group_output):
+        self.outputs = {
+            'lun': lun_output, 'storagegroup': storage_group_output
+        }
+        self.results = {}
+        self.commands = []
+
+    def submit(self, cmd, parse=None):
+        self.commands.append(cmd)
+        rc, out = 0, self.outputs.get(cmd[5], '')
+        if self.results.get(cmd[6]):
+            rc, out = self.results[cmd[6]].pop(0)
+        if parse is not None:
+            out = parse(iter(out.splitlines(True)))
+        result = CommandResult()
+        result._complete((rc, out, ''))
+        return result
+
+
+class APITestsMixin(object):
+    """
+    Set up an ``EMCVnxBlockDeviceAPI`` with a fake array and fake sysfs.
+    """
+    def setUp(self):
+        cluster_id = uuid4()
+        self.blockdevice_id = u'block-{}'.format(uuid4())
+        self.reservations = FilePath(self.mktemp())
+        self.api = EMCVnxBlockDeviceAPI(
+            cluster_id=cluster_id, spa_ip='192.0.2.1',
+            storage_pool='pool', hostname=u'node1', storage_group=u'node1',
+            naviseccli_keys='/keys',
+            hlu_reservation_directory=self.reservations.path,
+        )
+        self.executor = FakeExecutor(
+            LUN_OUTPUT.format(
+                name=self.api._get_lun_name_from_blockdevice_id(
+                    self.blockdevice_id
+                )
+            ),
+            STORAGE_GROUP_OUTPUT,
+        )
+        self.api._client.executor = self.executor
+        self.api._sysfs, self.api._dev = make_fake_host(self)
+        add_fake_device(self.api._sysfs, self.api._dev, 1, 5, 'sdb', 16)
+        device = self.api._sysfs.descendant(['block', 'sdb', 'device'])
+        device.makedirs()
+        device.child('wwid').setContent('naa.{}\n'.format(LUN_UID))
+
+
+class GetDevicePathTests(APITestsMixin, SynchronousTestCase):
+    """
+    Tests for ``EMCVnxBlockDeviceAPI.get_device_path``.
+    """
+
+    def test_found_on_array(self):
+        """
+        The first lookup asks the array which HLU the LUN has and returns
+        the device for that HLU.
+        """
+        self.assertEqual(
+            self.api._dev.child('sdb'),
+            self.api.get_device_path(self.blockdevice_id)
+        )
+        self.assertEqual(2, len(self.executor.commands))
+
+    def test_remembered(self):
+        """
+        Later lookups are answered locally.
+        """
+        self.api.get_device_path(self.blockdevice_id)
+        del self.executor.commands[:]
+        self.assertEqual(
+            self.api._dev.child('sdb'),
+            self.api.get_device_path(self.blockdevice_id)
+        )
+        self.assertEqual([], self.executor.commands)
+
+    def test_stale(self):
+        """
+        If the remembered device now belongs to a different LUN, the array is
+        asked again.
+        """
+        self.api.get_device_path(self.blockdevice_id)
+        self.api._sysfs.descendant(
+            ['block', 'sdb', 'device', 'wwid']
+        ).setContent('naa.600601601e0036009999999999999999\n')
+        del self.executor.commands[:]
+        self.api.get_device_path(self.blockdevice_id)
+        self.assertEqual(2, len(self.executor.commands))
+
+    def test_forgotten_on_list(self):
+        """
+        Listing volumes forgets the devices of volumes which are no longer
+        attached to this node.
+        """
+        self.api.get_device_path(self.blockdevice_id)
+        self.executor.outputs['storagegroup'] = ''
+        self.api.list_volumes()
+        self.assertNotIn(self.blockdevice_id, self.api._device_path_map)
+
+    def test_multipath(self):
+        """
+        In multipath mode the device-mapper device combining the paths to
+        the LUN is returned, and remembered.
+        """
+        self.api._multipath = True
+        add_fake_multipath(
+            self.api._sysfs, self.api._dev, 'dm-0', ['sdb'], 16
+        )
+        self.api.get_device_path(self.blockdevice_id)
+        del self.executor.commands[:]
+        self.assertEqual(
+            (self.api._dev.child('dm-0'), []),
+            (self.api.get_device_path(self.blockdevice_id),
+             self.executor.commands)
+        )
+
+
+class AddToStorageGroupTests(APITestsMixin, SynchronousTestCase):
+    """
+    Tests for ``EMCVnxBlockDeviceAPI._add_to_storage_group``.
+    """
+    def test_lowest_free(self):
+        """
+        The LUN is added at the lowest HLU not in the storage group.
+        """
+        self.assertEqual(
+            2, self.api._add_to_storage_group(self.blockdevice_id, 8, {7: 1})
+        )
+
+    def test_reservation_directory(self):
+        """
+        HLUs are reserved in ``hlu_reservation_directory``.
+        """
+        self.api._add_to_storage_group(self.blockdevice_id, 8, {7: 1})
+        self.assertTrue(self.reservations.child('node1.hlu').exists())
+
+    def test_conflict(self):
+        """
+        If the array rejects the HLU, the storage group is read again and
+        the next free HLU is tried.
+        """
+        self.executor.results['-addhlu'] = [(66, 'HLU in use')]
+        self.executor.outputs['storagegroup'] = STORAGE_GROUP_OUTPUT.replace(
+            '5               7', '1               9'
+        )
+        self.assertEqual(
+            2, self.api._add_to_storage_group(self.blockdevice_id, 8, {})
+        )
+
+    def test_already_attached(self):
+        """
+        If the array rejects the HLU because the LUN has been added to the
+        storage group by someone else, ``AlreadyAttachedVolume`` is raised.
+        """
+        self.executor.results['-addhlu'] = [(66, 'LUN in use')]
+        self.assertRaises(
+            AlreadyAttachedVolume,
+            self.api._add_to_storage_group, self.blockdevice_id, 7, {}
+        )
+
+    def test_foreign_group(self):
+        """
+        If every HLU is refused because the LUN has meanwhile been added to
+        another node's storage group, ``AlreadyAttachedVolume`` is raised.
+        """
+        self.executor.results['-addhlu'] = [(66, 'LUN in use')] * 5
+        self.executor.outputs['storagegroup'] += FOREIGN_STORAGE_GROUP_OUTPUT
+        self.assertRaises(
+            AlreadyAttachedVolume,
+            self.api._add_to_storage_group, self.blockdevice_id, 8, {}
+        )
+
+    def test_conflicts_exhausted(self):
+        """
+        If every HLU is refused although the LUN isn't in any storage group,
+        ``HLUConflict`` is raised.
+        """
+        self.executor.results['-addhlu'] = [(66, 'HLU in use')] * 5
+        self.executor.outputs['storagegroup'] += FOREIGN_STORAGE_GROUP_OUTPUT
+        self.assertEqual(
+            (self.blockdevice_id, 9, 1),
+            self.assertRaises(
+                HLUConflict,
+                self.api._add_to_storage_group, self.blockdevice_id, 9, {}
+            ).args
+        )
+
+
+class AttachVolumesTests(APITestsMixin, SynchronousTestCase):
+    """
+    Tests for ``EMCVnxBlockDeviceAPI.attach_volumes``.
+    """
+    def setUp(self):
+        APITestsMixin.setUp(self)
+        # The LUN in the storage group at HLU 5 has no device yet.
+        self.api._sysfs.child('block').remove()
+        self.api._sysfs.child('class').child('scsi_disk').remove()
+        self.api._dev.child('sdb').remove()
+        self.other_blockdevice_id = u'block-{}'.format(uuid4())
+        self.executor.outputs['lun'] += LUN_OUTPUT.replace(
+            'NUMBER 7', 'NUMBER 8'
+        ).format(
+            name=self.api._get_lun_name_from_blockdevice_id(
+                self.other_blockdevice_id
+            )
+        )
+        self.clock = Clock()
+
+    def appear(self):
+        """
+        Make the devices of both LUNs appear once the first wait begins.
+        """
+        def add_devices():
+            add_fake_device(self.api._sysfs, self.api._dev, 1, 5, 'sdb', 16)
+            add_fake_device(self.api._sysfs, self.api._dev, 1, 1, 'sdc', 16)
+        self.api._open_device_events = lambda: FakeEventSource(
+            self.clock, [add_devices]
+        )
+
+    def test_batched(self):
+        """
+        The LUNs are listed once, the storage group is read once, the new
+        LUN is added and one scan finds both devices.
+        """
+        self.appear()
+        volumes = self.api.attach_volumes(
+            [self.blockdevice_id, self.other_blockdevice_id], u'node1'
+        )
+        self.assertEqual(
+            ({self.blockdevice_id: u'node1',
+              self.other_blockdevice_id: u'node1'},
+             [('lun', '-list'), ('storagegroup', '-list'),
+              ('storagegroup', '-addhlu')],
+             self.api._dev.child('sdc')),
+            ({blockdevice_id: volume.attached_to
+              for blockdevice_id, volume in volumes.items()},
+             [cmd[5:7] for cmd in self.executor.commands],
+             self.api.get_device_path(self.other_blockdevice_id))
+        )
+
+    def test_metrics(self):
+        """
+        The ``naviseccli`` commands run and the phases of the attach are
+        recorded.
+        """
+        self.appear()
+        self.api.attach_volumes(
+            [self.blockdevice_id, self.other_blockdevice_id], u'node1'
+        )
+        text = self.api._metrics.prometheus_text()
+        self.assertEqual(
+            [True] * 5,
+            [series in text for series in [
+                u'# TYPE flocker_vnx_cache_misses_total counter',
+                u'# TYPE flocker_vnx_singleflight_executed_total counter',
+                u'flocker_vnx_naviseccli_commands_total'
+                u'{rc="0",subcommand="storagegroup -addhlu"} 1',
+                u'flocker_vnx_attach_phase_seconds_count{phase="scan"} 1',
+                u'flocker_vnx_attach_phase_seconds_count{phase="wait"} 1',
+            ]]
+        )
+
+    def test_actions(self):
+        """
+        The attach and its phases are eliot actions which the latency report
+        understands.
+        """
+        messages = []
+        add_destination(messages.append)
+        self.addCleanup(remove_destination, messages.append)
+        self.appear()
+        self.api.attach_volumes(
+            [self.blockdevice_id, self.other_blockdevice_id], u'node1'
+        )
+        report = LatencyReport()
+        report.read(json.dumps(message, default=repr) for message in messages)
+        self.assertEqual(
+            [u'flocker_vnx:attach_volumes',
+             u'flocker_vnx:attach_volumes:lookup',
+             u'flocker_vnx:attach_volumes:ready',
+             u'flocker_vnx:attach_volumes:scan',
+             u'flocker_vnx:attach_volumes:storage_group',
+             u'flocker_vnx:attach_volumes:wait'],
+            sorted(report._durations)
+        )
+
+    def test_partial_failure(self):
+        """
+        If some volumes can't be attached, ``BulkOperationFailed`` says why
+        and the others are attached anyway.
+        """
+        self.appear()
+        unknown = u'block-{}'.format(uuid4())
+        e = self.assertRaises(
+            BulkOperationFailed,
+            self.api.attach_volumes,
+            [self.blockdevice_id, unknown], u'node1'
+        )
+        self.assertEqual(
+            ([unknown], [self.blockdevice_id]),
+            ([blockdevice_id for blockdevice_id in e.failures
+              if isinstance(e.failures[blockdevice_id], UnknownVolume)],
+             list(e.results))
+        )
+
+
+class DetachVolumesTests(APITestsMixin, SynchronousTestCase):
+    """
+    Tests for ``EMCVnxBlockDeviceAPI.detach_volumes``.
+    """
+    def test_batched(self):
+        """
+        The SCSI device of each volume is deleted and the volumes are removed
+        from the storage group.
+        """
+        scsi_device = self.api._sysfs.descendant(
+            ['bus', 'scsi', 'drivers', 'sd', '1:0:0:5']
+        )
+        scsi_device.makedirs()
+        self.assertEqual(
+            ([self.blockdevice_id], '1\n',
+             [('lun', '-list'), ('storagegroup', '-list'),
+              ('storagegroup', '-removehlu')]),
+            (self.api.detach_volumes([self.blockdevice_id]),
+             scsi_device.child('delete').getContent(),
+             [cmd[5:7] for cmd in self.executor.commands])
+        )
+
+    def test_device_failure(self):
+        """
+        A volume whose local devices can't be deleted is reported in
+        ``BulkOperationFailed`` and left in the storage group, while the
+        rest of the batch is detached.
+        """
+        other_blockdevice_id = u'block-{}'.format(uuid4())
+        self.executor.outputs['lun'] += LUN_OUTPUT.replace(
+            'NUMBER 7', 'NUMBER 8'
+        ).format(
+            name=self.api._get_lun_name_from_blockdevice_id(
+                other_blockdevice_id
+            )
+        )
+        self.executor.outputs['storagegroup'] += '    6               8\n'
+        drivers = self.api._sysfs.descendant(['bus', 'scsi', 'drivers', 'sd'])
+        # Writing to ``delete`` fails because it is a directory.
+        drivers.descendant(['1:0:0:5', 'delete']).makedirs()
+        drivers.child('1:0:0:6').makedirs()
+        e = self.assertRaises(
+            BulkOperationFailed,
+            self.api.detach_volumes,
+            [self.blockdevice_id, other_blockdevice_id],
+        )
+        self.assertEqual(
+            ([self.blockdevice_id], [other_blockdevice_id],
+             [('-removehlu', '-hlu', '6')]),
+            ([blockdevice_id for blockdevice_id in e.failures
+              if isinstance(e.failures[blockdevice_id], IOError)],
+             list(e.results),
+             [cmd[6:9] for cmd in self.executor.commands
+              if cmd[6] == '-removehlu'])
+        )
@@ -0,0 +1,77 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Tests for ``flocker_emc_vnx_driver._emc_vnx_client``.
+"""
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._emc_vnx_client import EMCVNXClient
+
+CLI = (
+    '/opt/Navisphere/bin/naviseccli', '-h', '192.0.2.1',
+    '-secfilepath', '/keys',
+)
+
+
+class ListCommandTests(SynchronousTestCase):
+    """
+    Tests for ``EMCVNXClient._list_command``.
+    """
+    def setUp(self):
+        self.client = EMCVNXClient('192.0.2.1', '/keys')
+
+    def test_inventory(self):
+        """
+        Listing ``LUN_INVENTORY`` asks only for the user capacity.  The name
+        and number are always displayed.
+        """
+        self.assertEqual(
+            CLI + ('lun', '-list', '-userCap'),
+            self.client._list_command('lun', (), EMCVNXClient.LUN_INVENTORY)
+        )
+
+    def test_attachment(self):
+        """
+        Listing ``LUN_ATTACHMENT`` also asks for the UID.
+        """
+        self.assertEqual(
+            CLI + ('lun', '-list', '-name', 'a', '-userCap', '-uid'),
+            self.client._list_command(
+                'lun', ('-name', 'a'), EMCVNXClient.LUN_ATTACHMENT
+            )
+        )
+
+    def test_always_displayed(self):
+        """
+        Properties which are always displayed add no options.
+        """
+        self.assertEqual(
+            CLI + ('lun', '-list'),
+            self.client._list_command(
+                'lun', (), [EMCVNXClient.LUN_NAME, EMCVNXClient.LUN_ID]
+            )
+        )
+
+    def test_deduplicated(self):
+        """
+        Each option appears once, however many properties need it.
+        """
+        self.assertEqual(
+            CLI + ('lun', '-list', '-userCap', '-uid'),
+            self.client._list_command(
+                'lun', (),
+                EMCVNXClient.LUN_ATTACHMENT + EMCVNXClient.LUN_INVENTORY
+            )
+        )
+
+    def test_xml(self):
+        """
+        ``-xml`` output is requested among the global options, before the
+        command.
+        """
+        client = EMCVNXClient('192.0.2.1', '/keys', output_format='xml')
+        self.assertEqual(
+            CLI + ('-xml', 'lun', '-list', '-userCap'),
+            client._list_command('lun', (), EMCVNXClient.LUN_INVENTORY)
+        )
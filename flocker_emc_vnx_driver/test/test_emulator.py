@@ -0,0 +1,326 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Tests for ``flocker_emc_vnx_driver._emulator``.
+"""
+
+from uuid import uuid4
+
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from flocker.node.agents.blockdevice import UnknownVolume
+
+from .._devices import SysfsPollingSource
+from .._driver import EMCVnxBlockDeviceAPI
+from .._emc_vnx_client import EMCVNXClient
+from .._emulator import (
+    RC_HLU_CONFLICT, RC_LUN_BUSY, RC_NO_SUCH_LUN, RC_NO_SUCH_STORAGE_GROUP,
+    VNXEmulator, disk_name, lun_uid, make_host_tree,
+)
+from .._parsing import XMLOutput
+from .._records import LUN
+
+GLOBAL = ['-h', '192.0.2.1', '-secfilepath', '/keys']
+
+
+class EmulatorTests(SynchronousTestCase):
+    """
+    Tests for ``VNXEmulator.execute``.
+    """
+    def setUp(self):
+        self.now = 1000.0
+        self.slept = []
+        self.chance = 1.0
+        self.emulator = VNXEmulator(
+            FilePath(self.mktemp()), clock=lambda: self.now,
+            sleep=self.slept.append, random=lambda: self.chance,
+        )
+        self.emulator.create(storage_groups=['node1'])
+
+    def execute(self, *args):
+        return self.emulator.execute(GLOBAL + list(args))
+
+    def create(self, name, capacity='8'):
+        return self.execute(
+            'lun', '-create', '-capacity', capacity, '-sq', 'gb',
+            '-poolName', 'pool', '-name', name,
+        )
+
+    def test_lun_list(self):
+        """
+        ``lun -list`` shows each LUN with only the properties asked for.
+        """
+        self.create('a')
+        self.create('b', '16')
+        self.assertEqual(
+            (0,
+             'LOGICAL UNIT NUMBER 0\nName:  a\n'
+             'User Capacity (GBs):  8.000\n\n'
+             'LOGICAL UNIT NUMBER 1\nName:  b\n'
+             'User Capacity (GBs):  16.000\n\n'),
+            self.execute('lun', '-list', '-userCap')
+        )
+
+    def test_lun_by_name(self):
+        """
+        ``lun -list -name`` shows one LUN, or fails with the real return code
+        if there is no such LUN.
+        """
+        self.create('a')
+        self.assertEqual(
+            [(0, 'LOGICAL UNIT NUMBER 0\nName:  a\nUID:  {}\n'
+                 'Current State:  Ready\n\n'.format(lun_uid(0))),
+             RC_NO_SUCH_LUN],
+            [self.execute('lun', '-list', '-name', 'a', '-uid', '-state'),
+             self.execute('lun', '-list', '-name', 'b')[0]]
+        )
+
+    def test_initializing(self):
+        """
+        A LUN is ``Initializing`` for ``ready_after`` seconds.
+        """
+        self.emulator.configure(ready_after=10)
+        self.create('a')
+        states = []
+        for now in (1009, 1010):
+            self.now = now
+            states.append(self.execute('lun', '-list', '-name', 'a',
+                                       '-state')[1].splitlines()[2])
+        self.assertEqual(
+            ['Current State:  Initializing', 'Current State:  Ready'], states
+        )
+
+    def test_rename(self):
+        """
+        ``lun -modify -newName`` renames a LUN.
+        """
+        self.create('a')
+        self.execute('lun', '-modify', '-name', 'a', '-newName', 'b', '-o')
+        self.assertEqual(
+            (RC_NO_SUCH_LUN, 0),
+            (self.execute('lun', '-list', '-name', 'a')[0],
+             self.execute('lun', '-list', '-name', 'b')[0])
+        )
+
+    def test_addhlu(self):
+        """
+        ``storagegroup -addhlu`` maps the LUN into the group, and refuses an
+        HLU or LUN which is already mapped.
+        """
+        self.create('a')
+        self.create('b')
+        rcs = [
+            self.execute('storagegroup', '-addhlu', '-hlu', hlu, '-alu', alu,
+                         '-gname', 'node1', '-o')[0]
+            for hlu, alu in [('5', '0'), ('5', '1'), ('6', '0')]
+        ]
+        self.assertEqual(
+            ([0, RC_HLU_CONFLICT, RC_HLU_CONFLICT], {0: 5}),
+            (rcs, EMCVNXClient('', '').output.storage_groups(
+                self.execute('storagegroup', '-list', '-host')[1]
+            )['node1'].lunmap)
+        )
+
+    def test_no_storage_group(self):
+        """
+        Commands on a storage group which doesn't exist fail with the real
+        return code.
+        """
+        self.assertEqual(
+            RC_NO_SUCH_STORAGE_GROUP,
+            self.execute('storagegroup', '-list', '-gname', 'node2')[0]
+        )
+
+    def test_destroy_mapped(self):
+        """
+        A LUN in a storage group is busy unless ``-forceDetach`` is given,
+        which removes it from the group.
+        """
+        self.create('a')
+        self.execute('storagegroup', '-addhlu', '-hlu', '5', '-alu', '0',
+                     '-gname', 'node1')
+        busy = self.execute('lun', '-destroy', '-name', 'a', '-o')[0]
+        forced = self.execute('lun', '-destroy', '-name', 'a',
+                              '-forceDetach', '-o')[0]
+        self.assertEqual(
+            (RC_LUN_BUSY, 0, RC_NO_SUCH_LUN, 'Storage Group Name:    node1'),
+            (busy, forced, self.execute('lun', '-list', '-name', 'a')[0],
+             self.execute('storagegroup', '-list')[1].splitlines()[0])
+        )
+        self.assertNotIn(
+            'HLU/ALU', self.execute('storagegroup', '-list')[1]
+        )
+
+    def test_faults(self):
+        """
+        Queued faults fail the next invocations of their subcommand in
+        order, without running it.
+        """
+        self.emulator.configure(faults={'lun -create': [8, 66]})
+        rcs = [self.create('a')[0] for _ in range(3)]
+        self.assertEqual(
+            ([8, 66, 0], 0),
+            (rcs, self.execute('lun', '-list', '-name', 'a')[0])
+        )
+
+    def test_fault_rates(self):
+        """
+        A return code of ``fault_rates`` is returned when the random number
+        falls below its probability.
+        """
+        self.emulator.configure(fault_rates={'lun -list': {'8': 0.5}})
+        rcs = []
+        for chance in (0.4, 0.6):
+            self.chance = chance
+            rcs.append(self.execute('lun', '-list')[0])
+        self.assertEqual([8, 0], rcs)
+
+    def test_latency(self):
+        """
+        Each command sleeps for its configured latency, or that of ``*``.
+        """
+        self.emulator.configure(latency={'lun -list': 0.5, '*': 0.1})
+        self.execute('lun', '-list')
+        self.execute('storagegroup', '-list')
+        self.assertEqual([0.5, 0.1], self.slept)
+
+    def test_xml(self):
+        """
+        With ``-xml`` among the global options, each property is a
+        ``PARAMVALUE`` element which ``XMLOutput`` can parse.
+        """
+        self.create('a')
+        self.create('b', '16')
+        self.execute('storagegroup', '-addhlu', '-hlu', '5', '-alu', '1',
+                     '-gname', 'node1')
+        output = XMLOutput()
+        rc, luns = self.emulator.execute(
+            GLOBAL[:2] + ['-xml'] + GLOBAL[2:] + ['lun', '-list', '-userCap']
+        )
+        groups = self.execute('-xml', 'storagegroup', '-list')[1]
+        self.assertEqual(
+            (0, True,
+             [LUN(lun_id=0, lun_name='a', total_capacity_gb=8.0),
+              LUN(lun_id=1, lun_name='b', total_capacity_gb=16.0)],
+             {'node1': {1: 5}}),
+            (rc, luns.startswith('<?xml'),
+             list(output.records(
+                 EMCVNXClient.LUN_INVENTORY, EMCVNXClient.LUN_ID,
+                 luns.splitlines(True), LUN,
+             )),
+             {name: group.lunmap
+              for name, group in output.storage_groups(groups).items()})
+        )
+
+    def test_bound_host(self):
+        """
+        LUNs added to a storage group bound to a host appear as SCSI disks
+        with the LUN's size and wwid on each of its FC hosts once it scans,
+        and disappear when removed.
+        """
+        sysfs, dev = make_host_tree(FilePath(self.mktemp()), fc_hosts=(1, 2))
+        bridge = self.emulator.bind_host('node1', sysfs, dev)
+        self.create('a')
+        self.execute('storagegroup', '-addhlu', '-hlu', '5', '-alu', '0',
+                     '-gname', 'node1')
+        bridge.poll()
+        unscanned = dev.listdir()
+        sysfs.descendant(['class', 'scsi_host', 'host2', 'scan']).setContent(
+            '0 0 5'
+        )
+        bridge.poll()
+        attached = (
+            sorted(dev.listdir()),
+            sysfs.descendant(
+                ['class', 'scsi_disk', '2:0:0:5', 'device', 'block']
+            ).listdir(),
+            sysfs.descendant(['block', 'sda', 'size']).getContent(),
+            sysfs.descendant(['block', 'sda', 'device', 'wwid']).getContent(),
+            sorted(
+                sysfs.descendant(['bus', 'scsi', 'drivers', 'sd']).listdir()
+            ),
+        )
+        self.execute('storagegroup', '-removehlu', '-hlu', '5',
+                     '-gname', 'node1')
+        self.assertEqual(
+            ([],
+             (['sda', 'sdb'], ['sdb'], '16777216\n',
+              'naa.{}\n'.format(lun_uid(0).replace(':', '').lower()),
+              ['1:0:0:5', '2:0:0:5']),
+             [], []),
+            (unscanned, attached, dev.listdir(),
+             sysfs.descendant(['class', 'scsi_disk']).listdir())
+        )
+
+    def test_disk_name(self):
+        """
+        Disk names follow the kernel's sequence.
+        """
+        self.assertEqual(
+            ['sda', 'sdz', 'sdaa', 'sdba'],
+            [disk_name(index) for index in (0, 25, 26, 52)]
+        )
+
+
+class ScriptTests(SynchronousTestCase):
+    """
+    Tests for running the driver against ``VNXEmulator.write_script``.
+    """
+    def setUp(self):
+        root = FilePath(self.mktemp())
+        root.makedirs()
+        self.emulator = VNXEmulator(root.child('array.json'))
+        self.emulator.create(storage_groups=['node1'])
+        self.script = root.child('naviseccli')
+        self.emulator.write_script(self.script)
+        self.sysfs, self.dev = make_host_tree(root)
+        bridge = self.emulator.bind_host('node1', self.sysfs, self.dev)
+        bridge.start()
+        self.addCleanup(bridge.stop)
+
+    def test_client(self):
+        """
+        ``EMCVNXClient`` can create and list LUNs through the script, and
+        sees injected failures.
+        """
+        client = EMCVNXClient('192.0.2.1', '/keys',
+                              naviseccli_path=self.script.path)
+        client.create_volume('a', '8', 'pool')
+        self.emulator.configure(faults={'storagegroup -addhlu': [66]})
+        rcs = [client.add_volume_to_sg('5', '0', 'node1')[0]
+               for _ in range(2)]
+        lun = client.get_lun_by_name('a')
+        self.assertEqual(
+            (True, 'a', lun_uid(0).replace(':', '').lower(),
+             [RC_HLU_CONFLICT, 0], {0: 5}),
+            (client.check_pool('pool'), lun.lun_name, lun.lun_uid,
+             rcs, client.storage_groups()['node1'].lunmap)
+        )
+
+    def test_attach(self):
+        """
+        ``EMCVnxBlockDeviceAPI`` can create, attach, detach and destroy a
+        volume on the emulated array, finding its device in the bound host
+        tree.
+        """
+        api = EMCVnxBlockDeviceAPI(
+            cluster_id=uuid4(), spa_ip='192.0.2.1', storage_pool='pool',
+            hostname=u'node1', storage_group=u'node1',
+            naviseccli_keys='/keys', naviseccli_path=self.script.path,
+            hlu_reservation_directory=self.mktemp(),
+        )
+        api._sysfs, api._dev = self.sysfs, self.dev
+        api._open_device_events = lambda: SysfsPollingSource(interval=0.01)
+        volume = api.create_volume(uuid4(), 8 * 1024 ** 3)
+        api.attach_volume(volume.blockdevice_id, u'node1')
+        device = api.get_device_path(volume.blockdevice_id)
+        api.detach_volume(volume.blockdevice_id)
+        api.destroy_volume(volume.blockdevice_id)
+        self.assertEqual(
+            (self.dev.child('sda'), []),
+            (device, api.list_volumes())
+        )
+        self.assertRaises(
+            UnknownVolume, api.destroy_volume, volume.blockdevice_id
+        )
@@ -0,0 +1,182 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Tests for ``flocker_emc_vnx_driver._executor``.
+"""
+
+import sys
+import threading
+import time
+
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._executor import CommandResult, PooledExecutor, SerialExecutor, chain
+
+MISSING = '/nonexistent/naviseccli'
+
+
+def wait_for(predicate, timeout=10):
+    """
+    Poll ``predicate`` until it returns a true value.
+    """
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError("Timed out", predicate)
+        time.sleep(0.01)
+
+
+class CommandResultTests(SynchronousTestCase):
+    """
+    Tests for ``CommandResult`` and ``chain``.
+    """
+    def test_callback_after_done(self):
+        """
+        A callback added once the command has finished is called at once.
+        """
+        result = CommandResult()
+        result._complete((0, 'out', ''))
+        called = []
+        result.add_callback(called.append)
+        self.assertEqual([result], called)
+
+    def test_callback_before_done(self):
+        """
+        A callback added earlier is called when the command finishes.
+        """
+        result = CommandResult()
+        called = []
+        result.add_callback(called.append)
+        before = list(called)
+        result._complete((0, 'out', ''))
+        self.assertEqual(([], [result]), (before, called))
+
+    def test_chain(self):
+        """
+        ``chain`` applies a function to the value of a command.
+        """
+        result = CommandResult()
+        chained = chain(result, lambda (rc, out, err): out.upper())
+        result._complete((0, 'out', ''))
+        self.assertEqual('OUT', chained.result())
+
+    def test_chain_failure(self):
+        """
+        An exception raised by the command or the chained function reaches
+        the ``result`` of the chained ``CommandResult``.
+        """
+        failed = CommandResult()
+        try:
+            raise ValueError("no naviseccli")
+        except ValueError:
+            failed._fail(sys.exc_info())
+        succeeded = CommandResult()
+        succeeded._complete((0, '', ''))
+        self.assertRaises(
+            ValueError, chain(failed, lambda value: value).result
+        )
+        self.assertRaises(
+            ZeroDivisionError, chain(succeeded, lambda value: 1 / 0).result
+        )
+
+
+class SerialExecutorTests(SynchronousTestCase):
+    """
+    Tests for ``SerialExecutor``.
+    """
+    def test_run(self):
+        """
+        The command has finished by the time ``submit`` returns.
+        """
+        result = SerialExecutor().submit(('echo', 'hello'))
+        self.assertEqual(
+            (True, (0, 'hello\n', None)), (result.done(), result.result())
+        )
+
+    def test_parse(self):
+        """
+        ``parse`` is given the lines of stdout and its result replaces it.
+        """
+        result = SerialExecutor().submit(
+            ('printf', 'a\\nb\\n'),
+            lambda lines: [line.strip() for line in lines],
+        )
+        self.assertEqual((0, ['a', 'b'], None), result.result())
+
+    def test_failure(self):
+        """
+        An exception raised running the command is raised by ``result``.
+        """
+        result = SerialExecutor().submit((MISSING,))
+        self.assertRaises(OSError, result.result)
+
+
+class PooledExecutorTests(SynchronousTestCase):
+    """
+    Tests for ``PooledExecutor``.
+    """
+    def setUp(self):
+        self.executor = PooledExecutor(workers=2)
+        self.addCleanup(self.executor.stop)
+        self.gate = FilePath(self.mktemp())
+
+    def held(self, output):
+        """
+        :returns: A command which echoes ``output`` once the gate is open.
+        """
+        return (
+            'sh', '-c',
+            'while [ ! -e "$0" ]; do sleep 0.01; done; echo "$1"',
+            self.gate.path, output,
+        )
+
+    def test_workers(self):
+        """
+        No more than ``workers`` commands run at once.  The rest wait in the
+        queue until a worker is free.
+        """
+        results = [self.executor.submit(self.held(str(i))) for i in range(3)]
+        wait_for(lambda: self.executor.in_flight == 2)
+        held = (self.executor.in_flight, self.executor.queue_depth,
+                [result.done() for result in results])
+        self.gate.touch()
+        outputs = [result.result()[1] for result in results]
+        wait_for(lambda: self.executor.in_flight == 0)
+        self.assertEqual(
+            ((2, 1, [False] * 3), ['0\n', '1\n', '2\n'], 0),
+            (held, outputs, self.executor.queue_depth)
+        )
+
+    def test_failure(self):
+        """
+        An exception raised running the command is raised by ``result``,
+        and the worker goes on to run later commands.
+        """
+        failed = self.executor.submit((MISSING,))
+        later = self.executor.submit(('echo', 'later'))
+        self.assertRaises(OSError, failed.result)
+        self.assertEqual((0, 'later\n', None), later.result())
+
+    def test_stop(self):
+        """
+        ``stop`` finishes the commands already submitted before the workers
+        exit.
+        """
+        executor = PooledExecutor(workers=1)
+        results = [executor.submit(self.held(str(i))) for i in range(3)]
+        wait_for(lambda: executor.in_flight == 1)
+        queued = executor.queue_depth
+        opener = threading.Timer(0.1, self.gate.touch)
+        opener.start()
+        self.addCleanup(opener.join)
+        executor.stop()
+        self.assertEqual(
+            (2, [True] * 3), (queued, [result.done() for result in results])
+        )
+
+    def test_no_workers(self):
+        """
+        A pool needs at least one worker.
+        """
+        self.assertRaises(ValueError, PooledExecutor, 0)
@@ -0,0 +1,117 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Tests for ``flocker_emc_vnx_driver._hlu``.
+"""
+
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._hlu import (
+    HLUAllocator, HLUsExhausted, hlu_bitmap, lowest_free_hlu,
+    make_state_directory, shared_state_path,
+)
+
+
+class SharedStateTests(SynchronousTestCase):
+    """
+    Tests for ``shared_state_path`` and ``make_state_directory``.
+    """
+    def test_path(self):
+        """
+        Characters which don't belong in a file name are replaced.
+        """
+        directory = FilePath(self.mktemp())
+        self.assertEqual(
+            directory.child('Docker_1_a.hlu'),
+            shared_state_path(directory, u'Docker 1/a', '.hlu')
+        )
+
+    def test_make_directory(self):
+        """
+        The directory is created, and creating it again does nothing.
+        """
+        directory = FilePath(self.mktemp()).child('state')
+        make_state_directory(directory)
+        make_state_directory(directory)
+        self.assertTrue(directory.isdir())
+
+
+class LowestFreeHLUTests(SynchronousTestCase):
+    """
+    Tests for ``lowest_free_hlu``.
+    """
+    def test_empty(self):
+        """
+        HLU 0 is never chosen.
+        """
+        self.assertEqual(1, lowest_free_hlu(hlu_bitmap([])))
+
+    def test_gap(self):
+        """
+        The lowest unused HLU is chosen, even if higher ones are free too.
+        """
+        self.assertEqual(3, lowest_free_hlu(hlu_bitmap([1, 2, 4, 5])))
+
+    def test_full(self):
+        """
+        ``None`` is returned if every HLU up to 255 is used.
+        """
+        self.assertIs(None, lowest_free_hlu(hlu_bitmap(range(1, 256))))
+
+
+class HLUAllocatorTests(SynchronousTestCase):
+    """
+    Tests for ``HLUAllocator``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.directory = FilePath(self.mktemp())
+
+    def allocator(self):
+        return HLUAllocator(
+            u'Docker 1/a', directory=self.directory, ttl=60,
+            clock=self.clock.seconds,
+        )
+
+    def test_skips_lunmap(self):
+        """
+        HLUs already in the storage group aren't chosen.
+        """
+        self.assertEqual(3, self.allocator().reserve({10: 1, 11: 2}))
+
+    def test_shared_reservations(self):
+        """
+        Allocators for the same storage group, as in different processes,
+        don't choose the same HLU.
+        """
+        first = self.allocator().reserve({})
+        second = self.allocator().reserve({})
+        self.assertEqual((1, 2), (first, second))
+
+    def test_release(self):
+        """
+        A released HLU can be chosen again.
+        """
+        allocator = self.allocator()
+        hlu = allocator.reserve({})
+        allocator.release(hlu)
+        self.assertEqual(hlu, self.allocator().reserve({}))
+
+    def test_expiry(self):
+        """
+        Reservations lapse after ``ttl`` seconds.
+        """
+        self.allocator().reserve({})
+        self.clock.advance(61)
+        self.assertEqual(1, self.allocator().reserve({}))
+
+    def test_exhausted(self):
+        """
+        ``HLUsExhausted`` is raised when every HLU is in use or reserved.
+        """
+        allocator = self.allocator()
+        allocator.reserve({})
+        lunmap = {alu: alu for alu in range(2, 256)}
+        self.assertRaises(HLUsExhausted, allocator.reserve, lunmap)
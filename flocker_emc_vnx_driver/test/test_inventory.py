@@ -0,0 +1,165 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Tests for ``flocker_emc_vnx_driver._inventory``.
+"""
+
+from uuid import uuid4
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._inventory import Inventory
+from .._records import LUN, StorageGroup
+
+PREFIX = 'flocker--cluster--'
+GiB = 1024 * 1024 * 1024
+
+
+def blockdevice_id_for_name(name):
+    if not name.startswith(PREFIX):
+        return None
+    return name[len(PREFIX):]
+
+
+def lun(alu, name, capacity=8.0):
+    return LUN(lun_id=alu, lun_name=name, total_capacity_gb=capacity)
+
+
+def groups(**lunmaps):
+    return {
+        name: StorageGroup(name=name, lunmap=dict(lunmap))
+        for name, lunmap in lunmaps.items()
+    }
+
+
+class InventoryTests(SynchronousTestCase):
+    """
+    Tests for ``Inventory``.
+    """
+    def setUp(self):
+        self.inventory = Inventory(
+            blockdevice_id_for_name, u'node1', u'host1', u'foreign'
+        )
+        self.ids = [u'block-{}'.format(uuid4()) for _ in range(3)]
+        self.luns = [
+            lun(alu, PREFIX + blockdevice_id)
+            for alu, blockdevice_id in enumerate(self.ids)
+        ] + [lun(3, 'flocker--other--block-{}'.format(uuid4()))]
+
+    def attachments(self):
+        return {
+            volume.blockdevice_id: volume.attached_to
+            for volume in self.inventory.volumes()
+        }
+
+    def test_volumes(self):
+        """
+        Each of the cluster's LUNs is a volume attached to this host, to a
+        foreign host or to nothing, depending on its storage group.
+        """
+        updated = self.inventory.update(
+            self.luns, groups(node1={0: 1}, node2={1: 1, 3: 2})
+        )
+        self.assertEqual(
+            ({self.ids[0]: u'host1', self.ids[1]: u'foreign',
+              self.ids[2]: None},
+             3, 8 * GiB),
+            (self.attachments(), len(updated),
+             self.inventory.volume(self.ids[0]).size)
+        )
+
+    def test_unchanged(self):
+        """
+        An identical listing changes nothing and keeps the same volumes.
+        """
+        self.inventory.update(self.luns, groups(node1={0: 1}))
+        before = self.inventory.volumes()
+        updated = self.inventory.update(
+            [lun(r.lun_id, r.lun_name) for r in self.luns],
+            groups(node1={0: 1})
+        )
+        self.assertEqual(
+            ([], True),
+            (updated, all(
+                old is new
+                for old, new in zip(before, self.inventory.volumes())
+            ))
+        )
+
+    def test_changed(self):
+        """
+        Only volumes whose LUN or attachment changed are recreated.
+        """
+        self.inventory.update(self.luns, groups(node1={0: 1}))
+        unchanged = self.inventory.volume(self.ids[2])
+        self.luns[1] = lun(1, PREFIX + self.ids[1], 16.0)
+        updated = self.inventory.update(self.luns, groups(node2={0: 1}))
+        self.assertEqual(
+            ({self.ids[0], self.ids[1]}, u'foreign', 16 * GiB, True),
+            ({volume.blockdevice_id for volume in updated},
+             self.inventory.volume(self.ids[0]).attached_to,
+             self.inventory.volume(self.ids[1]).size,
+             self.inventory.volume(self.ids[2]) is unchanged)
+        )
+
+    def test_removed(self):
+        """
+        A LUN which disappears is no longer a volume or indexed.
+        """
+        self.inventory.update(self.luns, groups(node1={0: 1}))
+        self.inventory.update(self.luns[1:], groups(node1={}))
+        self.assertEqual(
+            ({self.ids[1]: None, self.ids[2]: None}, None, None, None),
+            (self.attachments(), self.inventory.lun_by_alu(0),
+             self.inventory.lun_by_blockdevice_id(self.ids[0]),
+             self.inventory.storage_group_of(0))
+        )
+
+    def test_renamed(self):
+        """
+        A LUN renamed into the cluster, as a warm pool spare is when it is
+        claimed, becomes a volume under its new name.
+        """
+        spare = lun(4, 'flockerspare--cluster--8--0')
+        self.inventory.update(self.luns + [spare], groups())
+        blockdevice_id = u'block-{}'.format(uuid4())
+        claimed = lun(4, PREFIX + blockdevice_id)
+        self.inventory.update(self.luns + [claimed], groups())
+        self.assertEqual(
+            (None, claimed, claimed, None),
+            (self.inventory.lun_by_name(spare.lun_name),
+             self.inventory.lun_by_alu(4),
+             self.inventory.lun_by_blockdevice_id(blockdevice_id),
+             self.inventory.volume(blockdevice_id).attached_to)
+        )
+
+    def test_moved(self):
+        """
+        A LUN may move from one storage group to another between listings.
+        """
+        self.inventory.update(self.luns, groups(node2={0: 1}, node1={}))
+        self.inventory.update(self.luns, groups(node2={}, node1={0: 5}))
+        self.assertEqual(
+            (u'host1', {0: 5}),
+            (self.inventory.volume(self.ids[0]).attached_to,
+             self.inventory.lunmap(u'node1'))
+        )
+
+    def test_in_two_groups(self):
+        """
+        One of the cluster's LUNs in two storage groups is an error, after
+        which the inventory is rebuilt from scratch.
+        """
+        self.assertRaises(
+            Exception, self.inventory.update,
+            self.luns, groups(node1={0: 1}, node2={0: 1}),
+        )
+        self.inventory.update(self.luns, groups(node1={0: 1}))
+        self.assertEqual(u'host1', self.attachments()[self.ids[0]])
+
+    def test_foreign_lun_in_two_groups(self):
+        """
+        Another cluster's LUN may be in two storage groups.
+        """
+        self.inventory.update(self.luns, groups(node1={3: 1}, node2={3: 1}))
+        self.assertEqual(3, len(self.inventory.volumes()))
@@ -0,0 +1,105 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Tests for ``flocker_emc_vnx_driver._metrics``.
+"""
+
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._metrics import COUNTER, GAUGE, Histogram, Metrics
+
+
+class HistogramTests(SynchronousTestCase):
+    """
+    Tests for ``Histogram``.
+    """
+    def test_observe(self):
+        """
+        Each observation is counted in the lowest bucket which holds it, or
+        none if it is larger than all of them.
+        """
+        histogram = Histogram(buckets=(1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.observe(value)
+        self.assertEqual(
+            ([2, 1], 4, 56.5),
+            (histogram.counts, histogram.count, histogram.sum)
+        )
+
+
+class MetricsTests(SynchronousTestCase):
+    """
+    Tests for ``Metrics``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.metrics = Metrics(clock=self.clock.seconds)
+
+    def test_timer(self):
+        """
+        ``timer`` observes the time spent in its block.
+        """
+        with self.metrics.timer('wait_seconds', phase='scan'):
+            self.clock.advance(2)
+        self.assertEqual(
+            {u'wait_seconds{phase="scan"}': {u'count': 1, u'sum': 2.0}},
+            self.metrics.snapshot()
+        )
+
+    def test_timings(self):
+        """
+        ``Timings`` totals each phase of an operation and observes each
+        time a phase is entered.
+        """
+        timings = self.metrics.timings('attach_seconds')
+        for _ in range(2):
+            with timings.phase('wait'):
+                self.clock.advance(1)
+        self.assertEqual(
+            ({'wait': 2}, {u'count': 2, u'sum': 2.0}),
+            (timings.phases,
+             self.metrics.snapshot()[u'attach_seconds{phase="wait"}'])
+        )
+
+    def test_prometheus_text(self):
+        """
+        Histograms, counters and gauges are rendered in the Prometheus text
+        format, with cumulative buckets and escaped label values.
+        """
+        self.metrics.observe('latency_seconds', 0.02, subcommand='lun -list')
+        self.metrics.increment('commands_total', rc=0)
+        self.metrics.add_collector(
+            lambda: [(GAUGE, 'spares', {'size': 'a"b'}, 3),
+                     (COUNTER, 'hits_total', {}, 2)]
+        )
+        lines = self.metrics.prometheus_text().splitlines()
+        self.assertEqual(
+            [u'# TYPE latency_seconds histogram',
+             u'latency_seconds_bucket{subcommand="lun -list",le="0.01"} 0',
+             u'latency_seconds_bucket{subcommand="lun -list",le="0.025"} 1',
+             u'latency_seconds_bucket{subcommand="lun -list",le="+Inf"} 1',
+             u'latency_seconds_sum{subcommand="lun -list"} 0.02',
+             u'latency_seconds_count{subcommand="lun -list"} 1',
+             u'# TYPE commands_total counter',
+             u'commands_total{rc="0"} 1',
+             u'# TYPE hits_total counter',
+             u'hits_total 2',
+             u'# TYPE spares gauge',
+             u'spares{size="a\\"b"} 3'],
+            lines[:1] + lines[2:4] + lines[16:]
+        )
+
+    def test_write_textfile(self):
+        """
+        ``write_textfile`` replaces the file with the current metrics.
+        """
+        path = FilePath(self.mktemp())
+        path.setContent('old')
+        self.metrics.increment('commands_total')
+        self.metrics.write_textfile(path)
+        self.assertEqual(
+            '# TYPE commands_total counter\ncommands_total 1\n',
+            path.getContent()
+        )
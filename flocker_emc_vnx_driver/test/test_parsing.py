@@ -0,0 +1,186 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Tests for ``flocker_emc_vnx_driver._parsing``.
+"""
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._emc_vnx_client import EMCVNXClient
+from .._parsing import RecordParser, TextOutput, XMLOutput
+from .._records import LUN
+
+LUN_LIST_OUTPUT = """\
+LOGICAL UNIT NUMBER 12
+Name:  flocker--abc--block-1
+UID:  60:06:01:60:3A:41:2B:00
+Pool Name:  Pool 0
+User Capacity (GBs):  8.000
+Current State:  Ready
+Status:  OK(0x0)
+
+LOGICAL UNIT NUMBER 13
+Name:  other
+User Capacity (GBs):  unknown
+Current State:  Initializing
+
+"""
+
+
+class RecordParserTests(SynchronousTestCase):
+    """
+    Tests for ``RecordParser``.
+    """
+    def setUp(self):
+        self.parser = RecordParser(EMCVNXClient.LUN_ALL, LUN)
+
+    def test_records(self):
+        """
+        ``RecordParser.records`` yields one record per blank line separated
+        block, with ``None`` for properties which are missing or fail to
+        convert.
+        """
+        self.assertEqual(
+            [
+                LUN(lun_id=12, lun_name='flocker--abc--block-1',
+                    lun_uid='600601603a412b00', total_capacity_gb=8.0,
+                    state='Ready', status='OK(0x0)'),
+                LUN(lun_id=13, lun_name='other', state='Initializing'),
+            ],
+            list(self.parser.records(LUN_LIST_OUTPUT.splitlines(True)))
+        )
+
+    def test_incremental(self):
+        """
+        A record is yielded as soon as the blank line ending it is consumed.
+        """
+        lines = iter(LUN_LIST_OUTPUT.splitlines(True))
+        records = self.parser.records(lines)
+        first = next(records)
+        self.assertEqual(
+            (12, 'LOGICAL UNIT NUMBER 13\n'),
+            (first.lun_id, next(lines))
+        )
+
+    def test_parse_one_empty(self):
+        """
+        ``RecordParser.parse_one`` returns ``None`` if there are no records.
+        """
+        self.assertIs(None, self.parser.parse_one([]))
+
+    def test_slots(self):
+        """
+        Records have no per-instance ``__dict__``.
+        """
+        record = self.parser.parse_one(LUN_LIST_OUTPUT.splitlines(True))
+        self.assertRaises(AttributeError, setattr, record, 'extra', 1)
+
+
+LUN_LIST_XML = """\
+<?xml version="1.0" encoding="utf-8" ?>
+<CIM CIMVERSION="2.0" DTDVERSION="2.0">
+<MESSAGE ID="877" PROTOCOLVERSION="1.0">
+<SIMPLERSP>
+<METHODRESPONSE NAME="ExecuteCommand">
+<PARAMVALUE NAME="LOGICAL UNIT NUMBER" TYPE="uint32"><VALUE>12</VALUE>
+</PARAMVALUE>
+<PARAMVALUE NAME="Name" TYPE="string"><VALUE>flocker--abc--block-1</VALUE>
+</PARAMVALUE>
+<PARAMVALUE NAME="User Capacity (GBs)" TYPE="string"><VALUE>8.000</VALUE>
+</PARAMVALUE>
+<PARAMVALUE NAME="LOGICAL UNIT NUMBER" TYPE="uint32"><VALUE>13</VALUE>
+</PARAMVALUE>
+<PARAMVALUE NAME="Name" TYPE="string"><VALUE>other</VALUE></PARAMVALUE>
+</METHODRESPONSE>
+</SIMPLERSP>
+</MESSAGE>
+</CIM>
+"""
+
+STORAGE_GROUP_XML = """\
+<CIM><MESSAGE><SIMPLERSP><METHODRESPONSE>
+<PARAMVALUE NAME="Storage Group Name"><VALUE>Docker1</VALUE></PARAMVALUE>
+<PARAMVALUE NAME="Storage Group UID"><VALUE>AB:CD</VALUE></PARAMVALUE>
+<PARAMVALUE NAME="HLU Number"><VALUE>1</VALUE></PARAMVALUE>
+<PARAMVALUE NAME="ALU Number"><VALUE>12</VALUE></PARAMVALUE>
+<PARAMVALUE NAME="HLU Number"><VALUE>2</VALUE></PARAMVALUE>
+<PARAMVALUE NAME="ALU Number"><VALUE>13</VALUE></PARAMVALUE>
+<PARAMVALUE NAME="Storage Group Name"><VALUE>Docker2</VALUE></PARAMVALUE>
+</METHODRESPONSE></SIMPLERSP></MESSAGE></CIM>
+"""
+
+
+class XMLOutputTests(SynchronousTestCase):
+    """
+    Tests for ``XMLOutput``.
+    """
+    def test_records(self):
+        """
+        ``XMLOutput.records`` starts a new record at each occurrence of the
+        start property.
+        """
+        self.assertEqual(
+            [
+                LUN(lun_id=12, lun_name='flocker--abc--block-1',
+                    total_capacity_gb=8.0),
+                LUN(lun_id=13, lun_name='other'),
+            ],
+            list(
+                XMLOutput().records(
+                    EMCVNXClient.LUN_INVENTORY,
+                    EMCVNXClient.LUN_ID,
+                    LUN_LIST_XML.splitlines(True),
+                    LUN
+                )
+            )
+        )
+
+    def test_storage_groups(self):
+        """
+        ``XMLOutput.storage_groups`` parses the HLU/ALU pairs of every group
+        into the same shape as ``TextOutput.storage_groups``.
+        """
+        groups = XMLOutput().storage_groups(STORAGE_GROUP_XML)
+        self.assertEqual(
+            {'Docker1': ('AB:CD', {12: 1, 13: 2}),
+             'Docker2': (None, {})},
+            {name: (group.storage_group_uid, group.lunmap)
+             for name, group in groups.items()}
+        )
+
+
+STORAGE_GROUP_OUTPUT = """\
+Storage Group Name:    Docker1
+Storage Group UID:     AB:CD
+
+HLU/ALU Pairs:
+
+  HLU Number     ALU Number
+  ----------     ----------
+    1               12
+"""
+
+
+class TextOutputTests(SynchronousTestCase):
+    """
+    Tests for ``TextOutput``.
+    """
+    def test_storage_groups(self):
+        """
+        ``TextOutput.storage_groups`` parses each group into a
+        ``StorageGroup`` without its raw output.
+        """
+        [group] = TextOutput().storage_groups(STORAGE_GROUP_OUTPUT).values()
+        self.assertEqual(
+            ('Docker1', 'AB:CD', {12: 1}, None),
+            (group.name, group.storage_group_uid, group.lunmap,
+             group.raw_output)
+        )
+
+    def test_keep_raw_output(self):
+        """
+        In debug mode each group keeps the output it was parsed from.
+        """
+        output = TextOutput(keep_raw_output=True)
+        group = output.storage_groups(STORAGE_GROUP_OUTPUT)['Docker1']
+        self.assertIn('HLU/ALU Pairs:', group.raw_output)
@@ -0,0 +1,118 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Tests for ``flocker_emc_vnx_driver._readiness``.
+"""
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._readiness import ReadinessTracker
+from .._records import LUN
+
+
+class FakeClient(object):
+    """
+    Report canned LUN states.
+
+    :ivar dict states: Maps LUN names to states.
+    """
+    def __init__(self):
+        self.states = {}
+        self.rc = 0
+
+    def get_lun_states(self):
+        return self.rc, [
+            LUN(lun_name=name, state=state)
+            for name, state in self.states.items()
+        ]
+
+
+class ReadinessTrackerTests(SynchronousTestCase):
+    """
+    Tests for ``ReadinessTracker``.
+    """
+    def setUp(self):
+        self.client = FakeClient()
+        self.tracker = ReadinessTracker(
+            self.client, initial_delay=1, max_delay=4,
+            uniform=lambda low, high: (low, high), background=False,
+        )
+
+    def test_settle(self):
+        """
+        A single poll settles every tracked LUN which is ready, faulted or
+        gone and leaves the rest pending.
+        """
+        self.client.states = {
+            'ready': 'Ready', 'faulted': 'Faulted', 'new': 'Initializing',
+        }
+        tracked = [
+            self.tracker.track(name)
+            for name in ('ready', 'faulted', 'new', 'gone')
+        ]
+        self.tracker.poll()
+        self.assertEqual(
+            ([('ready', 'Ready'), ('faulted', 'Faulted'), ('gone', None)],
+             ['new']),
+            ([(r.name, r.state) for r in tracked if r.done()],
+             [r.name for r in tracked if self.tracker.pending(r.name)])
+        )
+
+    def test_failed_poll(self):
+        """
+        Nothing is settled by a poll which fails.
+        """
+        self.client.rc = 1
+        readiness = self.tracker.track('gone')
+        self.tracker.poll()
+        self.assertFalse(readiness.done())
+
+    def test_backoff(self):
+        """
+        Successive delays double up to ``max_delay``, each jittered between
+        half and all of its nominal value.
+        """
+        self.client.states = {'new': 'Initializing'}
+        self.tracker.track('new')
+        self.assertEqual(
+            [(0.5, 1), (1, 2), (2, 4), (2, 4)],
+            [self.tracker.poll() for _ in range(4)]
+        )
+
+    def test_backoff_reset(self):
+        """
+        Tracking another LUN resets the delay.
+        """
+        self.client.states = {'new': 'Initializing'}
+        self.tracker.track('new')
+        self.tracker.poll()
+        self.tracker.poll()
+        self.tracker.track('newer')
+        self.assertEqual((0.5, 1), self.tracker.poll())
+
+    def test_callback(self):
+        """
+        Callbacks are called when the LUN settles, or at once if it already
+        has.
+        """
+        self.client.states = {'new': 'Ready'}
+        readiness = self.tracker.track('new')
+        called = []
+        readiness.add_callback(called.append)
+        self.tracker.poll()
+        readiness.add_callback(called.append)
+        self.assertEqual([readiness, readiness], called)
+
+    def test_wait(self):
+        """
+        ``wait`` tracks the LUNs, polls for them in the background and
+        returns the states of those which settle in time.
+        """
+        self.client.states = {'new': 'Ready', 'newer': 'Initializing'}
+        tracker = ReadinessTracker(
+            self.client, initial_delay=0.01, max_delay=0.01
+        )
+        self.addCleanup(tracker.stop)
+        self.assertEqual(
+            {'new': 'Ready'}, tracker.wait(['new', 'newer'], 0.5)
+        )
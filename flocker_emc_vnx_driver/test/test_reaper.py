@@ -0,0 +1,141 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Tests for ``flocker_emc_vnx_driver._reaper``.
+"""
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._reaper import Reaper
+from .._records import LUN
+
+CLUSTER_ID = '0b7d6b7e-5c8a-4a3f-a6c2-0e1c1e0e7e7e'
+
+
+class FakeClient(object):
+    """
+    Destroy LUNs, or not.
+
+    :ivar dict luns: Maps LUN names to the return code their next destroy
+        attempt will give.
+    :ivar list batches: The names passed to each ``destroy_volumes`` call.
+    """
+    LUN_INVENTORY = []
+
+    def __init__(self):
+        self.luns = {}
+        self.batches = []
+
+    def list_luns(self, properties):
+        return 0, [LUN(lun_name=name) for name in self.luns]
+
+    def destroy_volumes(self, names):
+        self.batches.append(names)
+        results = []
+        for name in names:
+            rc = self.luns.get(name, 9)
+            if rc == 0:
+                del self.luns[name]
+            results.append((rc, ''))
+        return results
+
+
+class ReaperTests(SynchronousTestCase):
+    """
+    Tests for ``Reaper``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.client = FakeClient()
+        self.reaper = Reaper(
+            self.client, CLUSTER_ID, batch_size=2, initial_delay=1,
+            max_delay=4, interval=300, reload_interval=900,
+            clock=self.clock.seconds,
+        )
+
+    def test_tombstone_name(self):
+        """
+        Tombstones are named after the cluster and volume, under a prefix
+        which isn't that of a volume.
+        """
+        self.assertEqual(
+            'flockerrm--0b7d6b7e--block-1',
+            self.reaper.tombstone_name(u'block-1')
+        )
+
+    def test_batches(self):
+        """
+        Tombstones are destroyed ``batch_size`` at a time.
+        """
+        for name in ('a', 'b', 'c'):
+            self.client.luns[name] = 0
+            self.reaper.bury(name)
+        self.assertEqual(0, self.reaper.reap())
+        self.assertEqual(None, self.reaper.reap())
+        self.assertEqual(
+            ([['a', 'b'], ['c']], {}, 3),
+            (self.client.batches, self.client.luns, self.reaper.destroyed)
+        )
+
+    def test_busy_backoff(self):
+        """
+        A busy LUN is retried after a delay which doubles each time, up to
+        ``max_delay``.
+        """
+        self.client.luns['a'] = 8
+        self.reaper.bury('a')
+        delays = []
+        for _ in range(4):
+            delay = self.reaper.reap()
+            delays.append(delay)
+            self.clock.advance(delay)
+        self.assertEqual([1, 2, 4, 4], delays)
+
+    def test_not_due(self):
+        """
+        A tombstone waiting to be retried isn't attempted early.
+        """
+        self.client.luns['a'] = 8
+        self.reaper.bury('a')
+        self.reaper.reap()
+        self.reaper.reap()
+        self.assertEqual([['a']], self.client.batches)
+
+    def test_gone(self):
+        """
+        A tombstone whose LUN has gone is finished with.
+        """
+        self.reaper.bury('a')
+        self.assertEqual(
+            (None, {'pending': 0, 'destroyed': 1, 'retries': 0}),
+            (self.reaper.reap(), self.reaper.stats())
+        )
+
+    def test_load(self):
+        """
+        ``load`` finds this cluster's tombstones and nothing else.
+        """
+        self.client.luns = {
+            'flockerrm--0b7d6b7e--block-1': 0,
+            'flockerrm--ffffffff--block-2': 0,
+            'flocker--0b7d6b7e--block-3': 0,
+        }
+        self.reaper.load()
+        self.assertEqual(1, self.reaper.stats()['pending'])
+
+    def test_reload(self):
+        """
+        The array is listed again every ``reload_interval`` seconds, so that
+        tombstones left meanwhile by other processes are destroyed.
+        """
+        delays = [self.reaper._step()]
+        self.client.luns['flockerrm--0b7d6b7e--block-1'] = 0
+        self.clock.advance(300)
+        delays.append(self.reaper._step())
+        self.clock.advance(600)
+        delays.append(self.reaper._step())
+        self.assertEqual(
+            ([300, 300, 300], [['flockerrm--0b7d6b7e--block-1']], {}),
+            (delays, self.client.batches, self.client.luns)
+        )
@@ -0,0 +1,98 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Tests for ``flocker_emc_vnx_driver._report``.
+"""
+
+import json
+from StringIO import StringIO
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._report import LatencyReport, main, percentile
+
+
+def action(task, level, action_type, status, timestamp, **fields):
+    fields.update(
+        task_uuid=task, task_level=level, action_type=action_type,
+        action_status=status, timestamp=timestamp,
+    )
+    return json.dumps(fields)
+
+
+def attach(task, start, lookup, scan):
+    """
+    :returns: The log lines of an attach whose lookup took ``lookup``
+        seconds and which scanned twice, for ``scan`` seconds each.
+    """
+    return [
+        action(task, [1], u'flocker_vnx:attach_volumes', u'started', start),
+        action(task, [2, 1], u'flocker_vnx:attach_volumes:lookup',
+               u'started', start),
+        action(task, [2, 2], u'flocker_vnx:attach_volumes:lookup',
+               u'succeeded', start + lookup),
+        action(task, [3, 1], u'flocker_vnx:attach_volumes:scan',
+               u'started', start + lookup),
+        action(task, [3, 2], u'flocker_vnx:attach_volumes:scan',
+               u'succeeded', start + lookup + scan),
+        action(task, [4, 1], u'flocker_vnx:attach_volumes:scan',
+               u'started', start + lookup + scan),
+        action(task, [4, 2], u'flocker_vnx:attach_volumes:scan',
+               u'succeeded', start + lookup + 2 * scan),
+        json.dumps({u'task_uuid': task, u'task_level': [5],
+                    u'operation': u'wait_for_devices_output',
+                    u'blockdevice_ids': [u'a', u'b'], u'passes': 2,
+                    u'timeouts': [u'b']}),
+        action(task, [6], u'flocker_vnx:attach_volumes', u'failed',
+               start + lookup + 2 * scan),
+    ]
+
+
+class PercentileTests(SynchronousTestCase):
+    """
+    Tests for ``percentile``.
+    """
+    def test_nearest_rank(self):
+        values = range(1, 101)
+        self.assertEqual(
+            [1, 50, 95, 100],
+            [percentile(values, f) for f in (0, 0.5, 0.95, 1)]
+        )
+
+
+class LatencyReportTests(SynchronousTestCase):
+    """
+    Tests for ``LatencyReport``.
+    """
+    def test_phases_summed(self):
+        """
+        The durations of a phase repeated within one attach are added
+        together.
+        """
+        report = LatencyReport()
+        report.read(attach(u'task', 100, 1, 2))
+        self.assertEqual(
+            {u'flocker_vnx:attach_volumes': [5],
+             u'flocker_vnx:attach_volumes:lookup': [1],
+             u'flocker_vnx:attach_volumes:scan': [4]},
+            {action_type: list(durations.values())
+             for action_type, durations in report._durations.items()}
+        )
+
+    def test_render(self):
+        """
+        The report gives percentiles for each action across every log, and
+        the rate of device timeouts.
+        """
+        stdout = StringIO()
+        stdin = StringIO(u'\n'.join(
+            [u'not json'] + attach(u'one', 100, 1, 2) +
+            attach(u'two', 100, 3, 2)
+        ))
+        main([], stdin=stdin, stdout=stdout)
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(
+            [u'attach_volumes:lookup 2 1.000 3.000 3.000 0',
+             u'device timeouts: 2 of 4 (50.00%)'],
+            [u' '.join(lines[2].split()), lines[6]]
+        )
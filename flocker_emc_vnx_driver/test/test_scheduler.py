@@ -0,0 +1,189 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Tests for ``flocker_emc_vnx_driver._scheduler``.
+"""
+
+import sys
+from Queue import Queue
+
+from zope.interface import implementer
+
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._executor import CommandResult, ICommandExecutor
+from .._scheduler import (
+    ATTACH, INVENTORY, MUTATION, ScheduledExecutor, TokenBucket, classify,
+)
+
+CLI = ('naviseccli', '-h', '192.0.2.1', '-secfilepath', '/keys')
+
+
+@implementer(ICommandExecutor)
+class HeldExecutor(object):
+    """
+    Accept commands and leave the test to finish them.
+
+    :ivar submitted: A ``Queue`` of ``(cmd, CommandResult)`` for each
+        command submitted.
+    """
+    workers = 1
+
+    def __init__(self):
+        self.submitted = Queue()
+
+    def submit(self, cmd, parse=None):
+        result = CommandResult()
+        self.submitted.put((cmd, result))
+        return result
+
+    def next(self):
+        return self.submitted.get(timeout=5)
+
+
+class ClassifyTests(SynchronousTestCase):
+    """
+    Tests for ``classify``.
+    """
+    def test_mutation(self):
+        self.assertEqual(MUTATION, classify(
+            CLI + ('storagegroup', '-addhlu', '-hlu', '5', '-alu', '7',
+                   '-gname', 'sg', '-o')
+        ))
+
+    def test_attach(self):
+        self.assertEqual(ATTACH, classify(
+            CLI + ('storagegroup', '-list', '-gname', 'sg', '-host')
+        ))
+
+    def test_inventory(self):
+        self.assertEqual(INVENTORY, classify(
+            CLI + ('lun', '-list', '-uid', '-state')
+        ))
+
+    def test_other_read(self):
+        """
+        A read which isn't a ``-list`` is not a mutation.
+        """
+        self.assertEqual(INVENTORY, classify(
+            CLI + ('connection', '-getport', '-address', '-vlanid')
+        ))
+
+    def test_rename(self):
+        self.assertEqual(MUTATION, classify(
+            CLI + ('lun', '-modify', '-name', 'a', '-newName', 'b', '-o')
+        ))
+
+
+class TokenBucketTests(SynchronousTestCase):
+    """
+    Tests for ``TokenBucket``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.path = FilePath(self.mktemp()).child('192.0.2.1.tokens')
+
+    def bucket(self):
+        return TokenBucket(self.path, rate=2, burst=3,
+                           clock=self.clock.seconds)
+
+    def test_burst(self):
+        """
+        ``burst`` tokens may be taken at once, after which the wait is until
+        the next token is added.
+        """
+        bucket = self.bucket()
+        self.assertEqual([0, 0, 0, 0.5], [bucket.take() for _ in range(4)])
+
+    def test_refill(self):
+        """
+        Tokens are added at ``rate`` a second.
+        """
+        bucket = self.bucket()
+        for _ in range(3):
+            bucket.take()
+        self.clock.advance(0.5)
+        self.assertEqual([0, 0.5], [bucket.take(), bucket.take()])
+
+    def test_shared(self):
+        """
+        Buckets using the same file share their tokens.
+        """
+        self.bucket().take()
+        self.bucket().take()
+        self.bucket().take()
+        self.assertEqual(0.5, self.bucket().take())
+
+
+class ScheduledExecutorTests(SynchronousTestCase):
+    """
+    Tests for ``ScheduledExecutor``.
+    """
+    def setUp(self):
+        self.held = HeldExecutor()
+        self.executor = ScheduledExecutor(self.held)
+        self.addCleanup(self.executor.stop)
+
+    def test_priority(self):
+        """
+        Commands queued while the wrapped executor is busy are handed on by
+        priority, and then in the order submitted.
+        """
+        first = CLI + ('lun', '-list')
+        self.executor.submit(first)
+        cmd, running = self.held.next()
+        commands = [
+            CLI + ('lun', '-list', '-uid'),
+            CLI + ('lun', '-list', '-name', 'a'),
+            CLI + ('lun', '-destroy', '-name', 'b'),
+            CLI + ('lun', '-create', '-name', 'c'),
+        ]
+        for command in commands:
+            self.executor.submit(command)
+        order = []
+        for _ in commands:
+            running._complete((0, '', None))
+            cmd, running = self.held.next()
+            order.append(cmd)
+        running._complete((0, '', None))
+        self.assertEqual(
+            [commands[2], commands[3], commands[1], commands[0]], order
+        )
+
+    def test_result(self):
+        """
+        The outcome of each command is passed on.
+        """
+        result = self.executor.submit(CLI + ('lun', '-list'))
+        _, pending = self.held.next()
+        pending._complete((0, 'out', None))
+        self.assertEqual((0, 'out', None), result.result())
+
+    def test_failure(self):
+        """
+        A command which couldn't be run is reported as such.
+        """
+        result = self.executor.submit(CLI + ('lun', '-list'))
+        _, pending = self.held.next()
+        try:
+            raise OSError("naviseccli not found")
+        except OSError:
+            pending._fail(sys.exc_info())
+        self.assertRaises(OSError, result.result)
+
+    def test_stats(self):
+        """
+        ``stats`` counts the commands of each class which were dispatched.
+        """
+        result = self.executor.submit(CLI + ('lun', '-list', '-name', 'a'))
+        _, pending = self.held.next()
+        pending._complete((0, '', None))
+        result.result()
+        stats = self.executor.stats()
+        self.assertEqual(
+            (1, 0, 0),
+            (stats['attach']['dispatched'], stats['attach']['queued'],
+             stats['inventory']['dispatched'])
+        )
@@ -0,0 +1,107 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Tests for ``flocker_emc_vnx_driver._singleflight``.
+"""
+
+import sys
+import threading
+import time
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._emc_vnx_client import EMCVNXClient
+from .._executor import CommandResult
+from .._singleflight import SingleFlight
+from .test_scheduler import HeldExecutor
+
+
+class SingleFlightTests(SynchronousTestCase):
+    """
+    Tests for ``SingleFlight``.
+    """
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.started = []
+
+    def start(self):
+        pending = CommandResult()
+        self.started.append(pending)
+        return pending
+
+    def test_shared(self):
+        """
+        A query for a key already in flight isn't started again, and gets
+        the outcome of the first.
+        """
+        first = self.flights.submit(('luns', 0), self.start)
+        second = self.flights.submit(('luns', 0), self.start)
+        self.started[0]._complete([1, 2])
+        self.assertEqual(
+            (1, [1, 2], [1, 2], {'luns': {'executed': 1, 'shared': 1}}),
+            (len(self.started), first.result(), second.result(),
+             self.flights.stats())
+        )
+
+    def test_different_keys(self):
+        """
+        Queries for different keys each run.
+        """
+        self.flights.submit(('luns', 0), self.start)
+        self.flights.submit(('luns', 1), self.start)
+        self.assertEqual(2, len(self.started))
+
+    def test_landed(self):
+        """
+        Once a query has finished, the next one for its key runs again.
+        """
+        self.flights.submit(('luns', 0), self.start)
+        self.started[0]._complete([])
+        self.flights.submit(('luns', 0), self.start)
+        self.assertEqual(2, len(self.started))
+
+    def test_failure(self):
+        """
+        Every caller sharing a query which fails gets its exception.
+        """
+        first = self.flights.submit(('luns', 0), self.start)
+        second = self.flights.submit(('luns', 0), self.start)
+        try:
+            raise OSError()
+        except OSError:
+            self.started[0]._fail(sys.exc_info())
+        self.assertRaises(OSError, first.result)
+        self.assertRaises(OSError, second.result)
+
+
+class ClientTests(SynchronousTestCase):
+    """
+    Tests for the coalescing of ``EMCVNXClient`` queries.
+    """
+    def test_concurrent_storage_groups(self):
+        """
+        Concurrent calls of ``storage_groups`` share one ``naviseccli``.
+        """
+        executor = HeldExecutor()
+        client = EMCVNXClient('192.0.2.1', '/keys', executor=executor)
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(client.storage_groups())
+            )
+            for _ in range(2)
+        ]
+        threads[0].start()
+        _, pending = executor.next()
+        threads[1].start()
+        deadline = time.time() + 5
+        while client.flights.stats()['storage_groups']['shared'] < 1:
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.001)
+        pending._complete((0, '', None))
+        for thread in threads:
+            thread.join()
+        self.assertEqual(
+            ([{}, {}], True, True),
+            (results, results[0] is results[1], executor.submitted.empty())
+        )
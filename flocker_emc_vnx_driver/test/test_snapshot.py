@@ -0,0 +1,203 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Tests for ``flocker_emc_vnx_driver._snapshot``.
+"""
+
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._emc_vnx_client import EMCVNXClient
+from .._records import LUN, StorageGroup
+from .._snapshot import SnapshotReader, SnapshotWriter
+from .test_driver import FakeExecutor, LUN_OUTPUT, STORAGE_GROUP_OUTPUT
+
+KEYS = frozenset(prop.key for prop in EMCVNXClient.LUN_ATTACHMENT)
+
+
+class FakeClient(object):
+    """
+    Just enough of ``EMCVNXClient`` to write snapshots.
+    """
+    def __init__(self):
+        self.luns = [
+            LUN(lun_id=7, lun_name='a', lun_uid='600601',
+                total_capacity_gb=8.0),
+            LUN(lun_id=8, lun_name='b', total_capacity_gb=16.0),
+        ]
+        self.storage_groups = {
+            'node1': StorageGroup(name='node1', storage_group_uid='AB:CD',
+                                  lunmap={7: 5}),
+        }
+        self.listings = 0
+
+    def list_inventory(self, properties):
+        self.listings += 1
+        return self.luns, self.storage_groups
+
+
+class SnapshotTests(SynchronousTestCase):
+    """
+    Tests for ``SnapshotWriter`` and ``SnapshotReader``.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.clock.advance(1000)
+        self.path = FilePath(self.mktemp()).child('192.0.2.1.snapshot')
+        self.client = FakeClient()
+        self.writer = self.make_writer()
+        self.reader = SnapshotReader(self.path, 10, clock=self.clock.seconds)
+
+    def make_writer(self):
+        writer = SnapshotWriter(
+            self.client, self.path, 5, EMCVNXClient.LUN_ATTACHMENT,
+            clock=self.clock.seconds,
+        )
+        self.addCleanup(writer.stop)
+        return writer
+
+    def test_round_trip(self):
+        """
+        A reader sees the LUNs and storage groups the writer listed.
+        """
+        self.writer.publish()
+        snapshot = self.reader.read(KEYS)
+        self.assertEqual(
+            (1000, self.client.luns, self.client.storage_groups,
+             self.client.luns[1]),
+            (snapshot.taken_at, snapshot.luns, snapshot.storage_groups,
+             snapshot.lun('b'))
+        )
+
+    def test_unchanged(self):
+        """
+        An unchanged snapshot is only decoded once, so readers see the same
+        records each time.
+        """
+        self.writer.publish()
+        first = self.reader.read(KEYS)
+        self.assertIs(first, self.reader.read(KEYS))
+
+    def test_taken_again(self):
+        """
+        When the writer lists the same LUNs and storage groups again, readers
+        see the new ``taken_at`` but keep the records they already decoded.
+        """
+        self.writer.publish()
+        first = self.reader.read(KEYS)
+        self.clock.advance(5)
+        self.writer.publish()
+        second = self.reader.read(KEYS)
+        self.assertEqual(
+            (1005, True, True),
+            (second.taken_at, second.luns is first.luns,
+             second.storage_groups is first.storage_groups)
+        )
+
+    def test_replaced(self):
+        """
+        Once the writer replaces the snapshot, readers see the new listing.
+        """
+        self.writer.publish()
+        self.reader.read(KEYS)
+        del self.client.luns[0]
+        self.clock.advance(5)
+        self.writer.publish()
+        snapshot = self.reader.read(KEYS)
+        self.assertEqual(
+            (1005, ['b']),
+            (snapshot.taken_at, [lun.lun_name for lun in snapshot.luns])
+        )
+
+    def test_unusable(self):
+        """
+        Readers get ``None`` rather than a snapshot which is missing,
+        corrupt, too old, taken before ``newer_than`` or without the wanted
+        properties.
+        """
+        missing = self.reader.read(KEYS)
+        self.path.parent().makedirs()
+        self.path.setContent('garbage')
+        corrupt = self.reader.read(KEYS)
+        self.writer.publish()
+        unwanted = self.reader.read(KEYS | {'state'})
+        earlier = self.reader.read(KEYS, newer_than=1000)
+        self.clock.advance(11)
+        old = self.reader.read(KEYS)
+        self.assertEqual(
+            ([None] * 5, 0, 5),
+            ([missing, corrupt, unwanted, earlier, old],
+             self.reader.hits, self.reader.misses)
+        )
+
+    def test_one_writer(self):
+        """
+        Only one writer publishes at a time.  Another takes over once it
+        stops.
+        """
+        other = self.make_writer()
+        published = [self.writer.publish(), other.publish()]
+        self.writer.stop()
+        published.append(other.publish())
+        self.assertEqual(
+            ([True, False, True], 2), (published, self.client.listings)
+        )
+
+
+class ClientTests(SynchronousTestCase):
+    """
+    Tests for ``EMCVNXClient`` with a shared snapshot.
+    """
+    def setUp(self):
+        self.path = FilePath(self.mktemp()).child('192.0.2.1.snapshot')
+        self.executor = FakeExecutor(
+            LUN_OUTPUT.format(name='a'), STORAGE_GROUP_OUTPUT
+        )
+        self.client = EMCVNXClient(
+            '192.0.2.1', '/keys', executor=self.executor,
+            snapshot=SnapshotReader(self.path, 60),
+        )
+        writer = SnapshotWriter(
+            self.client, self.path, 30, EMCVNXClient.LUN_ATTACHMENT
+        )
+        self.addCleanup(writer.stop)
+        writer.publish()
+        del self.executor.commands[:]
+
+    def test_shared(self):
+        """
+        Inventory queries are answered from the snapshot without running
+        ``naviseccli``.
+        """
+        luns, groups = self.client.get_inventory(EMCVNXClient.LUN_INVENTORY)
+        self.assertEqual(
+            ([7], {7: 5}, 7, [], 0),
+            ([lun.lun_id for lun in luns], groups['node1'].lunmap,
+             self.client.get_lun_by_name(
+                 'a', EMCVNXClient.LUN_ATTACHMENT
+             ).lun_id,
+             self.executor.commands, self.client.snapshot.misses)
+        )
+
+    def test_changed(self):
+        """
+        After the client changes the array it ignores snapshots taken
+        before the change.
+        """
+        self.client.add_volume_to_sg('6', '8', 'node1')
+        self.client.storage_groups()
+        self.assertEqual(
+            [('storagegroup', '-addhlu'), ('storagegroup', '-list')],
+            [cmd[5:7] for cmd in self.executor.commands]
+        )
+
+    def test_not_listed(self):
+        """
+        Properties the snapshot doesn't have are fetched from the array.
+        """
+        self.client.get_all_luns(EMCVNXClient.LUN_ALL)
+        self.assertEqual(
+            [('lun', '-list')],
+            [cmd[5:7] for cmd in self.executor.commands]
+        )
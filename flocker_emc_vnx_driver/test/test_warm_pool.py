@@ -0,0 +1,126 @@
+# Copyright ClusterHQ Inc.  See LICENSE file for details.
+
+"""
+Tests for ``flocker_emc_vnx_driver._warm_pool``.
+"""
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from .._records import LUN
+from .._warm_pool import WarmPool
+
+CLUSTER_ID = '0b7d6b7e-5c8a-4a3f-a6c2-0e1c1e0e7e7e'
+
+
+class FakeClient(object):
+    """
+    Just enough of ``EMCVNXClient`` to manage spare LUNs.
+
+    :ivar dict luns: Maps LUN names to their sizes, in GiB.
+    """
+    LUN_INVENTORY = []
+
+    def __init__(self):
+        self.luns = {}
+        self.rc = 0
+
+    def list_luns(self, properties):
+        return self.rc, [LUN(lun_name=name) for name in self.luns]
+
+    def create_volume(self, name, size, pool):
+        self.luns[name] = int(size)
+        return 0, ''
+
+    def wait_for_volume(self, name):
+        pass
+
+    def rename_volume(self, name, new_name):
+        if name not in self.luns:
+            return 9, 'No such LUN'
+        self.luns[new_name] = self.luns.pop(name)
+        return 0, ''
+
+
+class WarmPoolTests(SynchronousTestCase):
+    """
+    Tests for ``WarmPool``.
+    """
+    def setUp(self):
+        self.client = FakeClient()
+        self.pool = WarmPool(
+            self.client, 'pool', CLUSTER_ID, sizes=[8, 1], depth=2
+        )
+
+    def test_refill(self):
+        """
+        ``refill`` creates ``depth`` spares of each size.
+        """
+        self.pool.refill()
+        self.assertEqual(
+            [1, 1, 8, 8], sorted(self.client.luns.values())
+        )
+
+    def test_spares_are_not_volumes(self):
+        """
+        Spares are named under their own prefix.
+        """
+        self.pool.refill()
+        for name in self.client.luns:
+            self.assertTrue(name.startswith('flockerspare--0b7d6b7e--'))
+
+    def test_hit(self):
+        """
+        ``claim`` renames a spare of the requested size.
+        """
+        self.pool.refill()
+        self.assertEqual(
+            (True, 8, {'hits': 1, 'misses': 0, 'spares': {1: 2, 8: 1}}),
+            (self.pool.claim(8, 'flocker--0b7d6b7e--vol'),
+             self.client.luns.get('flocker--0b7d6b7e--vol'),
+             self.pool.stats())
+        )
+
+    def test_miss(self):
+        """
+        ``claim`` returns ``False`` if there is no spare of the requested
+        size.
+        """
+        self.pool.refill()
+        self.assertEqual(
+            (False, {'hits': 0, 'misses': 1, 'spares': {1: 2, 8: 2}}),
+            (self.pool.claim(4, 'flocker--0b7d6b7e--vol'), self.pool.stats())
+        )
+
+    def test_claimed_elsewhere(self):
+        """
+        If a spare has been claimed by another node, the next one is used.
+        """
+        self.pool.refill()
+        self.client.rename_volume(
+            self.pool._spares[8][0], 'flocker--0b7d6b7e--other'
+        )
+        self.assertTrue(self.pool.claim(8, 'flocker--0b7d6b7e--vol'))
+        self.assertEqual(0, self.pool.stats()['spares'][8])
+
+    def test_load(self):
+        """
+        ``load`` finds this cluster's existing spares and ignores other LUNs.
+        """
+        self.pool.refill()
+        self.client.luns['flockerspare--ffffffff--8--abc'] = 8
+        self.client.luns['flocker--0b7d6b7e--vol'] = 8
+        pool = WarmPool(
+            self.client, 'pool', CLUSTER_ID, sizes=[8, 1], depth=2
+        )
+        pool.load()
+        self.assertEqual({1: 2, 8: 2}, pool.stats()['spares'])
+
+    def test_load_failure(self):
+        """
+        If the LUNs can't be listed, ``load`` raises and keeps the spares it
+        already knew of.
+        """
+        self.pool.refill()
+        self.client.rc = 1
+        self.assertRaises(Exception, self.pool.load)
+        self.assertEqual({1: 2, 8: 2}, self.pool.stats()['spares'])
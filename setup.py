@@ -35,4 +35,12 @@ setup(
     extras_require={
         "dev": dev_requires,
     },
+    entry_points={
+        "console_scripts": [
+            "flocker-vnx-latency-report = "
+            "flocker_emc_vnx_driver._report:main",
+            "flocker-vnx-benchmark = "
+            "flocker_emc_vnx_driver._benchmark:main",
+        ],
+    },
 )